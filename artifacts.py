@@ -0,0 +1,208 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# artifacts.py -- what the Coldcard made for us (previews, signed files), so we don't ask twice.
+#
+# - keyed by PSBT hash, xfp of the Coldcard, and the flags used
+# - kept on disk, encrypted using a key derived from BP.key; file names are keyed hashes
+# - total size is limited; least recently used are removed first
+#
+import os, asyncio, logging, hmac
+import nacl.secret
+from hashlib import sha256
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from utils import Singleton
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+def subkey(key, purpose):
+    return hmac.new(key, b'artifacts-' + purpose, sha256).digest()
+
+class ArtifactCache(metaclass=Singleton):
+
+    def __init__(self):
+        # all file access is done in this one thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._index = None          # OrderedDict: filename => size, least recently used first
+        self.size = 0
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def path(self):
+        from persist import settings
+        return os.path.join(settings.DATA_FILES, 'artifacts')
+
+    def _load_index(self):
+        # (in thread) what we have on disk, oldest first
+        if self._index is not None:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+
+        files = []
+        for fn in os.listdir(self.path):
+            if not fn.endswith('.bin'): continue
+            st = os.stat(os.path.join(self.path, fn))
+            files.append((st.st_mtime, fn, st.st_size))
+        files.sort()
+
+        self._index = OrderedDict((fn, sz) for _, fn, sz in files)
+        self.size = sum(self._index.values())
+
+    def _filename(self, key, hh, xfp, flags, finalize):
+        msg = f'{hh}:{xfp}:{flags:x}:{int(bool(finalize))}'.encode('ascii')
+        return hmac.new(subkey(key, b'name'), msg, sha256).hexdigest()[0:32] + '.bin'
+
+    def _get(self, key, name):
+        self._load_index()
+        if name not in self._index:
+            return None
+
+        fn = os.path.join(self.path, name)
+        try:
+            with open(fn, 'rb') as fd:
+                data = nacl.secret.SecretBox(subkey(key, b'data')).decrypt(fd.read())
+        except Exception as exc:
+            logging.warning(f"Dropping bad cache file {name}: {exc}")
+            self._remove(name)
+            return None
+
+        # remember it was used, here and on disk (for next time we start)
+        self._index.move_to_end(name)
+        os.utime(fn)
+
+        return data
+
+    def _put(self, key, name, data, limit):
+        self._load_index()
+
+        enc = nacl.secret.SecretBox(subkey(key, b'data')).encrypt(data)
+        if len(enc) > limit:
+            return
+
+        fn = os.path.join(self.path, name)
+        with open(fn + '.tmp', 'wb') as fd:
+            fd.write(enc)
+        os.replace(fn + '.tmp', fn)
+
+        self.size += len(enc) - self._index.pop(name, 0)
+        self._index[name] = len(enc)
+
+        while self.size > limit:
+            self._remove(next(iter(self._index)))
+            self.evictions += 1
+
+    def _remove(self, name):
+        self.size -= self._index.pop(name)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def _clear(self):
+        self._load_index()
+        for name in list(self._index):
+            self._remove(name)
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def get(self, hh, xfp, flags=0, finalize=False):
+        # Cached result for this PSBT (by hash) from that Coldcard, or None
+        from persist import BP, settings
+
+        # until BP is loaded, BP.key is a random placeholder; cache would be useless
+        if not BP.loaded or not settings.ARTIFACT_CACHE_SIZE:
+            return None
+
+        try:
+            rv = await self._call(self._get, BP.key,
+                                    self._filename(BP.key, hh, xfp, flags, finalize))
+        except Exception:
+            logging.error("Artifact cache", exc_info=1)
+            rv = None
+
+        if rv is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.publish()
+
+        return rv
+
+    async def put(self, hh, xfp, flags, finalize, data):
+        # Remember result from Coldcard; errors are logged, never raised
+        from persist import BP, settings
+
+        if not BP.loaded or not settings.ARTIFACT_CACHE_SIZE:
+            return
+
+        try:
+            await self._call(self._put, BP.key,
+                                self._filename(BP.key, hh, xfp, flags, finalize),
+                                data, settings.ARTIFACT_CACHE_SIZE)
+        except Exception:
+            logging.error("Artifact cache", exc_info=1)
+
+        self.publish()
+
+    async def clear(self):
+        await self._call(self._clear)
+        self.publish()
+
+    def publish(self):
+        from status import STATUS
+
+        lookups = self.hits + self.misses
+        STATUS.artifact_cache = dict(hits=self.hits, misses=self.misses,
+                        hit_rate=round(self.hits / lookups, 3) if lookups else None,
+                        count=len(self._index or []), size=self.size, evictions=self.evictions)
+
+# singleton
+ARTIFACTS = ArtifactCache()
+
+if __name__ == '__main__':
+    # Benchmark: lookups, and eviction when full
+    #   python artifacts.py [count]
+    import sys, time, tempfile
+    from persist import Settings
+    Settings.startup()
+    from persist import settings, BP
+    settings.DATA_FILES = tempfile.mkdtemp()
+    settings.ARTIFACT_CACHE_SIZE = 1024*1024
+    BP.open(os.urandom(32))
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    async def main():
+        blob = os.urandom(4000)
+        hashes = [sha256(b'%d' % i).hexdigest() for i in range(count)]
+
+        t = time.perf_counter()
+        for hh in hashes:
+            await ARTIFACTS.put(hh, '0F056943', 0, True, blob)
+        dt = time.perf_counter() - t
+        print(f"put: {count} x {len(blob)} bytes, {1000*dt/count:.2f}ms each; "
+                    f"{ARTIFACTS.evictions} evicted, {ARTIFACTS.size} bytes kept")
+
+        t = time.perf_counter()
+        for hh in hashes:
+            got = await ARTIFACTS.get(hh, '0F056943', 0, True)
+            assert got in (None, blob)
+        dt = time.perf_counter() - t
+        print(f"get: {1000*dt/count:.2f}ms each; {ARTIFACTS.hits} hits, {ARTIFACTS.misses} misses")
+
+        # newest survive a restart; different flags don't match
+        ARTIFACTS._index = None
+        assert await ARTIFACTS.get(hashes[-1], '0F056943', 0, True) == blob
+        assert await ARTIFACTS.get(hashes[-1], '0F056943', 0, False) is None
+        print(STATUS.artifact_cache)
+
+    from status import STATUS
+    asyncio.run(main())
+
+# EOF
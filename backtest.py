@@ -0,0 +1,291 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# backtest.py -- what would this HSM policy have done with these transactions?
+#
+# - policy is a dict as made by policy.web_cleanup() (or a downloaded policy file)
+# - transactions: time, amount sent (not change) and destination addresses; from
+#   the signing history, or a CSV/JSON file (see load_file)
+# - each rule is checked against all transactions at once, using columns of values;
+#   numpy is used if installed, otherwise plain arrays
+# - velocity limits depend on what was approved before, so that's done last, in time order
+#
+import logging, csv, json, time
+from array import array
+from datetime import datetime
+from decimal import Decimal
+from policy import norm_addr
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+class TxnColumns:
+    # Transactions as columns, sorted by time. Destinations are numbered (see .addrs)
+    # and kept in one column: those for txn i are dests[offsets[i]:offsets[i+1]]
+
+    def __init__(self, txns):
+        txns = sorted(txns, key=lambda t: t['ts'])
+
+        self.addrs = {}             # address => number
+        ts, amount, multisig = array('d'), array('q'), array('b')
+        offsets, dests, owner = array('q', [0]), array('q'), array('q')
+
+        for i, t in enumerate(txns):
+            ts.append(t['ts'])
+            amount.append(t['amount'])
+            multisig.append(bool(t.get('multisig')))
+            for a in set(norm_addr(a) for a in t['destinations']):
+                dests.append(self.addrs.setdefault(a, len(self.addrs)))
+                owner.append(i)
+            offsets.append(len(dests))
+
+        if np is not None:
+            ts, amount, offsets, dests, owner = [np.frombuffer(c, dtype=c.typecode)
+                                        for c in (ts, amount, offsets, dests, owner)]
+            multisig = np.frombuffer(multisig, dtype=np.int8).astype(bool)
+
+        self.ts, self.amount, self.multisig = ts, amount, multisig
+        self.offsets, self.dests, self.owner = offsets, dests, owner
+
+    def __len__(self):
+        return len(self.ts)
+
+    def where(self, fn, col):
+        # bool column: fn applied to each value of col
+        if np is not None:
+            return fn(col)
+        return array('b', (fn(v) for v in col))
+
+    def all_dests_in(self, wanted):
+        # bool column: are all destinations of each txn in set of addresses?
+        known = [a in wanted for a in self.addrs]
+
+        if np is not None:
+            bad = ~np.array(known, dtype=bool)[self.dests]
+            return np.bincount(self.owner, weights=bad, minlength=len(self)) == 0
+
+        o = self.offsets
+        return array('b', (all(known[d] for d in self.dests[o[i]:o[i+1]])
+                                    for i in range(len(self))))
+
+def both(a, b):
+    if np is not None:
+        return a & b
+    return array('b', (x and y for x, y in zip(a, b)))
+
+def rule_matches(cols, rule):
+    # Txns this rule could apply to, ignoring velocity (and users: we assume they'll auth)
+    n = len(cols)
+    ok = np.ones(n, dtype=bool) if np is not None else array('b', [1]*n)
+
+    wallet = rule.get('wallet') or None
+    if wallet == '1':
+        ok = both(ok, cols.where(lambda m: m == 0, cols.multisig))
+    elif wallet:
+        # can't tell which multisig wallet from here
+        ok = both(ok, cols.where(lambda m: m != 0, cols.multisig))
+
+    for fn in ['max_amount', 'per_period']:
+        limit = rule.get(fn)
+        if limit is not None:
+            ok = both(ok, cols.where(lambda v: v <= limit, cols.amount))
+
+    if rule.get('whitelist'):
+        ok = both(ok, cols.all_dests_in(set(norm_addr(a) for a in rule['whitelist'])))
+
+    return ok
+
+def first_match(cols, matches):
+    # index of first rule that matches each txn, or -1
+    if np is not None and matches:
+        m = np.vstack(matches)
+        return np.where(m.any(axis=0), m.argmax(axis=0), -1)
+
+    rv = array('q', [-1] * len(cols))
+    for r in reversed(range(len(matches))):
+        for i, ok in enumerate(matches[r]):
+            if ok:
+                rv[i] = r
+    return rv
+
+def needs(rule):
+    # text for what else is needed for this rule, besides the Coldcard
+    rv = []
+    if rule.get('users'):
+        m = rule.get('min_users') or len(rule['users'])
+        rv.append(f"{m} of {', '.join(rule['users'])}")
+    if rule.get('local_conf'):
+        rv.append('local code')
+    return ' + '.join(rv) or None
+
+def backtest(pol, txns, details=False):
+    # Replay txns against policy. Returns a report (dict); with details, has the
+    # outcome of each txn as well.
+    started = time.perf_counter()
+
+    rules = pol.get('rules') or []
+    cols = txns if isinstance(txns, TxnColumns) else TxnColumns(txns)
+    n = len(cols)
+
+    matches = [rule_matches(cols, r) for r in rules]
+    used = first_match(cols, matches)
+
+    velocity = [r.get('per_period') for r in rules]
+    if any(v is not None for v in velocity):
+        # one period for all rules; starts at first use of a rule w/ per-period limit
+        period = (pol.get('period') or 0) * 60
+        ts, amount = cols.ts.tolist(), cols.amount.tolist()
+        used = used.tolist()
+        ok = [m.tolist() for m in matches]
+        spent = [0] * len(rules)
+        ends = None
+
+        for i in range(n):
+            if used[i] < 0 or velocity[used[i]] is None:
+                continue
+            if ends is not None and ts[i] >= ends:
+                spent = [0] * len(rules)
+                ends = None
+
+            # first rule that fits, with what's left this period
+            for r in range(used[i], len(rules)):
+                if not ok[r][i]:
+                    continue
+                if velocity[r] is None:
+                    break
+                if spent[r] + amount[i] <= velocity[r]:
+                    spent[r] += amount[i]
+                    if ends is None:
+                        ends = ts[i] + period
+                    break
+            else:
+                r = -1
+            used[i] = r
+
+    used = [int(r) for r in used]
+    amounts = cols.amount.tolist()
+
+    per_rule = [dict(rule=r+1, count=0, amount=0, needs=needs(rule))
+                    for r, rule in enumerate(rules)]
+    refused = dict(count=0, amount=0)
+    needs_auth = {}
+    for r, amt in zip(used, amounts):
+        if r < 0:
+            refused['count'] += 1
+            refused['amount'] += amt
+        else:
+            per_rule[r]['count'] += 1
+            per_rule[r]['amount'] += amt
+            if per_rule[r]['needs']:
+                needs_auth[per_rule[r]['needs']] = needs_auth.get(per_rule[r]['needs'], 0) + 1
+
+    rv = dict(count=n, approved=n - refused['count'], refused=refused, rules=per_rule,
+                needs_auth=needs_auth, numpy=(np is not None),
+                elapsed=round(time.perf_counter() - started, 3))
+
+    if details:
+        ts = cols.ts.tolist()
+        rv['txns'] = [dict(ts=t, amount=a, rule=(r+1 if r >= 0 else None))
+                            for t, a, r in zip(ts, amounts, used)]
+
+    return rv
+
+def parse_time(v):
+    # unix time, or ISO 8601
+    try:
+        return float(v)
+    except ValueError:
+        return datetime.fromisoformat(v).timestamp()
+
+def load_file(fobj):
+    # Transactions from a file:
+    # - CSV w/ header: time, amount (BTC) and destination (several separated by spaces)
+    #   and optionally: multisig (0/1)
+    # - or JSON list (or lines) of objects w/ same fields
+    # Returns list of dict for backtest()
+    text = fobj.read()
+    if text.lstrip()[0:1] in ('[', '{'):
+        try:
+            rows = json.loads(text, parse_float=Decimal)
+        except ValueError:
+            rows = [json.loads(ln, parse_float=Decimal) for ln in text.splitlines() if ln.strip()]
+    else:
+        rows = list(csv.DictReader(text.splitlines()))
+
+    rv = []
+    for row in rows:
+        dests = row.get('destination') or row.get('destinations') or []
+        if isinstance(dests, str):
+            dests = dests.split()
+        rv.append(dict(ts=parse_time(str(row['time'])),
+                        amount=int(Decimal(str(row['amount'])) * Decimal('1E8')),
+                        destinations=dests,
+                        multisig=str(row.get('multisig', '0')).lower() in ('1', 'true', 'yes')))
+    return rv
+
+def from_history(entries, testnet=False):
+    # Signed txns from signing history (history.py) as txns for backtest()
+    from psbt import script_to_address
+
+    rv = []
+    for e in entries:
+        if 'sending' in e:
+            amount, dests = e['sending'], e.get('dest_addrs') or []
+        elif e.get('outputs'):
+            # don't know which were change; count them all
+            amount = sum(o['value'] for o in e['outputs'])
+            dests = [script_to_address(bytes.fromhex(o['script']), testnet) or o['script']
+                            for o in e['outputs']]
+        else:
+            continue
+        rv.append(dict(ts=e['ts'], amount=amount, destinations=dests))
+    return rv
+
+def report_text(r):
+    # Report as text, for the command line
+    btc = lambda sats: '%.8f' % (sats / 1E8)
+    lines = [f"{r['count']} transactions: {r['approved']} approved, "
+                f"{r['refused']['count']} refused ({btc(r['refused']['amount'])} BTC)", '']
+
+    for pr in r['rules']:
+        lines.append(f"  Rule #{pr['rule']}: {pr['count']:8d} txn  {btc(pr['amount']):>18} BTC"
+                        + (f"  needs: {pr['needs']}" if pr['needs'] else ''))
+
+    lines.append('')
+    lines.append(f"({r['elapsed']}s, {'numpy' if r['numpy'] else 'no numpy'})")
+
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    # Benchmark: a year of synthetic history, every 2 minutes
+    #   python backtest.py [count] [nonumpy]
+    import sys, random
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 365*24*30
+    if 'nonumpy' in sys.argv:
+        np = None
+
+    wl = ['bc1q%038x' % i for i in range(500)]
+    pol = dict(period=24*60, rules=[
+        dict(whitelist=wl[0:100], max_amount=10**8),
+        dict(max_amount=10**6, per_period=10**8),
+        dict(users=['alice', 'bob', 'carol'], min_users=2, local_conf=True),
+    ])
+
+    t0 = time.time() - 365*86400
+    txns = [dict(ts=t0 + i*120, amount=int(random.expovariate(1 / 10**6)),
+                    destinations=random.sample(wl, random.choice([1, 1, 2])))
+                for i in range(count)]
+
+    t = time.perf_counter()
+    cols = TxnColumns(txns)
+    print(f"columns: {count} txns in {time.perf_counter() - t:.2f}s")
+
+    r = backtest(pol, cols)
+    print(report_text(r))
+    print(r['needs_auth'])
+
+# EOF
@@ -2,54 +2,253 @@
 #
 # chain.py --- API to blockstream stuff
 #
-import sys, os, asyncio, logging, requests
+# - broadcast is sent to all the Esplora servers we know (and bitcoind, if configured)
+#   at the same time: first one to accept it wins
+# - each backend keeps a requests.Session, so connections via Tor are reused
+# - blocking network calls happen in a thread, not on the event loop
+#
+import sys, os, asyncio, logging, requests, time
 from objstruct import ObjectStruct
 from persist import settings
 from status import STATUS
 from binascii import b2a_hex, a2b_hex
-from utils import json_loads
+from urllib.parse import urlparse
+from utils import json_loads, Histogram, Singleton
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
-def broadcast_txn(txn):
-    # take bytes and get them shared over P2P to the world
-    # - raise w/ text about what happened if it fails
+# bitcoind/esplora error text when another backend beat them to it
+ALREADY_KNOWN = ['already in block chain', 'txn-already-known', 'txn-already-in-mempool']
+
+class BroadcastError(RuntimeError):
+    pass
+
+class BroadcastRejected(BroadcastError):
+    # backend got the txn, and said no; retrying won't help
+    pass
+
+class ServersUnreachable(BroadcastError):
+    # none of the backends answered; try again later
+    pass
+
+def is_local_url(url):
+    host = urlparse(url).hostname or ''
+    return host in ('localhost', '127.0.0.1', '::1')
+
+class Backend:
+    # something that can broadcast a txn for us. Subclasses do the protocol.
+
+    def __init__(self, url):
+        self.url = url
+
+        u = urlparse(url)
+        self.label = (u.hostname + (f':{u.port}' if u.port else '')) if u.hostname else url
+
+        ses = requests.Session()
+        ses.headers.clear()     # hide user-agent
+        if not is_local_url(url):
+            ses.proxies = dict(http=settings.TOR_SOCKS, https=settings.TOR_SOCKS)
+        self.ses = ses
+
+        # stats
+        self.latency = Histogram()
+        self.ok = 0
+        self.rejected = 0
+        self.failed = 0
+        self.last_error = None
+
+    def summary(self):
+        return dict(label=self.label, ok=self.ok, rejected=self.rejected, failed=self.failed,
+                        last_error=self.last_error, latency=self.latency.as_dict())
+
+    def send(self, txn_hex):
+        # blocking; return txid (hex), or raise
+        raise NotImplementedError
+
+    async def broadcast(self, txn_hex):
+        # Send it, with retries for network problems (but not if it's rejected).
+        loop = asyncio.get_running_loop()
+        delay = settings.BROADCAST_BACKOFF
+
+        for attempt in range(settings.BROADCAST_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(delay)
+                delay *= 2
+
+            t = time.perf_counter()
+            try:
+                rv = await loop.run_in_executor(None, self.send, txn_hex)
+                self.latency.add(time.perf_counter() - t)
+                self.ok += 1
+                return rv
+            except BroadcastRejected as exc:
+                self.latency.add(time.perf_counter() - t)
+                self.rejected += 1
+                self.last_error = str(exc)
+                raise
+            except Exception as exc:
+                self.failed += 1
+                self.last_error = str(exc) or type(exc).__name__
+                logging.warning(f"Broadcast via {self.label} failed (try {attempt+1}): "
+                                    f"{self.last_error}")
+                last_exc = exc
+
+        raise last_exc
+
+class EsploraBackend(Backend):
+    # Blockstream's Esplora protocol
     # - limited docs: <https://github.com/Blockstream/esplora/blob/master/API.md>
-    ses = requests.session()
-    ses.proxies = dict(http=settings.TOR_SOCKS)
-    ses.headers.clear()     # hide user-agent
 
-    url = settings.EXPLORA
-    url += '/api/tx' if not STATUS.is_testnet else '/testnet/api/tx'
+    def api_url(self, path):
+        return self.url + ('/api/' if not STATUS.is_testnet else '/testnet/api/') + path
+
+    def get(self, path):
+        # blocking; returns text of response, or None if not found
+        resp = self.ses.get(self.api_url(path), timeout=settings.BROADCAST_TIMEOUT)
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.text
+
+    def send(self, txn_hex):
+        url = self.api_url('tx')
+
+        logging.warning(f"Sending txn via: {url}")
+        resp = self.ses.post(url, data=txn_hex, timeout=settings.BROADCAST_TIMEOUT)
+
+        msg = resp.text
+
+        if resp.status_code >= 500 and 'RPC error' not in msg:
+            # their problem, not ours; try again
+            resp.raise_for_status()
+
+        if not resp.ok:
+            # content is like:
+            #       sendrawtransaction RPC error: {"code":-22,"message":"TX decode failed"}
+            # which is a text thing, including some JSON from bitcoind?
+
+            if '"message":' in msg:
+                try:
+                    prefix, rest = msg.split(': ', 1)
+                    j = json_loads(rest)
+                    if prefix == 'sendrawtransaction RPC error':
+                        msg = j.message
+                    else:
+                        msg = prefix + ': ' + j.message
+                except:
+                    pass
+
+            raise BroadcastRejected(msg)
+
+        return msg.strip()
+
+class BitcoindBackend(Backend):
+    # JSON-RPC to a bitcoind; url has the user:password in it
 
-    assert '.onion/' in url, 'dude, your privacy'
-    logging.warning(f"Sending txn via: {url}")
-    resp = ses.post(url, data=b2a_hex(txn).decode('ascii'))
+    def send(self, txn_hex):
+        body = dict(jsonrpc='1.0', id='ckbunker', method='sendrawtransaction', params=[txn_hex])
+        resp = self.ses.post(self.url, json=body, timeout=settings.BROADCAST_TIMEOUT)
 
-    msg = resp.text
+        try:
+            j = json_loads(resp.text)
+        except ValueError:
+            # not JSON: bad password, etc.
+            resp.raise_for_status()
+            raise
 
-    if not resp.ok:
-        # content is like:
-        #       sendrawtransaction RPC error: {"code":-22,"message":"TX decode failed"}
-        # which is a text thing, including some JSON from bitcoind?
+        if j.get('error'):
+            raise BroadcastRejected(j.error.message)
 
-        if '"message":' in msg:
+        return j.result
+
+class Broadcaster(metaclass=Singleton):
+
+    def __init__(self):
+        self.backends = None
+
+    def setup(self):
+        # build list of backends, based on settings
+        urls = [settings.EXPLORA] + list(settings.EXPLORA_MIRRORS)
+
+        for url in urls + [settings.BITCOIND_RPC or '']:
+            assert not url or ('.onion' in url) or is_local_url(url), 'dude, your privacy'
+
+        self.backends = [EsploraBackend(u) for u in urls]
+        if settings.BITCOIND_RPC:
+            self.backends.append(BitcoindBackend(settings.BITCOIND_RPC))
+
+    def publish(self):
+        STATUS.broadcast = [b.summary() for b in self.backends]
+
+    async def query(self, path):
+        # GET from an Esplora server: first one that answers. Returns text or None.
+        if self.backends is None:
+            self.setup()
+
+        loop = asyncio.get_running_loop()
+        err = None
+        for b in self.backends:
+            if not isinstance(b, EsploraBackend):
+                continue
+            try:
+                return await loop.run_in_executor(None, b.get, path)
+            except Exception as exc:
+                logging.warning(f"Query via {b.label} failed: {exc}")
+                err = exc
+
+        raise ServersUnreachable(str(err) or type(err).__name__)
+
+    async def broadcast(self, txn):
+        # Send to all backends at once, and return txid from first to accept it.
+        # - raise BroadcastRejected if refused, ServersUnreachable if nobody answered
+        if self.backends is None:
+            self.setup()
+
+        txn_hex = b2a_hex(txn).decode('ascii')
+
+        # losers keep going: more peers hear about it, and we learn their latency
+        def done(task):
+            if not task.cancelled():
+                task.exception()        # avoid warning, is reported below
+            self.publish()
+            STATUS.notify_watchers()
+
+        tasks = [asyncio.create_task(b.broadcast(txn_hex)) for b in self.backends]
+        for t in tasks:
+            t.add_done_callback(done)
+
+        errors = []
+        for fut in asyncio.as_completed(tasks):
             try:
-                prefix, rest = msg.split(': ', 1)
-                j = json_loads(rest)
-                if prefix == 'sendrawtransaction RPC error':
-                    msg = j.message
-                else:
-                    msg = prefix + ': ' + j.message
-            except:
-                pass
-
-        msg = f"Transaction broadcast FAILED: {msg}"
+                return await fut
+            except Exception as exc:
+                if any(i in str(exc) for i in ALREADY_KNOWN):
+                    # someone else (maybe another of our backends) sent it
+                    return None
+                errors.append(exc)
+
+        # report the most useful error: rejection reason, rather than a timeout
+        rej = [e for e in errors if isinstance(e, BroadcastRejected)]
+        if rej:
+            raise rej[0]
+
+        raise ServersUnreachable("unable to reach any server: %s" % (
+                                        str(errors[0]) or type(errors[0]).__name__))
+
+# singleton
+BROADCASTER = Broadcaster()
+
+async def broadcast_txn(txn):
+    # take bytes and get them shared over P2P to the world
+    # - returns text about what happened, for user
+    try:
+        txid = await BROADCASTER.broadcast(txn)
+    except BroadcastError as exc:
+        msg = f"Transaction broadcast FAILED: {exc}"
         logging.error(msg)
         return msg
 
-    # untested
-    msg = f"Transaction broadcast success: {msg}"
+    msg = f"Transaction broadcast success: {txid or 'already known'}"
     logging.info(msg)
 
     return msg
@@ -58,10 +257,56 @@ def link_to_txn(txn_hash):
     path = '/tx/' if not STATUS.is_testnet else '/testnet/tx/'
     assert len(txn_hash) == 64
     return settings.EXPLORA + path + txn_hash
-    
+
 
 if __name__ == '__main__':
-    # test code
-    r = broadcast_txn(b'sdhffkhjkdfshdfshjdfshdfkshdfs')
+    # Test against local fake Esplora servers: one slow, one broken, one good.
+    #   python chain.py
+    from aiohttp import web
+    from hashlib import sha256
+    from persist import Settings
+    Settings.startup()
+    import chain                # fresh copy, which sees settings we just made
+
+    def fake_esplora(delay, status=200):
+        async def post_tx(request):
+            body = await request.text()
+            await asyncio.sleep(delay)
+            if status != 200:
+                return web.Response(status=status, text='oops')
+            txid = sha256(sha256(a2b_hex(body)).digest()).digest()[::-1].hex()
+            return web.Response(text=txid)
+
+        app = web.Application()
+        app.router.add_post('/api/tx', post_tx)
+        return app
+
+    async def main():
+        fakes = [(0.5, 200), (0.05, 503), (0.1, 200)]
+        runners = []
+        for port, (delay, status) in enumerate(fakes, start=18231):
+            r = web.AppRunner(fake_esplora(delay, status))
+            await r.setup()
+            await web.TCPSite(r, '127.0.0.1', port).start()
+            runners.append(r)
+
+        chain.settings.EXPLORA = 'http://127.0.0.1:18231'
+        chain.settings.EXPLORA_MIRRORS = ['http://127.0.0.1:18232', 'http://127.0.0.1:18233']
+        chain.settings.BROADCAST_BACKOFF = 0.1
+
+        for i in range(5):
+            t = time.perf_counter()
+            msg = await chain.broadcast_txn(os.urandom(200))
+            print(f"{1000*(time.perf_counter()-t):6.1f}ms  {msg}")
+
+        await asyncio.sleep(1)      # let losers finish
+        for b in STATUS.broadcast:
+            print(b['label'], {k:v for k,v in b.items() if k in ('ok', 'failed', 'rejected')},
+                    'avg', b['latency']['avg'])
+
+        for r in runners:
+            await r.cleanup()
+
+    asyncio.run(main())
 
 # EOF
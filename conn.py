@@ -2,9 +2,12 @@
 #
 # Connection to Coldcard (and/or simulator).
 #
-import asyncio, logging, os
-from utils import Singleton, xfp2str, json_loads, json_dumps
+import asyncio, logging, os, time, struct, heapq, contextvars
+from contextlib import asynccontextmanager
+from utils import Singleton, xfp2str, json_loads, json_dumps, Histogram
 from status import STATUS
+from velocity import VELOCITY
+import events
 from persist import settings, BP
 from binascii import a2b_hex
 import policy
@@ -14,7 +17,8 @@ from hashlib import sha256
 from concurrent.futures import ThreadPoolExecutor
 
 from ckcc.protocol import CCProtocolPacker, CCFramingError
-from ckcc.protocol import CCProtoError, CCUserRefused
+from ckcc.protocol import CCProtoError, CCUserRefused, CCBusyError
+from ckcc.constants import STXN_VISUALIZE
 from ckcc.constants import USB_NCRY_V2
 from ckcc.client import ColdcardDevice
 from ckcc.constants import (USER_AUTH_TOTP, USER_AUTH_HMAC, USER_AUTH_SHOW_QR, MAX_USERNAME_LEN)
@@ -24,20 +28,144 @@ logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 executor = ThreadPoolExecutor(max_workers=5)
 
+# priority classes for USB commands; lower number goes first
+PRI_SIGN = 0            # signing and user auth steps
+PRI_UI = 1              # refresh for web pages
+PRI_PING = 2            # keep-alive
+PRI_NAMES = { PRI_SIGN: 'sign', PRI_UI: 'ui', PRI_PING: 'ping' }
+
+# commands which have the same answer if queued together (read only)
+COALESCE_CMDS = { CCProtocolPacker.hsm_status() }
+
+class CommandScheduler:
+    # Instead of a FIFO lock: the USB channel goes to the highest priority
+    # waiter next. Only one command at a time is sent to the Coldcard.
+
+    def __init__(self):
+        self.busy = False
+        self.waiting = []           # heap of (priority, seq, future)
+        self.seq = 0
+
+    @asynccontextmanager
+    async def slot(self, pri):
+        started = time.time()
+        await self.acquire(pri)
+        record_latency('usb_wait', PRI_NAMES[pri], time.time() - started)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, pri):
+        if not self.busy:
+            self.busy = True
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        heapq.heappush(self.waiting, (pri, self.seq, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # we were given the channel, but don't want it now
+                self.release()
+            raise
+
+    def release(self):
+        # give channel to next in line, skipping any who gave up waiting
+        while self.waiting:
+            _, _, fut = heapq.heappop(self.waiting)
+            if not fut.done():
+                fut.set_result(True)
+                return
+
+        self.busy = False
+
+# how long signing requests take, by type: kind => (phase => Histogram)
+# - phases are 'upload', 'approval' (until Coldcard is done) and 'download' (of result)
+LATENCY = dict()
+
+# timings for just the current task, if it wants them: 'kind.phase' => seconds
+PHASE_TIMES = contextvars.ContextVar('phase_times', default=None)
+
+_latency_changed = False
+
+def record_latency(kind, phase, dt):
+    # histogram is updated in place; STATUS copy only once per command (not for each
+    # USB round-trip, ie. usb_wait) or on next ping, see publish_latency
+    global _latency_changed
+
+    LATENCY.setdefault(kind, {}).setdefault(phase, Histogram()).add(dt)
+    _latency_changed = True
+    if kind != 'usb_wait':
+        publish_latency()
+
+    mine = PHASE_TIMES.get()
+    if mine is not None:
+        k = kind + '.' + phase
+        mine[k] = round(mine.get(k, 0) + dt, 3)
+
+def publish_latency():
+    # copy histograms into STATUS, if they have changed
+    global _latency_changed
+
+    if _latency_changed:
+        _latency_changed = False
+        STATUS.latency = dict((k, dict((p, h.as_dict()) for p,h in v.items()))
+                                        for k,v in LATENCY.items())
+
 # if you see this, it means the USB plug is fell out!
 class MissingColdcard(RuntimeError):
     pass
 
+# user (or shutdown) stopped a file upload/download part way
+class TransferCancelled(RuntimeError):
+    pass
+
 #logging.info("fd = %d" % open('/dev/null').fileno())
 
-class Connection(metaclass=Singleton):
+class Connection:
+    # One Coldcard. The "primary" one is reflected in STATUS and holds the
+    # storage locker for BP; others (if any) just help with signing.
 
-    def __init__(self, serial):
+    def __init__(self, serial, primary=True):
         self.serial = serial
+        self.primary = primary
         self.dev = None
         self.dev_key = None
-        self.lock = asyncio.Lock()
+        self.sched = CommandScheduler()
+        self._queued = {}           # msg => (task, priority), for commands we can coalesce
         self.sign_lock = asyncio.Lock()
+
+        # per-device state, see DevicePool.publish()
+        self.connected = False
+        self.xfp = None
+        self.hsm = ObjectStruct()
+        self.busy = 0               # signing jobs in progress
+        self.jobs_done = 0
+        self.busy_time = 0.0        # seconds spent on jobs
+        self.started = time.time()
+        self.last_ping = None
+        self.errors = 0
+
+        # cached HSM status: (generation, time) of last fetch, and fetch in progress
+        self._hsm_gen = 0
+        self._hsm_at = None
+        self._hsm_fetch = None
+        self.hsm_hits = 0
+        self.hsm_misses = 0
+        self.hsm_shared = 0             # joined a fetch already in progress
+
+        # (length, sha256) of the file we last uploaded, which Coldcard should still have
+        self._staged = None
+        self.uploads_saved = 0
+
+        # file transfer in progress, if any
+        self.xfer = None
+        self._xfer_cancel = False
+        self._xfer_shown = 0
+
         self._conn_broken(setup_time=True)
 
     async def run(self):
@@ -59,7 +187,7 @@ class Connection(metaclass=Singleton):
 
                 await asyncio.get_running_loop().run_in_executor(executor, d.check_mitm)
 
-                async with self.lock:
+                async with self.sched.slot(PRI_SIGN):
                     self.dev = d
             except:
                 logging.error("Cannot connect to Coldcard (will retry)", exc_info=0)
@@ -69,15 +197,24 @@ class Connection(metaclass=Singleton):
             # stay connected, and check we are working periodically
             logging.info(f"Connected to Coldcard {self.dev.serial}.")
 
-            STATUS.connected = True
+            self.connected = True
+            self.xfp = xfp2str(self.dev.master_fingerprint)
+            self.hsm = ObjectStruct()
 
-            # read static info about coldcard
-            STATUS.xfp = xfp2str(self.dev.master_fingerprint)
-            STATUS.serial_number = self.dev.serial
-            STATUS.is_testnet = (self.dev.master_xpub[0] == 't')
-            STATUS.hsm = {}
-            STATUS.reset_pending_auth()
+            if self.primary:
+                STATUS.connected = True
+
+                # read static info about coldcard
+                STATUS.xfp = self.xfp
+                STATUS.serial_number = self.dev.serial
+                STATUS.is_testnet = (self.dev.master_xpub[0] == 't')
+                STATUS.hsm = {}
+                STATUS.reset_pending_auth()
+
+            POOL.publish()
             STATUS.notify_watchers()
+            events.emit(events.DEVICE_CONNECTED, serial=self.dev.serial, xfp=self.xfp,
+                            primary=self.primary)
             await self.hsm_status()
 
             while 1:
@@ -85,30 +222,85 @@ class Connection(metaclass=Singleton):
                 try:
                     # use long timeout here, even tho simple command, because the CC may
                     # we working on something else right now (thinking).
-                    h = await self.send_recv(CCProtocolPacker.hsm_status(), timeout=20000)
+                    h = await self.send_recv(CCProtocolPacker.hsm_status(),
+                                                    pri=PRI_PING, timeout=20000)
                     logging.info("ping ok")
+                    self.last_ping = time.time()
+                    publish_latency()
                     await self.hsm_status(h)
                 except MissingColdcard:
                     self._conn_broken()
                     break
                 except:
+                    self.errors += 1
                     logging.error("Ping failed", exc_info=1)
 
+    def can_sign(self, psbt):
+        # Does this PSBT involve our master fingerprint? If so, we can probably sign it.
+        # - it will be in the values of the BIP-32 derivation records
+        if not self.xfp:
+            return False
+        return struct.pack('<I', self.dev.master_fingerprint) in psbt
+
+    @asynccontextmanager
+    async def working(self):
+        # track how busy we are, for load balancing and stats
+        self.busy += 1
+        started = time.time()
+        POOL.publish()
+        try:
+            yield self
+        finally:
+            self.busy -= 1
+            self.jobs_done += 1
+            self.busy_time += time.time() - started
+            POOL.publish()
+
+    def hsm_fetched(self):
+        # when we last read HSM status, or None
+        return self._hsm_at[1] if self._hsm_at else None
+
+    def summary(self):
+        # per-device health and utilisation, for STATUS
+        up = max(time.time() - self.started, 1)
+        return dict(serial=(self.dev.serial if self.dev else self.serial),
+                    primary=self.primary, connected=self.connected, xfp=self.xfp,
+                    hsm_active=bool(self.hsm.get('active')), busy=self.busy,
+                    jobs_done=self.jobs_done, utilisation=round(self.busy_time / up, 4),
+                    last_ping=self.last_ping, errors=self.errors, xfer=self.xfer,
+                    uploads_saved=self.uploads_saved,
+                    hsm_cache=dict(hits=self.hsm_hits, misses=self.hsm_misses,
+                                    shared=self.hsm_shared))
+
     def _conn_broken(self, setup_time=False):
         # our connection is lost, so clear/reset system state
+        if self.connected:
+            events.emit(events.DEVICE_DISCONNECTED, serial=self.dev.serial if self.dev else self.serial,
+                            xfp=self.xfp, primary=self.primary)
+
         if self.dev:
             self.dev.close()
             self.dev = None
 
-        STATUS.connected = False
-        STATUS.xfp = None
-        STATUS.serial_number = None
-        STATUS.is_testnet = False
-        STATUS.hsm = {}
-        STATUS.reset_pending_auth()
+        self.connected = False
+        self.xfp = None
+        self.hsm = ObjectStruct()
+        self._hsm_at = None
+        self._staged = None
+
+        if self.primary:
+            STATUS.connected = False
+            STATUS.xfp = None
+            STATUS.serial_number = None
+            STATUS.is_testnet = False
+            STATUS.hsm = {}
+            STATUS.reset_pending_auth()
+
+            if not setup_time:
+                BP.reset()
 
         if not setup_time:
-            BP.reset()
+            POOL.publish()
 
         STATUS.notify_watchers()
 
@@ -156,44 +348,144 @@ class Connection(metaclass=Singleton):
             BP['summary'] = h.summary
             BP.save()
 
+        # may have some txn to be sent/watched
+        from outbox import OUTBOX
+        OUTBOX.kick()
+
         STATUS.reset_pending_auth()
         STATUS.notify_watchers()
 
-    async def send_recv(self, msg, **kws):
+    async def send_recv(self, msg, pri=PRI_UI, **kws):
         # a more-async version of ColdcardDevice.send_recv?
+        # - waits its turn for the USB channel, according to priority class
 
-        if not self.dev or not STATUS.connected:
+        if not self.dev or not self.connected:
             raise MissingColdcard
-        
-        try:
-            def doit():
-                return self.dev.send_recv(msg, **kws)
 
-            # we do need this lock
-            async with self.lock:
-                return await asyncio.get_running_loop().run_in_executor(executor, doit)
-
-        except CCFramingError:
-            self._conn_broken()
-            raise MissingColdcard
-        except (CCProtoError, CCUserRefused):
-            raise
-        except BaseException as exc:
+        if msg in COALESCE_CMDS:
+            task, q_pri = self._queued.get(msg, (None, None))
+            if task and q_pri <= pri:
+                # same request is already waiting to go, and will go
+                # before us anyway; share the answer
+                return await asyncio.shield(task)
+
+            # runs as its own task, so if we give up, others sharing it still get the answer
+            task = asyncio.ensure_future(self._send_recv(msg, pri, True, **kws))
+            self._queued[msg] = (task, pri)
+            task.add_done_callback(lambda t: self._shared_done(msg, t))
+
+            return await asyncio.shield(task)
+
+        return await self._send_recv(msg, pri, False, **kws)
+
+    def _shared_done(self, msg, task):
+        if self._queued.get(msg, (None,))[0] is task:
+            del self._queued[msg]
+        if not task.cancelled():
+            task.exception()        # avoid "never retrieved" noise
+
+    def _failed(self, exc, msg):
+        # error from USB layer; returns exception for caller
+        if isinstance(exc, (CCProtoError, CCUserRefused, CCBusyError)):
+            return exc
+        if not isinstance(exc, CCFramingError):
             logging.error(f"Error from Coldcard: {exc} (for msg: {msg!r}")
-            self._conn_broken()
-            raise MissingColdcard
+        self._conn_broken()
+        return MissingColdcard()
+
+    async def _send_recv(self, msg, pri, shared, **kws):
+        def doit():
+            return self.dev.send_recv(msg, **kws)
+
+        async with self.sched.slot(pri):
+            if shared and self._queued.get(msg, (None,))[0] is asyncio.current_task():
+                # on the wire now, so later callers must wait for a fresh answer
+                del self._queued[msg]
+
+            work = asyncio.get_running_loop().run_in_executor(executor, doit)
+            try:
+                return await asyncio.shield(work)
+            except asyncio.CancelledError:
+                # caller gave up, but the Coldcard is still working on it: keep the USB
+                # channel until it's done, so the next command doesn't collide with it
+                while not work.done():
+                    try:
+                        await asyncio.wait([work])
+                    except asyncio.CancelledError:
+                        pass
+                if work.exception() is not None:
+                    self._failed(work.exception(), msg)
+                raise
+            except BaseException as exc:
+                raise self._failed(exc, msg)
+
+    @asynccontextmanager
+    async def changing_hsm(self):
+        # we're doing something that changes HSM status, so any cached copy
+        # is stale, as is anything fetched while we're working on it
+        self._hsm_gen += 1
+        try:
+            yield
+        finally:
+            self._hsm_gen += 1
 
-    async def hsm_status(self, h=None):
+    async def hsm_status(self, h=None, max_age=0):
         # refresh HSM status
-        b4 = STATUS.hsm.get('active', False)
+        # - can use cached value if it's fresh enough (max_age, in seconds) and
+        #   nothing has changed it since
+        # - concurrent callers share one request to the Coldcard
+        if h is not None:
+            # ping has already fetched it for us
+            return await self._refresh_hsm(h)
+
+        gen = self._hsm_gen
+        if max_age and self._hsm_at and self._hsm_at[0] == gen \
+                and (time.time() - self._hsm_at[1]) <= max_age:
+            self.hsm_hits += 1
+            return STATUS.hsm if self.primary else self.hsm
+
+        if not self._hsm_fetch or self._hsm_fetch[0] != gen or self._hsm_fetch[1].done():
+            self.hsm_misses += 1
+            self._hsm_fetch = (gen, asyncio.ensure_future(self._refresh_hsm()))
+        else:
+            self.hsm_shared += 1
+
+        return await asyncio.shield(self._hsm_fetch[1])
+
+    async def _refresh_hsm(self, h=None):
+        b4 = self.hsm.get('active', False)
+        b4_known = bool(self._hsm_at)         # else: first read since connect
+        b4_refusal = self.hsm.get('last_refusal')
 
         try:
-            b4_nlc = STATUS.hsm.get('next_local_code')
+            gen = self._hsm_gen
+            b4_nlc = self.hsm.get('next_local_code')
             h = h or (await self.send_recv(CCProtocolPacker.hsm_status()))
-            STATUS.hsm = h = json_loads(h)
-            STATUS.notify_watchers()
+            self.hsm = h = json_loads(h)
+            self._hsm_at = (gen, time.time())
         except MissingColdcard:
-            h = {}
+            h = ObjectStruct()
+
+        if self.connected:
+            if bool(self.hsm.get('active')) != bool(b4):
+                events.emit(events.HSM_ACTIVE if self.hsm.get('active') else events.HSM_INACTIVE,
+                                xfp=self.xfp, primary=self.primary)
+            refusal = self.hsm.get('last_refusal')
+            if b4_known and refusal and refusal != b4_refusal:
+                events.emit(events.HSM_REFUSAL, xfp=self.xfp, primary=self.primary,
+                                reason=refusal)
+
+        if not self.primary:
+            # only the primary Coldcard is shown in the UI
+            if self.hsm.get('active') != b4:
+                POOL.publish()
+                STATUS.notify_watchers()
+            return self.hsm
+
+        if self.connected:
+            STATUS.hsm = self.hsm
+            VELOCITY.sync(self.hsm, self.hsm_fetched())
+            STATUS.notify_watchers()
 
         if h.get('next_local_code') and STATUS.psbt_hash:
             if b4_nlc != h.next_local_code:
@@ -203,43 +495,48 @@ class Connection(metaclass=Singleton):
             STATUS.local_code = None
 
         # has it just transitioned into HSM mode?
-        if STATUS.connected and STATUS.hsm.active and not b4:
+        if self.connected and STATUS.hsm.get('active') and not b4:
+            POOL.publish()
             await self.activated_hsm()
 
         return STATUS.hsm
             
     async def hsm_start(self, new_policy=None):
-        args = []
-        if new_policy is not None:
-            # must upload it first
-            data = json_dumps(new_policy).encode('utf8')
-            args = self.dev.upload_file(data)
-
-            # save a trimmed copy of some details, if they want that
-            bk = policy.desensitize(new_policy)
-            BP['summary'] = None
-            if not bk.get('priv_over_ux'):
-                BP['priv_over_ux'] = False
-                BP['policy'] = bk       # full copy
-                BP['xfp'] = xfp2str(self.dev.master_fingerprint)
-                BP['serial'] = self.dev.serial
-            else:
-                BP['priv_over_ux'] = True
-                BP['policy'] = None
-                BP['xfp'] = None
-                BP['serial'] = None
+        # upload and start must go together: no signing can get in between
+        async with self.sign_lock:
+            args = []
+            if new_policy is not None:
+                # must upload it first
+                data = json_dumps(new_policy).encode('utf8')
+                args = await self.upload_file(data)
+
+                # save a trimmed copy of some details, if they want that
+                bk = policy.desensitize(new_policy)
+                BP['summary'] = None
+                if not bk.get('priv_over_ux'):
+                    BP['priv_over_ux'] = False
+                    BP['policy'] = bk       # full copy
+                    BP['xfp'] = xfp2str(self.dev.master_fingerprint)
+                    BP['serial'] = self.dev.serial
+                else:
+                    BP['priv_over_ux'] = True
+                    BP['policy'] = None
+                    BP['xfp'] = None
+                    BP['serial'] = None
 
-            BP.save()
+                BP.save()
 
-        try:
-            await self.send_recv(CCProtocolPacker.hsm_start(*args))
-        except CCProtoError as exc:
-            msg = str(exc)
-            logging.error("Coldcard didn't like policy: %s" % msg)
-            raise RuntimeError(str(msg))
+            try:
+                async with self.changing_hsm():
+                    await self.send_recv(CCProtocolPacker.hsm_start(*args))
+            except CCProtoError as exc:
+                msg = str(exc)
+                logging.error("Coldcard didn't like policy: %s" % msg)
+                raise RuntimeError(str(msg))
 
     async def delete_user(self, username):
-        await self.send_recv(CCProtocolPacker.delete_user(username))
+        async with self.changing_hsm():
+            await self.send_recv(CCProtocolPacker.delete_user(username))
 
     async def create_user(self, username, authmode, new_pw=None):
         # typically we'll let Coldcard pick password
@@ -248,7 +545,8 @@ class Connection(metaclass=Singleton):
         else:
             secret = b''
 
-        await self.send_recv(CCProtocolPacker.create_user(username, authmode, secret))
+        async with self.changing_hsm():
+            await self.send_recv(CCProtocolPacker.create_user(username, authmode, secret))
     
     async def user_auth(self, username, token, totp, psbt_hash):
         if len(token) == 6 and token.isdigit():
@@ -262,7 +560,9 @@ class Connection(metaclass=Singleton):
             token = HMAC(secret, msg=psbt_hash, digestmod=sha256).digest()
             totp_time = 0
 
-        await self.send_recv(CCProtocolPacker.user_auth(username.encode('ascii'), token, totp_time))
+        async with self.changing_hsm():
+            await self.send_recv(CCProtocolPacker.user_auth(username.encode('ascii'),
+                                    token, totp_time), pri=PRI_SIGN)
 
     async def get_storage_locker(self):
         return await self.send_recv(CCProtocolPacker.get_storage_locker())
@@ -270,25 +570,150 @@ class Connection(metaclass=Singleton):
     async def sign_psbt(self, data, finalize=False, flags=0x0):
         # upload it first
 
+        kind = 'visualize' if (flags & STXN_VISUALIZE) else 'psbt'
+
         async with self.sign_lock:
-            sz, chk = self.dev.upload_file(data)
-            assert chk == a2b_hex(STATUS.psbt_hash)
+            started = time.time()
+            sz, chk = await self.stage_file(data)
+            record_latency(kind, 'upload', time.time() - started)
+
+            # approvals, spending, refusals: all will change
+            async with self.changing_hsm():
+                await self.send_recv(CCProtocolPacker.sign_transaction(sz, chk, finalize, flags),
+                                        pri=PRI_SIGN)
+
+                # wait for it to finish
+                return await self.wait_and_download(CCProtocolPacker.get_signed_txn(), kind)
+
+    def _xfer_progress(self, pos, final=False):
+        # update progress of file transfer, but don't flood the websockets
+        x = self.xfer
+        now = time.time()
+        x.done = pos
+        x.rate = int(pos / max(now - x.started, 0.001))         # bytes/sec
+
+        if final or (now - self._xfer_shown) >= 0.5:
+            self._xfer_shown = now
+            POOL.publish()
+            STATUS.notify_watchers()
+
+    async def _transfer(self, kind, length, blk_fn):
+        # Move a file to/from Coldcard in blocks, each one done in executor, so
+        # we don't block the event loop. Can be cancelled between blocks.
+        blksize = settings.USB_BLOCK_SIZE
+        self._xfer_cancel = False
+        self._xfer_shown = 0
+        self.xfer = ObjectStruct(kind=kind, size=length, done=0, rate=0, started=time.time())
+        try:
+            pos = 0
+            while pos < length:
+                if self._xfer_cancel:
+                    raise TransferCancelled(f"File {kind} cancelled")
+
+                pos += await blk_fn(pos, min(blksize, length-pos))
+                self._xfer_progress(pos)
+
+            self._xfer_progress(pos, final=True)
+        finally:
+            self.xfer = None
+            POOL.publish()
+
+    def cancel_transfer(self):
+        # stop upload/download at next block boundary
+        if self.xfer:
+            logging.warning(f"Cancelling file {self.xfer.kind}")
+            self._xfer_cancel = True
+
+    async def stage_file(self, data):
+        # Upload file, unless the Coldcard already has it: a preview followed by
+        # signing uses the same file. Checked with Coldcard first.
+        chk = sha256(data).digest()
+
+        if self._staged == (len(data), chk):
+            rb = await self.send_recv(CCProtocolPacker.sha256(), pri=PRI_SIGN)
+            if rb == chk:
+                self.uploads_saved += 1
+                return len(data), chk
+
+            logging.warning("Coldcard doesn't have our file anymore; uploading again")
+
+        return await self.upload_file(data)
+
+    async def upload_file(self, data):
+        # like ColdcardDevice.upload_file(), but async and with progress
+        chk = sha256(data).digest()
+
+        # whatever was there before is being overwritten
+        self._staged = None
+
+        async def blk(pos, ln):
+            here = data[pos:pos+ln]
+            rv = await self.send_recv(CCProtocolPacker.upload(pos, len(data), here), pri=PRI_SIGN)
+            assert rv == pos
+            return ln
+
+        await self._transfer('upload', len(data), blk)
+
+        rb = await self.send_recv(CCProtocolPacker.sha256(), pri=PRI_SIGN)
+        if rb != chk:
+            raise RuntimeError('Checksum wrong during file upload')
+
+        self._staged = (len(data), chk)
+
+        return len(data), chk
 
-            await self.send_recv(CCProtocolPacker.sign_transaction(sz, chk, finalize, flags))
+    async def download_file(self, length, checksum, file_number=1):
+        # like ColdcardDevice.download_file(), but async and with progress
+        rv = bytearray()
+        chk = sha256()
 
-            # wait for it to finish
-            return await self.wait_and_download(CCProtocolPacker.get_signed_txn())
+        async def blk(pos, ln):
+            here = await self.send_recv(CCProtocolPacker.download(pos, ln, file_number),
+                                            pri=PRI_SIGN)
+            assert len(here) > 0
+            rv.extend(here)
+            chk.update(here)
+            return len(here)
 
-    async def wait_and_download(self, req, fn=1):
+        await self._transfer('download', length, blk)
+
+        if chk.digest() != checksum:
+            raise RuntimeError('Checksum wrong during file download')
+
+        return bytes(rv)
+
+    async def wait_for_done(self, req, kind):
         # Wait for user action (sic) on the device... by polling w/ indicated request
-        # - also download resulting file
+        # - poll quickly at first, since policy might approve right away
+        # - then back off, especially if a human is reading the screen (no HSM)
+        # - back to fast polling when Coldcard says it's busy working on it
+        started = time.time()
+        fastest = settings.POLL_MIN_DELAY
+        slowest = settings.POLL_MAX_DELAY if self.hsm.get('active') \
+                        else settings.POLL_MAX_HUMAN_DELAY
+        delay = fastest
 
         while 1:
-            await asyncio.sleep(0.250)
-            done = await self.send_recv(req, timeout=None)
-            if done == None:
+            await asyncio.sleep(delay)
+            try:
+                done = await self.send_recv(req, pri=PRI_SIGN, timeout=None)
+            except CCBusyError:
+                # progress: it's thinking, so should be done soon
+                delay = fastest
                 continue
-            break
+
+            if done is not None:
+                break
+
+            delay = min(delay * 1.5, slowest)
+
+        record_latency(kind, 'approval', time.time() - started)
+
+        return done
+
+    async def wait_and_download(self, req, kind, fn=1):
+        # Wait for result, and then download resulting file
+        done = await self.wait_for_done(req, kind)
 
         if len(done) != 2:
             logging.error('Coldcard failed: %r' % done)
@@ -297,7 +722,9 @@ class Connection(metaclass=Singleton):
         result_len, result_sha = done
 
         # download the result.
-        result = self.dev.download_file(result_len, result_sha, file_number=fn)
+        started = time.time()
+        result = await self.download_file(result_len, result_sha, file_number=fn)
+        record_latency(kind, 'download', time.time() - started)
 
         return result
 
@@ -308,14 +735,11 @@ class Connection(metaclass=Singleton):
 
         async with self.sign_lock:
             try:
-                await self.send_recv(CCProtocolPacker.sign_message(msg, subpath, addr_fmt))
+                async with self.changing_hsm():
+                    await self.send_recv(CCProtocolPacker.sign_message(msg, subpath, addr_fmt),
+                                            pri=PRI_SIGN)
 
-                while 1:
-                    await asyncio.sleep(0.250)
-                    done = await self.send_recv(CCProtocolPacker.get_signed_msg(), timeout=None)
-                    if done == None:
-                        continue
-                    break
+                    done = await self.wait_for_done(CCProtocolPacker.get_signed_msg(), 'msg')
 
             except CCUserRefused:
                 raise RuntimeError("Coldcard refused request based on policy.")
@@ -328,6 +752,96 @@ class Connection(metaclass=Singleton):
 
         return sig, addr
 
+class DevicePool(metaclass=Singleton):
+    # All the Coldcards we are connected to. First one is the primary.
+
+    def __init__(self):
+        self.devices = []
+
+    def add(self, serial):
+        rv = Connection(serial, primary=not self.devices)
+        self.devices.append(rv)
+        return rv
 
+    @property
+    def primary(self):
+        return self.devices[0]
+
+    def pick(self, psbt=None):
+        # Find the least-busy Coldcard that can do the work
+        # - when given PSBT, must be a Coldcard that is involved in it
+        # - falls back to primary, which will raise MissingColdcard if not connected
+        ready = [d for d in self.devices if d.connected]
+        if psbt is not None:
+            ready = [d for d in ready if d.can_sign(psbt)] or ready
+
+        # prefer devices in HSM mode, then least busy, then least used
+        ready.sort(key=lambda d: (not d.hsm.get('active'), d.busy, d.jobs_done))
+
+        return ready[0] if ready else self.primary
+
+    def publish(self):
+        STATUS.devices = [d.summary() for d in self.devices]
+
+    def startup(self, serial=None):
+        # Returns awaitable that runs all the connections
+        self.add(serial)
+        for sn in settings.POOL_DEVICES or []:
+            self.add(sn)
+
+        self.publish()
+
+        return asyncio.gather(*[d.run() for d in self.devices])
+
+# singleton
+POOL = DevicePool()
+
+if __name__ == '__main__':
+    # Benchmark: event loop latency during a 1MB file upload, against the simulator;
+    # and time to stage the same file again (as when signing after a preview).
+    #   python conn.py [size]
+    import sys
+    from persist import Settings
+    Settings.startup()
+    import conn                 # fresh copy, which sees settings we just made
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024*1024
+    data = os.urandom(size)
+
+    async def ticker(lags):
+        # how late is a 10ms timer? that's our latency
+        while 1:
+            t = time.perf_counter()
+            await asyncio.sleep(0.010)
+            lags.append(time.perf_counter() - t - 0.010)
+
+    async def measure(label, coro):
+        lags = []
+        tk = asyncio.create_task(ticker(lags))
+        t = time.perf_counter()
+        await coro
+        dt = time.perf_counter() - t
+        tk.cancel()
+        lags.sort()
+        print(f"{label:>10}: {size/dt/1024:8.1f} KiB/s  loop lag: "
+                f"median {1000*lags[len(lags)//2]:.1f}ms  max {1000*lags[-1]:.1f}ms  "
+                f"({len(lags)} ticks)")
+
+    async def main():
+        sock = conn.settings.SIMULATOR_SOCK
+        c = conn.POOL.add(sock)
+        c.dev = ColdcardDevice(sn=sock)
+        c.connected = True
+
+        async def blocking():
+            # the old way
+            c.dev.upload_file(data)
+
+        await measure('blocking', blocking())
+        await measure('async', c.upload_file(data))
+        await measure('staged', c.stage_file(data))
+        print(f"uploads saved: {c.uploads_saved}")
+
+    asyncio.run(main())
 
 # EOF
@@ -0,0 +1,152 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# dispatch.py -- run requests from one websocket connection, each in its own task.
+#
+# - a slow request (signing: waits for the Coldcard, maybe minutes) doesn't hold up
+#   others on the same connection, like pings, auth values, or cancel
+# - some actions are limited to N at a time (per connection); the rest are not
+# - tasks start in the order requests arrive, and waiters on a limit go in order
+# - when the connection closes, whatever is still running is cancelled
+#
+import asyncio, logging, time
+from utils import Histogram
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# action => how many can run at once, per connection; others are unlimited
+ACTION_LIMITS = {
+    'submit_psbt': 1,
+    'preview_psbt': 1,
+    'download_signed': 1,
+    'sign_message': 1,
+    'backtest_policy': 1,
+    'submit_policy': 1,
+    'start_hsm_btn': 1,
+    'create_user': 1,
+    'new_bunker_config': 1,
+}
+
+class TooBusy(RuntimeError):
+    pass
+
+class Dispatcher:
+    # One per websocket connection
+
+    def __init__(self, handler, limits=ACTION_LIMITS, max_pending=None):
+        self.handler = handler              # async fn(req), does the work
+        self.limits = limits
+        self.max_pending = max_pending
+        self.sems = {}                      # action => Semaphore
+        self.tasks = set()
+
+        # stats
+        self.count = 0
+        self.cancelled = 0
+        self.run_time = Histogram()
+
+    def submit(self, req):
+        # Start work on request; returns task. Raises TooBusy if too many running already.
+        if self.max_pending and len(self.tasks) >= self.max_pending:
+            raise TooBusy(f"Too many requests at once (max {self.max_pending})")
+
+        task = asyncio.create_task(self._run(req))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.count += 1
+
+        return task
+
+    async def _run(self, req):
+        started = time.time()
+        try:
+            limit = self.limits.get(req.get('action'))
+            if not limit:
+                return await self.handler(req)
+
+            sem = self.sems.get(req.action)
+            if not sem:
+                sem = self.sems[req.action] = asyncio.Semaphore(limit)
+
+            async with sem:
+                return await self.handler(req)
+        finally:
+            self.run_time.add(time.time() - started)
+
+    def busy(self):
+        # actions running (or waiting for their turn)
+        return len(self.tasks)
+
+    async def close(self):
+        # connection is gone: stop everything
+        for t in self.tasks:
+            if t.cancel():
+                self.cancelled += 1
+
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def summary(self):
+        return dict(count=self.count, running=len(self.tasks), cancelled=self.cancelled,
+                        run_time=self.run_time.as_dict())
+
+if __name__ == '__main__':
+    # Benchmark: ping latency while a long signing request is running, and with
+    # many cheap requests at once. Compare w/ inline dispatch (old way).
+    #   python dispatch.py [sign_seconds]
+    import sys
+    from objstruct import ObjectStruct
+
+    sign_time = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+
+    async def handler(req):
+        if req.action == 'submit_psbt':
+            await asyncio.sleep(sign_time)          # waiting on Coldcard / human
+        else:
+            await asyncio.sleep(0.001)              # cheap read
+
+    async def client(inline):
+        # requests arrive on a queue, like websocket messages
+        rx = asyncio.Queue()
+        d = Dispatcher(handler)
+        pings = []
+
+        async def rx_loop():
+            while 1:
+                req, sent = await rx.get()
+                if req is None:
+                    break
+                if req.get('_ping'):
+                    pings.append(time.perf_counter() - sent)
+                elif inline:
+                    await handler(req)
+                else:
+                    d.submit(req)
+
+        loop = asyncio.create_task(rx_loop())
+
+        now = time.perf_counter
+        rx.put_nowait((ObjectStruct(action='submit_psbt'), now()))
+        rx.put_nowait((ObjectStruct(action='submit_psbt'), now()))     # waits for first
+        for i in range(20):
+            await asyncio.sleep(sign_time / 20)
+            rx.put_nowait((ObjectStruct(action='auth_set_name'), now()))
+            rx.put_nowait((ObjectStruct(_ping=1), now()))
+
+        rx.put_nowait((None, now()))
+        if inline:
+            await loop
+        else:
+            await loop
+            running = d.busy()
+            await d.close()
+            print(f"  closed with {running} running; {d.summary()['cancelled']} cancelled")
+
+        pings.sort()
+        return pings[len(pings)//2], pings[-1]
+
+    for inline in [True, False]:
+        med, worst = asyncio.run(client(inline))
+        print(f"{'inline' if inline else 'concurrent'}: ping median {1000*med:.2f}ms, "
+                    f"worst {1000*worst:.2f}ms (sign takes {sign_time}s)")
+
+# EOF
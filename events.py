@@ -0,0 +1,83 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# events.py -- things that happened (Coldcard connected, PSBT signed, txn broadcast...)
+#
+# - kept in memory, newest last, up to EVENT_BUFFER_SIZE of them
+# - each has an id, always increasing: even across restarts, since they start from
+#   the time we started (in ms)
+# - programs get them from the REST API (see restapi.py), as a stream (SSE), or long-poll;
+#   they can resume from the last id they saw, and are told if they missed some
+#
+import logging, time
+from collections import deque
+from objstruct import ObjectStruct
+from utils import Singleton, ChangeCounter
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# event types
+DEVICE_CONNECTED = 'device_connected'
+DEVICE_DISCONNECTED = 'device_disconnected'
+HSM_ACTIVE = 'hsm_active'
+HSM_INACTIVE = 'hsm_inactive'
+HSM_REFUSAL = 'hsm_refusal'             # last_refusal has changed
+PSBT_STATE = 'psbt_state'               # see sigqueue.py for states
+BROADCAST = 'broadcast'                 # see outbox.py for states
+JOB_DONE = 'job_done'                   # REST API signing job has finished
+RESYNC = 'resync'                       # you missed some; not kept in buffer
+
+class EventLog(metaclass=Singleton):
+
+    def __init__(self):
+        self.events = deque()
+        self.changes = ChangeCounter()
+        self.changes.version = int(time.time() * 1000)
+        self.dropped = 0
+
+    @property
+    def last_id(self):
+        return self.changes.version
+
+    def emit(self, kind, **data):
+        # something happened
+        from persist import settings
+
+        ev = ObjectStruct(id=self.last_id + 1, type=kind, ts=time.time(), **data)
+        self.events.append(ev)
+
+        limit = settings.EVENT_BUFFER_SIZE if settings else 1000
+        while len(self.events) > limit:
+            self.events.popleft()
+            self.dropped += 1
+
+        self.changes.bump()
+        logging.debug(f"Event {ev.id}: {kind}")
+
+        return ev
+
+    def since(self, last_id, types=None):
+        # Events after that id, and True if some were missed (not in buffer anymore)
+        first = self.events[0].id if self.events else self.last_id + 1
+        missed = (last_id < first - 1) or (last_id > self.last_id)
+
+        rv = []
+        for ev in reversed(self.events):
+            if ev.id <= last_id:
+                break
+            if not types or ev.type in types:
+                rv.append(ev)
+        rv.reverse()
+
+        return rv, missed
+
+    async def wait(self, last_id, timeout):
+        # Block until there is something after that id, or timeout (raises asyncio.TimeoutError)
+        await self.changes.wait_newer(last_id, timeout)
+
+# singleton
+EVENTS = EventLog()
+
+def emit(kind, **data):
+    return EVENTS.emit(kind, **data)
+
+# EOF
@@ -0,0 +1,284 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# fanout.py -- sending to all the browsers (websockets) at once, without waiting on slow ones.
+#
+# - each connection has its own queue of messages, and a task to send them
+# - status updates aren't queued as text: a marker is, and the message is made when it's
+#   that client's turn (see StatusPublisher.message_since) so any number of changes
+#   become one patch; a slow client just gets fewer, bigger updates
+# - other messages (replies, redirects) can't be dropped: if too many are waiting, or
+#   one send takes too long (Tor...), that client is disconnected
+# - telling everyone about a change only adds markers; nothing waits for any client
+#
+import asyncio, logging, time
+from collections import deque
+from utils import Singleton, Histogram
+from status import PUBLISHER
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# markers in queue
+STATUS_UPDATE = object()
+CLOSE = object()
+
+class TooSlow(RuntimeError):
+    pass
+
+class Client:
+    # One websocket connection, and what's waiting to go out on it
+
+    def __init__(self, ws, queue_size, send_timeout):
+        self.ws = ws
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.queue = deque()                # (message or marker, time queued)
+        self.ready = asyncio.Event()
+        self.version = None                 # of STATUS, that they have (or will soon)
+        self.status_queued = False
+        self.closed = None                  # reason, once closed
+        self.task = None
+
+        # stats
+        self.connected = time.time()
+        self.sent = 0
+        self.bytes_sent = 0
+        self.merged = 0                     # status updates combined w/ one already queued
+        self.max_depth = 0
+        self.send_time = Histogram()
+
+    def _add(self, thing):
+        if self.closed:
+            return
+        if len(self.queue) >= self.queue_size:
+            self.close(f"queue full ({len(self.queue)})")
+            return
+
+        self.queue.append((thing, time.time()))
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self.ready.set()
+
+    def send(self, msg):
+        # queue a message (text); never blocks
+        self._add(msg)
+
+    def push_status(self):
+        # STATUS has changed; they need an update, unless one is already waiting
+        if self.status_queued:
+            self.merged += 1
+            return
+        self.status_queued = True
+        self._add(STATUS_UPDATE)
+
+    def close_after(self):
+        # close connection once everything queued so far is sent
+        self._add(CLOSE)
+
+    def close(self, reason):
+        # stop now, and drop what's queued
+        if self.closed:
+            return
+        self.closed = reason
+        self.queue.clear()
+        self.ready.set()
+
+        if reason != 'done':
+            logging.warning(f"Websocket client closed: {reason}")
+
+        # closing handshake could block on a slow client too
+        asyncio.create_task(self.ws.close())
+
+    async def run(self, keepalive):
+        # send everything in queue, in order; keep connection alive when idle
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self.ready.clear()
+                    try:
+                        await asyncio.wait_for(self.ready.wait(), keepalive)
+                    except asyncio.TimeoutError:
+                        self.send('{"keepalive":1}')
+                    continue
+
+                thing, queued = self.queue.popleft()
+
+                if thing is CLOSE:
+                    self.close('done')
+                    break
+
+                if thing is STATUS_UPDATE:
+                    self.status_queued = False
+                    self.version, msg = PUBLISHER.message_since(self.version)
+                else:
+                    msg = thing
+
+                t = time.perf_counter()
+                try:
+                    await asyncio.wait_for(self.ws.send_str(msg), self.send_timeout)
+                except asyncio.TimeoutError:
+                    raise TooSlow(f"send took over {self.send_timeout}s")
+
+                self.send_time.add(time.perf_counter() - t)
+                self.sent += 1
+                self.bytes_sent += len(msg)
+
+        except (TooSlow, ConnectionResetError, RuntimeError) as exc:
+            # RuntimeError: aiohttp says it's closing
+            self.close(str(exc) or type(exc).__name__)
+
+    @property
+    def lag(self):
+        # how long the oldest thing in queue has been waiting
+        return (time.time() - self.queue[0][1]) if self.queue else 0
+
+    def summary(self):
+        return dict(depth=len(self.queue), max_depth=self.max_depth, lag=round(self.lag, 3),
+                    sent=self.sent, kbytes_sent=round(self.bytes_sent / 1024, 1),
+                    merged=self.merged, age=int(time.time() - self.connected),
+                    send_ms_avg=round(1000 * self.send_time.total / self.send_time.count, 2)
+                                    if self.send_time.count else None,
+                    send_ms_max=round(1000 * self.send_time.max, 2))
+
+class FanOut(metaclass=Singleton):
+
+    def __init__(self):
+        self.clients = set()
+        self.task = None
+
+        # stats
+        self.fanouts = 0
+        self.fanout_time = 0.0
+        self.slow_closed = 0
+
+    def add(self, ws):
+        # new connection; returns Client, which is sending already
+        from persist import settings
+
+        PUBLISHER.ensure_running()
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+        c = Client(ws, settings.FANOUT_QUEUE_SIZE, settings.FANOUT_SEND_TIMEOUT)
+        self.clients.add(c)
+        c.task = asyncio.create_task(self.start(c, settings.FANOUT_KEEPALIVE))
+
+        return c
+
+    async def start(self, c, keepalive):
+        # no need for immediate update because when we rendered the HTML on page
+        # load, we put in current values.
+        await asyncio.sleep(0.250)
+        c.push_status()
+        await c.run(keepalive)
+
+    def remove(self, c):
+        if c not in self.clients:
+            return
+        self.clients.remove(c)
+        if c.closed and c.closed != 'done':
+            self.slow_closed += 1
+        if c.task:
+            c.task.cancel()
+
+    async def run(self):
+        # tell everyone when STATUS has changed
+        version = PUBLISHER.version
+        while 1:
+            version = await PUBLISHER.wait_newer(version)
+
+            t = time.perf_counter()
+            for c in list(self.clients):
+                if c.closed:
+                    self.remove(c)
+                elif c.version is None or c.version < version:
+                    c.push_status()
+            self.fanout_time += time.perf_counter() - t
+            self.fanouts += 1
+
+    def broadcast(self, msg, close=False):
+        # same message to everyone; maybe close their connection after
+        for c in list(self.clients):
+            c.send(msg)
+            if close:
+                c.close_after()
+
+    def summary(self, details=False):
+        rv = dict(clients=len(self.clients), fanouts=self.fanouts, slow_closed=self.slow_closed,
+                    fanout_ms_avg=round(1000 * self.fanout_time / self.fanouts, 3)
+                                        if self.fanouts else None,
+                    max_depth=max((len(c.queue) for c in self.clients), default=0),
+                    max_lag=round(max((c.lag for c in self.clients), default=0), 3))
+        if details:
+            rv['per_client'] = [c.summary() for c in self.clients]
+        return rv
+
+# singleton
+FANOUT = FanOut()
+
+if __name__ == '__main__':
+    # Load test: hundreds of websocket clients, some slow (Tor), a few stuck for good,
+    # while STATUS changes a lot. Fast ones should keep up; stuck ones get closed.
+    #   python fanout.py [clients] [seconds]
+    import sys, random
+    from persist import Settings
+    Settings.startup()
+    from persist import settings
+    from status import STATUS
+
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    settings.FANOUT_SEND_TIMEOUT = 2.0
+
+    class FakeWS:
+        def __init__(self, delay):
+            self.delay = delay          # seconds per send; None = never finishes
+            self.got = []
+            self.closed = False
+
+        async def send_str(self, msg):
+            if self.delay is None:
+                await asyncio.Event().wait()
+            await asyncio.sleep(self.delay * random.uniform(0.5, 1.5))
+            self.got.append((time.perf_counter(), msg))
+
+        async def close(self):
+            self.closed = True
+
+    async def main():
+        kinds = dict(fast=0.0005, slow=0.25, stuck=None)
+        mix = ['fast'] * 8 + ['slow'] + ([] if num < 20 else ['stuck'] * (num // 100 > 0))
+        wss = [(random.choice(mix), None) for i in range(num)]
+        wss = [(k, FakeWS(kinds[k])) for k, _ in wss]
+        clients = [(k, ws, FANOUT.add(ws)) for k, ws in wss]
+
+        # replies to a few, while status changes 200 times a second
+        changes = 0
+        t_end = time.perf_counter() + duration
+        while time.perf_counter() < t_end:
+            STATUS.busy_signing = (changes % 2 == 0)
+            STATUS.notify_watchers()
+            changes += 1
+            if changes % 50 == 0:
+                clients[changes % num][2].send('{"vue_app_cb":{"reply":1}}')
+            await asyncio.sleep(0.005)
+        last_change = time.perf_counter()
+
+        # give them a moment to catch up
+        await asyncio.sleep(1.0)
+
+        for kind in kinds:
+            mine = [(ws, c) for k, ws, c in clients if k == kind]
+            if not mine: continue
+            got = sum(len(ws.got) for ws, c in mine) / len(mine)
+            merged = sum(c.merged for ws, c in mine) / len(mine)
+            closed = sum(1 for ws, c in mine if c.closed)
+            # how far behind their final update was
+            behind = [max(0, ws.got[-1][0] - last_change) for ws, c in mine if ws.got]
+            print(f"{kind:>6}: {len(mine):4d} clients, {got:6.1f} msgs each, {merged:6.1f} merged, "
+                  f"{closed} closed, caught up {1000*max(behind, default=0):.0f}ms after last change")
+
+        print(f"{changes} status changes; {PUBLISHER.stats()}")
+        print({k: v for k, v in FANOUT.summary().items()})
+
+    asyncio.run(main())
+
+# EOF
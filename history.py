@@ -0,0 +1,225 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# history.py -- record of everything we've tried to sign, encrypted.
+#
+# - sqlite file, one row per signing attempt; all details are in an encrypted blob
+# - time and outcome are plaintext columns, so we can search and page quickly
+# - PSBT hash, txid and destinations are stored as keyed-HMAC values ("blind index"):
+#   we can find matches, but someone with the file can't learn them
+# - keys are derived from BP.key, which is kept in the Coldcard's storage locker
+#
+import os, asyncio, logging, sqlite3, hmac, time
+import nacl.secret
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
+from utils import Singleton, json_dumps, json_loads
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# outcomes
+SIGNED = 'signed'
+REFUSED = 'refused'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,
+    outcome TEXT NOT NULL,
+    psbt_tag BLOB,
+    txid_tag BLOB,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS by_time ON entries(ts);
+CREATE INDEX IF NOT EXISTS by_outcome ON entries(outcome, id);
+CREATE INDEX IF NOT EXISTS by_psbt ON entries(psbt_tag);
+CREATE INDEX IF NOT EXISTS by_txid ON entries(txid_tag);
+
+CREATE TABLE IF NOT EXISTS dests (
+    entry_id INTEGER NOT NULL,
+    tag BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS by_dest ON dests(tag, entry_id);
+'''
+
+def subkey(key, purpose):
+    return hmac.new(key, b'history-' + purpose, sha256).digest()
+
+class SigningHistory(metaclass=Singleton):
+
+    def __init__(self):
+        # sqlite connection is only used from this one thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._key = None
+        self.db = None
+
+    def _open(self, key):
+        # (in thread) open the database for this key, if not already
+        from persist import settings
+
+        if key and key == self._key:
+            return
+
+        if self.db:
+            self.db.close()
+            self.db = None
+            self._key = None
+
+        if not key:
+            raise RuntimeError("Signing history isn't available until storage locker is read")
+
+        self.box = nacl.secret.SecretBox(subkey(key, b'data'))
+        self._idx_key = subkey(key, b'index')
+
+        fn = 'hist-%s.db' % sha256(subkey(key, b'file')).hexdigest()[-16:]
+        self.db = sqlite3.connect(os.path.join(settings.DATA_FILES, fn))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self._key = key
+
+    def tag(self, value):
+        # blind index value: same input gives same tag, but can't be reversed
+        return hmac.new(self._idx_key, value.lower().encode('utf8'), sha256).digest()[0:16]
+
+    async def _call(self, fn, *args):
+        # run in our thread, with database open using key from BP (once it's loaded;
+        # before that, BP.key is just a random placeholder)
+        from persist import BP
+
+        key = BP.key if BP.loaded else None
+
+        def doit():
+            self._open(key)
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, doit)
+
+    def _insert(self, entry):
+        body = self.box.encrypt(json_dumps(entry).encode('utf8'))
+
+        with self.db:
+            cur = self.db.execute(
+                'INSERT INTO entries (ts, outcome, psbt_tag, txid_tag, body) VALUES (?,?,?,?,?)',
+                (int(entry['ts']), entry['outcome'], self.tag(entry['psbt_hash']),
+                    self.tag(entry['txid']) if entry.get('txid') else None, body))
+
+            rowid = cur.lastrowid
+            self.db.executemany('INSERT INTO dests (entry_id, tag) VALUES (?,?)',
+                        [(rowid, self.tag(d)) for d in set(entry.get('destinations', []))])
+
+        return rowid
+
+    async def record(self, entry):
+        # Add an entry; must have: ts, outcome, psbt_hash and optionally: txid, destinations
+        try:
+            return await self._call(self._insert, entry)
+        except Exception:
+            # never stop signing because of this
+            logging.error("Unable to record signing history", exc_info=1)
+
+    def _query(self, before, outcome, dest, psbt_hash, txid, hash, since, until, limit):
+        where = []
+        args = []
+
+        if before:
+            where.append('e.id < ?'); args.append(before)
+        if outcome:
+            where.append('e.outcome = ?'); args.append(outcome)
+        if psbt_hash:
+            where.append('e.psbt_tag = ?'); args.append(self.tag(psbt_hash))
+        if txid:
+            where.append('e.txid_tag = ?'); args.append(self.tag(txid))
+        if hash:
+            # either one
+            where.append('(e.txid_tag = ? OR e.psbt_tag = ?)'); args.extend([self.tag(hash)]*2)
+        if since:
+            where.append('e.ts >= ?'); args.append(int(since))
+        if until:
+            where.append('e.ts < ?'); args.append(int(until))
+
+        sql = 'SELECT e.id, e.body FROM entries e'
+        if dest:
+            sql += ' JOIN dests d ON d.entry_id = e.id'
+            where.append('d.tag = ?'); args.append(self.tag(dest))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY e.id DESC LIMIT ?'
+        args.append(limit)
+
+        rows = self.db.execute(sql, args).fetchall()
+
+        # only decrypt the ones we are returning
+        entries = []
+        for rowid, body in rows:
+            e = json_loads(self.box.decrypt(body))
+            e['id'] = rowid
+            entries.append(e)
+
+        total, = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()
+
+        return dict(entries=entries, total=total,
+                        more=(rows[-1][0] if len(rows) == limit else None))
+
+    async def query(self, before=None, outcome=None, dest=None, psbt_hash=None, txid=None,
+                                hash=None, since=None, until=None, limit=50):
+        # Newest first, a page at a time: pass "more" value from result as "before"
+        # to get the next page.
+        limit = max(1, min(int(limit), 500))
+        return await self._call(self._query, before, outcome, dest, psbt_hash, txid, hash,
+                                    since, until, limit)
+
+    def _export(self, outcome, since):
+        rows = self.db.execute('SELECT body FROM entries WHERE outcome = ? AND ts >= ? '
+                                    'ORDER BY id', (outcome, int(since or 0))).fetchall()
+        return [json_loads(self.box.decrypt(body)) for body, in rows]
+
+    async def export(self, outcome=SIGNED, since=None):
+        # All entries (oldest first) with that outcome, decrypted; for backtest.py
+        return await self._call(self._export, outcome, since)
+
+# singleton
+HISTORY = SigningHistory()
+
+if __name__ == '__main__':
+    # Benchmark: paging thru lots of history
+    #   python history.py [count]
+    import sys, tempfile, random
+    from persist import Settings
+    Settings.startup()
+    from persist import settings, BP
+    settings.DATA_FILES = tempfile.mkdtemp()
+    BP.open(os.urandom(32))
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    async def main():
+        dests = ['bc1q%038x' % i for i in range(200)]
+
+        def fake(i):
+            return dict(ts=time.time() - (count-i)*60, outcome=random.choice([SIGNED]*8 + [REFUSED]),
+                        psbt_hash=sha256(b'%d' % i).hexdigest(), txid=sha256(b't%d' % i).hexdigest(),
+                        users=['alice'], destinations=random.sample(dests, 2),
+                        timings={'psbt.approval': 0.5})
+
+        t = time.perf_counter()
+        await HISTORY._call(lambda: [HISTORY._insert(fake(i)) for i in range(count)])
+        print(f"insert: {count} entries in {time.perf_counter()-t:.1f}s")
+
+        async def timed(label, **kws):
+            t = time.perf_counter()
+            r = await HISTORY.query(**kws)
+            print(f"{label:>30}: {1000*(time.perf_counter()-t):6.2f}ms  "
+                    f"({len(r['entries'])} of {r['total']})")
+            return r
+
+        r = await timed('first page')
+        r = await timed('next page', before=r['more'])
+        await timed('refused', outcome=REFUSED)
+        await timed('by destination', dest=dests[7])
+        await timed('by txid', txid=sha256(b't123').hexdigest())
+        await timed('by txid or PSBT hash', hash=sha256(b'123').hexdigest())
+        await timed('last day', since=time.time()-86400, limit=500)
+
+    asyncio.run(main())
+
+# EOF
@@ -75,6 +75,30 @@ def setup_hsm(local=False, config_file=None):
 
     asyncio.run(startup(True, local, config_file, None), debug=True)
 
+@main.command('backtest')
+@click.argument('policy_file', type=click.File('rt'))
+@click.argument('txn_file', type=click.File('rt'))
+@click.option('--details', '-d', type=click.File('wt'), default=None,
+                    help="Write outcome of each transaction to this file (CSV)")
+def backtest_policy(policy_file, txn_file, details=None):
+    '''Replay transactions against an HSM policy file, and show what it would do.
+
+    Transactions are CSV (with header) or JSON with: time, amount (BTC)
+    and destination (several can be given, separated by spaces).'''
+    import json, csv
+    import backtest
+
+    pol = json.load(policy_file)
+    r = backtest.backtest(pol, backtest.load_file(txn_file), details=bool(details))
+
+    click.echo(backtest.report_text(r))
+
+    if details:
+        w = csv.writer(details)
+        w.writerow(['time', 'amount', 'rule'])
+        for t in r['txns']:
+            w.writerow([t['ts'], '%.8f' % (t['amount'] / 1E8), t['rule'] or 'refused'])
+
 async def startup(setup_mode, force_local_mode, config_file, first_psbt):
     # All startup/operation code
 
@@ -103,8 +127,17 @@ async def startup(setup_mode, force_local_mode, config_file, first_psbt):
     from torsion import TOR
     aws.append(TOR.startup())
 
-    from conn import Connection
-    aws.append(Connection(force_serial).run())
+    from conn import POOL
+    aws.append(POOL.startup(force_serial))
+
+    from sigqueue import SIGQ
+    aws.append(SIGQ.run())
+
+    from outbox import OUTBOX
+    aws.append(OUTBOX.run())
+
+    from make_captcha import CAPTCHAS
+    aws.append(CAPTCHAS.run())
 
     import webapp
     aws.append(webapp.startup(setup_mode))
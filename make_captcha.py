@@ -3,12 +3,26 @@
 # Draw a Captchas ... not meant to be hard, but easier to replace out, and challenging
 # to read image itself..
 #
-import random, os, io
-from PIL import Image, ImageDraw, ImageFont
+import random, os, io, asyncio, logging, time
+from collections import deque
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont, ImageColor
+from utils import Singleton, worker_processes
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 # Avoid similar-looking letters/numbers.
 TOKEN_CHARS = 'abcdefghkmnpqrstuvwxyz23456789'
 
+FONT_FILES = { 'ransom': 'static/fonts/ransom-note.ttf', 
+                 'nova': 'static/fonts/proximanova-semibold.ttf'
+             }
+
+@lru_cache(maxsize=None)
+def load_font(which, size):
+    # parsing the TTF file is slow; do it once per process
+    return ImageFont.truetype(FONT_FILES[which], size)
+
 class CaptchaMaker:
     size = (256, 64)                # limited by iphone case. esp. when entering value
 
@@ -22,16 +36,13 @@ class CaptchaMaker:
         raise NotImplementedError
 
     def get_font(self, size=40, which='nova'):
-        fn = { 'ransom': 'static/fonts/ransom-note.ttf', 
-                 'nova': 'static/fonts/proximanova-semibold.ttf'
-             }
-        return ImageFont.truetype(fn[which], size)
+        return load_font(which, size)
 
 class RansomCaptcha(CaptchaMaker):
     #
     # Just the simple ransom note that most people expect today.
     #
-    def draw(self, token, foreground='#000', seed=None):
+    def draw(self, token, foreground='#000', seed=None, compact=True):
         fn = self.get_font(size=40, which='ransom')
         w,h = self.size
         _,_,dx,dy = fn.getbbox('W')
@@ -51,14 +62,26 @@ class RansomCaptcha(CaptchaMaker):
             x += ix
 
         data = io.BytesIO()
-        im.save(data, format='png')
+
+        if compact:
+            # only one colour, so just need the alpha channel: 16 levels of that
+            # is plenty, as a palette image w/ transparency per entry
+            levels = 16
+            alpha = im.getchannel('A').point(lambda v: (v*(levels-1) + 127) // 255)
+            im = Image.frombytes('P', self.size, alpha.tobytes())
+            im.putpalette(ImageColor.getrgb(foreground)[0:3] * levels)
+            trns = bytes(round(i*255 / (levels-1)) for i in range(levels))
+
+            im.save(data, format='png', optimize=True, transparency=trns, bits=4)
+        else:
+            im.save(data, format='png')
 
         return 'png', data.getvalue()
 
 class MegaGifCaptcha(CaptchaMaker):
     # These are fun, but too large to be practical? Keep in toolbox for later.
 
-    def draw(self, token, foreground='#fff', background='white'):
+    def draw(self, token, foreground='#fff', background='white', compact=True):
 
         token = ' '.join(token.upper())
 
@@ -75,25 +98,41 @@ class MegaGifCaptcha(CaptchaMaker):
 
         ans_y = self.rng.randint(3, h-dy-3)
         ans_w = fn.getbbox(token)[2]
-        count = 15
+
+        if compact:
+            # - fewer frames (token only moves a few pixels each) shown for longer
+            # - noise redrawn every other frame: between those only the token
+            #   changes, and the GIF encoder just stores that area
+            # - same two-colour palette on all frames
+            count, noise_every = 8, 2
+            palette = ImageColor.getrgb(background)[0:3] + ImageColor.getrgb(foreground)[0:3]
+            background, foreground = 0, 1
+        else:
+            count, noise_every = 15, 1
 
         for fr_num in range(count):
-            im = Image.new('P', self.size, background)
-            dr = ImageDraw.Draw(im)
+            if fr_num % noise_every == 0:
+                noise = Image.new('P', self.size, background)
+                if compact:
+                    noise.putpalette(palette)
+                dr = ImageDraw.Draw(noise)
+
+                # give them noise chars, except they are mostly correct so that
+                # the order is not so clear at all. don't want to just be able to 
+                # pick the most common chars observed
+                charset = set(token)
+                while len(charset) < len(token) + 4:
+                    charset.add(sample(TOKEN_CHARS, 1)[0])
 
-            # give them noise chars, except they are mostly correct so that
-            # the order is not so clear at all. don't want to just be able to 
-            # pick the most common chars observed
-            charset = set(token)
-            while len(charset) < len(token) + 4:
-                charset.add(sample(TOKEN_CHARS, 1)[0])
+                for k in range(int(w * 1.5/dx)):
+                    #ch = ''.join(self.rng.sample(TOKEN_CHARS, 1)).upper()
+                    ch = ''.join(sample(list(charset), 1)).upper()
+                    x = randint(-dx, w)
+                    y = ans_y + randint(int(-dy*3/4), int(dy*3/4))
+                    dr.text( (x,y), ch, fill=foreground, font=fn)
 
-            for k in range(int(w * 1.5/dx)):
-                #ch = ''.join(self.rng.sample(TOKEN_CHARS, 1)).upper()
-                ch = ''.join(sample(list(charset), 1)).upper()
-                x = randint(-dx, w)
-                y = ans_y + randint(int(-dy*3/4), int(dy*3/4))
-                dr.text( (x,y), ch, fill=foreground, font=fn)
+            im = noise.copy() if noise_every > 1 else noise
+            dr = ImageDraw.Draw(im)
 
             frames.append(im)
 
@@ -102,9 +141,184 @@ class MegaGifCaptcha(CaptchaMaker):
 
         data = io.BytesIO()
 
-        frames[0].save(data, format='gif', save_all=True, loop=0,
+        if compact:
+            # same speed as before: 14 frames, twice as long each
+            frames[0].save(data, format='gif', save_all=True, loop=0, optimize=True,
+                            disposal=1, duration=200,
+                            append_images=frames[1:] + list(reversed(frames[1:-1])))
+        else:
+            frames[0].save(data, format='gif', save_all=True, loop=0,
                             append_images=frames + list(reversed(frames[1:-1])))
 
         return 'gif', data.getvalue()
 
+def new_token():
+    return ''.join(random.sample(TOKEN_CHARS, 8))
+
+def render(code, easy):
+    # draw captcha image for code: returns (extension, raw_data)
+    # - runs in worker process, so must be top-level function
+    if easy:
+        return RansomCaptcha(seed=code).draw(code, foreground='#444')
+    else:
+        return MegaGifCaptcha(seed=code).draw(code, foreground='#444')
+
+class CaptchaPool(metaclass=Singleton):
+    # Captchas are slow to draw, so do that in other processes, and keep a
+    # few ready-to-go so the login page doesn't wait (or stall the event loop).
+
+    def __init__(self):
+        self.ready = deque()            # of (easy, code, itype, data)
+        self._want_more = asyncio.Event()
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.rendered = 0
+        self.render_time = 0.0
+
+    async def render(self, code, easy):
+        # draw a specific captcha, in a worker process
+        t = time.perf_counter()
+        rv = await asyncio.get_running_loop().run_in_executor(worker_processes(),
+                                                                render, code, easy)
+        self.rendered += 1
+        self.render_time += time.perf_counter() - t
+
+        return rv
+
+    async def take(self, easy):
+        # get a new captcha: returns (code, extension, raw_data)
+        self._want_more.set()
+
+        while self.ready:
+            was_easy, code, itype, data = self.ready.popleft()
+            if was_easy == easy:
+                self.hits += 1
+                return code, itype, data
+
+            # setting changed since it was drawn; discard
+
+        # pool is empty (login flood?) so make one now
+        self.misses += 1
+        code = new_token()
+        itype, data = await self.render(code, easy)
+
+        return code, itype, data
+
+    def stats(self):
+        return dict(ready=len(self.ready), hits=self.hits, misses=self.misses,
+                    rendered=self.rendered,
+                    avg_render_ms=round(1000*self.render_time/self.rendered, 1)
+                                                if self.rendered else None)
+
+    async def run(self):
+        # Keep the pool topped-up, in the background.
+        from persist import BP, settings
+
+        while 1:
+            missing = settings.CAPTCHA_POOL_SIZE - len(self.ready)
+            if missing <= 0:
+                self._want_more.clear()
+                await self._want_more.wait()
+                continue
+
+            easy = BP.get('easy_captcha', settings.EASY_CAPTCHA)
+            codes = [new_token() for i in range(min(missing, settings.WORKER_PROCESSES))]
+
+            try:
+                drawn = await asyncio.gather(*[self.render(c, easy) for c in codes])
+            except Exception:
+                logging.error("Captcha rendering failed", exc_info=1)
+                await asyncio.sleep(10)
+                continue
+
+            for code, (itype, data) in zip(codes, drawn):
+                self.ready.append((easy, code, itype, data))
+
+# singleton
+CAPTCHAS = CaptchaPool()
+
+def compare_sizes(count=20):
+    # Benchmark: bytes and draw time of original vs. compact encoding, same seeds.
+    for cls in [RansomCaptcha, MegaGifCaptcha]:
+        for compact in [False, True]:
+            sizes = []
+            t = time.perf_counter()
+            for i in range(count):
+                code = random.Random(i).sample(TOKEN_CHARS, 8)
+                code = ''.join(code)
+                itype, data = cls(seed=code).draw(code, foreground='#444', compact=compact)
+                sizes.append(len(data))
+            dt = time.perf_counter() - t
+
+            print(f"{cls.__name__:>15} {'compact' if compact else 'original':>8}: "
+                    f"avg {sum(sizes)/count/1024:5.1f} KiB  max {max(sizes)/1024:5.1f} KiB  "
+                    f"{1000*dt/count:5.1f} ms each")
+
+if __name__ == '__main__':
+    # Benchmarks:
+    #   python make_captcha.py sizes
+    #       - image sizes of original vs. compact encoding
+    #   python make_captcha.py [num_requests] [easy]
+    #       - captchas per second, and event loop stall, during a login flood
+    import sys
+
+    if sys.argv[1:2] == ['sizes']:
+        compare_sizes()
+        sys.exit(0)
+
+    from persist import Settings
+    Settings.startup()
+    from persist import settings, BP
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    easy = len(sys.argv) > 2 and sys.argv[2] == 'easy'
+    BP['easy_captcha'] = easy
+
+    async def ticker(lags):
+        # how late is a 10ms timer? that's our stall time
+        while 1:
+            t = time.perf_counter()
+            await asyncio.sleep(0.010)
+            lags.append(time.perf_counter() - t - 0.010)
+
+    async def flood(label, handler):
+        lags = []
+        tk = asyncio.create_task(ticker(lags))
+        await asyncio.sleep(0.05)
+
+        t = time.perf_counter()
+        await asyncio.gather(*[handler() for i in range(count)])
+        dt = time.perf_counter() - t
+
+        await asyncio.sleep(0.05)       # so ticker can report last stall
+        tk.cancel()
+        lags.sort()
+        print(f"{label:>8}: {count/dt:6.1f} captchas/sec  loop stall: "
+                f"median {1000*lags[len(lags)//2]:.1f}ms  max {1000*lags[-1]:.1f}ms")
+
+    async def main():
+        async def inline():
+            # the old way: draw on the event loop
+            await asyncio.sleep(0)
+            code = new_token()
+            return render(code, easy)
+
+        async def pooled():
+            return await CAPTCHAS.take(easy)
+
+        await flood('inline', inline)
+
+        # let pool fill before the flood arrives, like a running server
+        bg = asyncio.create_task(CAPTCHAS.run())
+        while len(CAPTCHAS.ready) < settings.CAPTCHA_POOL_SIZE:
+            await asyncio.sleep(0.1)
+
+        await flood('pooled', pooled)
+        print(CAPTCHAS.stats())
+        bg.cancel()
+
+    asyncio.run(main())
+
 # EOF
@@ -0,0 +1,252 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# outbox.py -- signed transactions we have broadcast (or are trying to), until confirmed.
+#
+# - kept in BP, so encrypted, and survives a restart; until BP is loaded (storage locker
+#   read), they are only in memory, and are moved into BP when it is
+# - broadcast is retried with backoff when servers can't be reached, or if a txn
+#   falls out of the mempool
+# - confirmations are tracked using Esplora: we only ask about each txn when
+#   a new block is seen, and limit the rate of requests over Tor
+#
+import asyncio, logging, time
+from binascii import b2a_hex, a2b_hex
+from objstruct import ObjectStruct
+from persist import settings, BP
+from status import STATUS
+from utils import Singleton, json_loads
+from txn import parse_txn
+from chain import BROADCASTER, BroadcastRejected, ServersUnreachable
+import events
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# lifecycle of each txn
+PENDING = 'pending'             # not yet accepted by any server
+MEMPOOL = 'mempool'             # accepted, not yet mined
+CONFIRMED = 'confirmed'         # mined, but fewer than OUTBOX_CONFIRMATIONS
+DONE = 'done'                   # deep enough; will be forgotten after a while
+REJECTED = 'rejected'           # refused by bitcoin nodes; won't retry
+
+class Outbox(metaclass=Singleton):
+
+    def __init__(self):
+        self._kick = asyncio.Event()
+        self.tip_height = None
+        self.last_poll = 0
+        self.queries = 0        # stats: number of status requests made
+        self._unsaved = []      # entries from before BP is loaded
+        self._sending = {}      # txid => task, while broadcast is underway
+
+    @property
+    def entries(self):
+        # list of ObjectStruct, in BP; so they are saved w/ rest of that. Before BP
+        # is loaded, its key is a placeholder, and a file saved w/ it can't be read again.
+        if not BP.loaded:
+            return self._unsaved
+        return BP.setdefault('outbox', [])
+
+    def get(self, txid):
+        for e in self.entries:
+            if e.txid == txid:
+                return e
+
+    def add(self, txn):
+        # remember a new signed txn; returns the entry for it
+        t = parse_txn(txn)
+
+        e = self.get(t.txid)
+        if not e:
+            e = ObjectStruct(txid=t.txid, hex=b2a_hex(txn).decode('ascii'), vsize=t.vsize,
+                        state=PENDING, added=int(time.time()), tries=0, next_try=0,
+                        last_error=None, height=None, confirmations=0, checked=0)
+            self.entries.append(e)
+
+        return e
+
+    async def send(self, txn):
+        # Add and broadcast now; return text for user. Will keep retrying if needed.
+        e = self.add(txn)
+        await self.try_send(e)
+        self.changed()
+
+        if e.state == MEMPOOL:
+            return f"Transaction broadcast success: {e.txid}"
+        elif e.state == PENDING:
+            return f"Transaction broadcast FAILED: {e.last_error} (will retry)"
+        elif e.state == REJECTED:
+            return f"Transaction broadcast FAILED: {e.last_error}"
+        else:
+            return f"Transaction already {e.state}: {e.txid}"
+
+    async def try_send(self, e):
+        # one broadcast at a time per txn: if already underway, wait for that one
+        task = self._sending.get(e.txid)
+        if not task:
+            if e.state != PENDING:
+                return
+            task = self._sending[e.txid] = asyncio.ensure_future(self._send_once(e))
+            task.add_done_callback(lambda t: self._sending.pop(e.txid, None))
+
+        await asyncio.shield(task)
+
+    async def _send_once(self, e):
+        e.tries += 1
+        try:
+            await BROADCASTER.broadcast(a2b_hex(e.hex))
+            e.state = MEMPOOL
+            e.last_error = None
+            logging.info(f"Broadcast {e.txid} ok (try {e.tries})")
+            self.event(e)
+        except BroadcastRejected as exc:
+            e.state = REJECTED
+            e.last_error = str(exc)
+            logging.error(f"Broadcast {e.txid} rejected: {exc}")
+            self.event(e)
+        except ServersUnreachable as exc:
+            delay = min(settings.OUTBOX_MAX_BACKOFF, settings.OUTBOX_BACKOFF * (2 ** (e.tries-1)))
+            e.next_try = int(time.time() + delay)
+            e.last_error = str(exc)
+            logging.warning(f"Broadcast {e.txid} failed, will retry in {delay}s: {exc}")
+            self.event(e)
+
+    def event(self, e):
+        # tell anyone listening (see events.py)
+        events.emit(events.BROADCAST, txid=e.txid, state=e.state, error=e.last_error,
+                        tries=e.tries, height=e.height, confirmations=e.confirmations)
+
+    def changed(self):
+        # save to disk, and update UI
+        if BP.loaded:
+            BP.save('outbox')
+        self.publish()
+        STATUS.notify_watchers()
+
+    def publish(self):
+        STATUS.outbox = [dict((k, v) for k, v in e.items() if k != 'hex') for e in self.entries]
+
+    async def poll(self):
+        # Check status of txn in mempool. Confirmation status can only change when
+        # there is a new block, so we check tip first (one request), and only then
+        # look at each txn; at most OUTBOX_POLL_BATCH of them, and spaced out.
+        waiting = [e for e in self.entries if e.state in (MEMPOOL, CONFIRMED)]
+        if not waiting:
+            return False
+
+        tip = await BROADCASTER.query('blocks/tip/height')
+        self.queries += 1
+        if tip is None:
+            # server doesn't know? try again next time
+            logging.warning("Unable to get block height")
+            return False
+        tip = int(tip)
+        now = time.time()
+        changed = False
+
+        # old enough to be worth a recheck, even w/o a new block (dropped from mempool?)
+        stale = now - settings.OUTBOX_RECHECK_TIME
+        todo = [e for e in waiting if e.state == MEMPOOL
+                            and (tip != self.tip_height or e.checked < stale)]
+        todo.sort(key=lambda e: e.checked)
+
+        for e in todo[0:settings.OUTBOX_POLL_BATCH]:
+            await asyncio.sleep(60 / settings.OUTBOX_POLL_RATE)
+
+            resp = await BROADCASTER.query(f'tx/{e.txid}/status')
+            self.queries += 1
+            e.checked = int(time.time())
+
+            if resp is None:
+                # not known to server: fell out of mempool? send it again
+                logging.warning(f"Txn {e.txid} not found; will broadcast again")
+                e.state = PENDING
+                e.next_try = 0
+                changed = True
+                self.event(e)
+                continue
+
+            st = json_loads(resp)
+            if st.confirmed:
+                e.height = st.block_height
+                e.state = CONFIRMED
+                changed = True
+                self.event(e)
+
+        for e in waiting:
+            if e.height is not None and e.state == CONFIRMED:
+                confs = tip - e.height + 1
+                if confs != e.confirmations:
+                    e.confirmations = confs
+                    changed = True
+                if confs >= settings.OUTBOX_CONFIRMATIONS:
+                    e.state = DONE
+                    changed = True
+                    self.event(e)
+
+        self.tip_height = tip
+
+        return changed
+
+    async def step(self):
+        # Do what's due now; return seconds until we should run again.
+        now = time.time()
+        changed = False
+
+        for e in list(self.entries):
+            if e.state == PENDING and e.next_try <= now:
+                await self.try_send(e)
+                changed = True
+
+        if now - self.last_poll >= settings.OUTBOX_POLL_INTERVAL:
+            self.last_poll = now
+            try:
+                changed = (await self.poll()) or changed
+            except ServersUnreachable as exc:
+                logging.warning(f"Unable to check txn status: {exc}")
+
+        # forget about old, well-confirmed ones
+        old = now - settings.OUTBOX_KEEP_TIME
+        keep = [e for e in self.entries if not (e.state in (DONE, REJECTED) and e.added < old)]
+        if len(keep) != len(self.entries):
+            self.entries[:] = keep
+            changed = True
+
+        if changed:
+            self.changed()
+
+        retries = [e.next_try for e in self.entries if e.state == PENDING]
+        return max(1, min(retries + [self.last_poll + settings.OUTBOX_POLL_INTERVAL]) - now)
+
+    async def run(self):
+        # Background task: retries and polling.
+        self.publish()
+
+        while 1:
+            try:
+                delay = await self.step()
+            except Exception:
+                logging.error("Outbox", exc_info=1)
+                delay = settings.OUTBOX_POLL_INTERVAL
+
+            try:
+                await asyncio.wait_for(self._kick.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._kick.clear()
+
+    def kick(self):
+        # BP was just loaded, or something else worth looking at now
+        if BP.loaded and self._unsaved:
+            # sent before we could save them; keep them now
+            have = set(e.txid for e in self.entries)
+            self.entries.extend(e for e in self._unsaved if e.txid not in have)
+            self._unsaved = []
+            self.changed()
+
+        self.last_poll = 0
+        self._kick.set()
+
+# singleton
+OUTBOX = Outbox()
+
+# EOF
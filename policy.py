@@ -95,6 +95,139 @@ def web_cookup(proposed):
     return p
     
 
+#
+# Predict what the Coldcard will do with a PSBT, in HSM mode, so we can
+# bounce those which will obviously be refused, without using the Coldcard.
+# - rules are checked like the Coldcard does: first one that matches is used
+# - we can't check passwords, local codes or wallet names, so those are "can't tell"
+# - a PSBT is refused only if every rule surely fails
+#
+APPROVE = 'approve'
+REFUSE = 'refuse'
+UNKNOWN = 'unknown'
+
+def norm_addr(addr):
+    # bech32 is case-insensitive, base58 isn't
+    return addr.lower() if addr[0:3].lower() in ('bc1', 'tb1', 'bcr') else addr
+
+class CompiledRule:
+    # One spending rule, with everything needed ready to go.
+
+    def __init__(self, idx, rule):
+        self.idx = idx
+        self.max_amount = rule.get('max_amount')
+        self.per_period = rule.get('per_period')
+        self.whitelist = frozenset(norm_addr(a) for a in rule.get('whitelist') or [])
+        self.users = frozenset(rule.get('users') or [])
+        self.min_users = rule.get('min_users') or len(self.users)
+        self.local_conf = bool(rule.get('local_conf'))
+        self.wallet = rule.get('wallet') or None
+
+    def check(self, lo, hi, dests, unsure, multisig, authed, spent):
+        # Does this rule apply? True/False, or None if we can't tell; and why not.
+        # - lo/hi: amount sent, not counting/counting outputs that might be change
+        # - dests/unsure: addresses of those outputs
+        maybe = []
+
+        if self.wallet == '1' and multisig:
+            return False, 'only for non-multisig'
+        if self.wallet and self.wallet != '1':
+            if not multisig:
+                return False, 'only for multisig wallet: ' + self.wallet
+            maybe.append('wallet')
+
+        if self.max_amount is not None:
+            if lo > self.max_amount:
+                return False, 'over max amount'
+            if hi > self.max_amount:
+                maybe.append('max amount')
+
+        if self.whitelist:
+            if not dests <= self.whitelist:
+                return False, 'destination not whitelisted'
+            if not unsure <= self.whitelist:
+                maybe.append('whitelist')
+
+        if self.users:
+            if len(self.users & authed) < self.min_users:
+                return False, f'needs {self.min_users} of: ' + ', '.join(sorted(self.users))
+            maybe.append('user auth')
+
+        if self.local_conf:
+            maybe.append('local code')
+
+        if self.per_period is not None:
+            if spent is None:
+                maybe.append('velocity')
+            elif spent + lo > self.per_period:
+                return False, 'over per-period limit'
+            elif spent + hi > self.per_period:
+                maybe.append('velocity')
+
+        if maybe:
+            return None, ', '.join(maybe)
+
+        return True, None
+
+class CompiledPolicy:
+    # All the rules from a policy, ready to check PSBT files against
+
+    def __init__(self, pol):
+        self.rules = [CompiledRule(i, r) for i, r in enumerate(pol.get('rules') or [])]
+
+    def predict(self, details, authed=(), spent=None):
+        # Details are from psbt.decode_psbt(); authed is usernames which gave values;
+        # spent is amount spent so far in period, per rule (None if not known).
+        # Returns (verdict, rule index or None, reason)
+        dests, unsure = set(), set()
+        lo = hi = 0
+        for o in details['outputs']:
+            if o['change']:
+                continue
+            addr = norm_addr(o['address'] or o['script'])
+            if o['claimed']:
+                # might be change, if Coldcard can tell (taproot, etc.)
+                unsure.add(addr)
+                hi += o['value']
+            else:
+                dests.add(addr)
+                lo += o['value']
+        hi += lo
+
+        authed = frozenset(authed)
+        maybe = None
+        why = []
+        for r in self.rules:
+            ok, reason = r.check(lo, hi, dests, unsure, details['multisig'], authed,
+                                    spent[r.idx] if spent and r.idx < len(spent) else None)
+            if ok:
+                return APPROVE, (r.idx if maybe is None else None), None
+            if ok is None:
+                if maybe is None:
+                    maybe = (r.idx, reason)
+                continue
+            why.append(f'Rule #{r.idx+1}: {reason}')
+
+        if maybe:
+            return UNKNOWN, maybe[0], maybe[1]
+
+        return REFUSE, None, '; '.join(why) or 'no rules allow spending'
+
+_compiled = (None, None)
+
+def compiled():
+    # Current policy (from BP) compiled; None if we don't know it (privacy over UX)
+    global _compiled
+
+    pol = BP.get('policy')
+    if not pol:
+        return None
+
+    if _compiled[0] is not pol:
+        _compiled = (pol, CompiledPolicy(pol))
+
+    return _compiled[1]
+
 def desensitize(policy):
     # remove the most sensitive stuff in the policy.
     bk = policy.copy()
@@ -147,4 +280,37 @@ def update_sl(proposed):
     proposed['allow_sl'] = 13 if BP.get('allow_reboots', True) else 1
             
 
+if __name__ == '__main__':
+    # Benchmark: predictions against a policy with a big whitelist
+    #   python policy.py [whitelist size]
+    import sys, timeit
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    wl = ['bc1q%038x' % i for i in range(n)]
+
+    pol = dict(rules=[
+        dict(whitelist=wl, max_amount=10**8, users=['alice', 'bob'], min_users=2),
+        dict(whitelist=wl[0:10], per_period=5*10**7),
+        dict(max_amount=10**6, local_conf=True),
+    ])
+    cp = CompiledPolicy(pol)
+
+    def psbt(*outs):
+        return dict(multisig=False, outputs=[dict(value=v, address=a, script='',
+                                    change=False, claimed=False) for a, v in outs])
+
+    cases = [
+        ('whitelisted, no auth', psbt((wl[5], 10**5)), [], [0, 0, 0]),
+        ('whitelisted, both users', psbt((wl[5000 % n], 10**5)), ['alice', 'bob'], [0, 0, 0]),
+        ('not whitelisted, big', psbt(('bc1qxyz', 10**7)), [], [0, 0, 0]),
+        ('over velocity', psbt((wl[5], 10**7)), [], [0, 45*10**6, 0]),
+        ('velocity unknown', psbt((wl[5], 10**7)), [], None),
+    ]
+    for label, d, users, spent in cases:
+        t = timeit.timeit(lambda: cp.predict(d, users, spent), number=10000) / 10000
+        print(f"{label:>25}: {1E6*t:5.1f}us  {cp.predict(d, users, spent)}")
+
+    t = timeit.timeit(lambda: CompiledPolicy(pol), number=10) / 10
+    print(f"compile ({n} addresses): {1000*t:.1f}ms")
+
 # EOF
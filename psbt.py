@@ -0,0 +1,409 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# psbt.py -- decode a PSBT locally, so we can show what it does without asking the Coldcard.
+#
+# - amounts, fee, size, addresses and which outputs are change (back to us)
+# - change is only shown if the output script matches the keys claimed; the Coldcard
+#   still does the real checks when signing
+# - big files are decoded in another process
+#
+import io, struct, logging, asyncio, hashlib
+from hashlib import sha256
+from binascii import b2a_hex
+from objstruct import ObjectStruct
+from ckcc.utils import xfp2str
+from txn import parse_txn, read_varint, read_exact, dsha256
+from utils import worker_processes
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# key types we care about (BIP-174)
+PSBT_GLOBAL_UNSIGNED_TX = 0x00
+PSBT_GLOBAL_VERSION = 0xfb
+
+PSBT_IN_NON_WITNESS_UTXO = 0x00
+PSBT_IN_WITNESS_UTXO = 0x01
+PSBT_IN_REDEEM_SCRIPT = 0x04
+PSBT_IN_WITNESS_SCRIPT = 0x05
+PSBT_IN_BIP32_DERIVATION = 0x06
+
+PSBT_OUT_REDEEM_SCRIPT = 0x00
+PSBT_OUT_WITNESS_SCRIPT = 0x01
+PSBT_OUT_BIP32_DERIVATION = 0x02
+
+# RIPEMD-160, for OpenSSL builds that don't have it (like OpenSSL 3 by default)
+RMD_ML = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15,
+          7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8,
+          3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12,
+          1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2,
+          4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13]
+RMD_MR = [5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12,
+          6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2,
+          15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13,
+          8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14,
+          12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11]
+RMD_RL = [11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8,
+          7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12,
+          11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5,
+          11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12,
+          9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6]
+RMD_RR = [8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6,
+          9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11,
+          9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5,
+          15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8,
+          8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11]
+RMD_KL = [0x00000000, 0x5A827999, 0x6ED9EBA1, 0x8F1BBCDC, 0xA953FD4E]
+RMD_KR = [0x50A28BE6, 0x5C4DD124, 0x6D703EF3, 0x7A6D76E9, 0x00000000]
+
+def _rmd_fi(x, y, z, i):
+    if i == 0: return x ^ y ^ z
+    if i == 1: return (x & y) | (~x & z)
+    if i == 2: return (x | ~y) ^ z
+    if i == 3: return (x & z) | (y & ~z)
+    return x ^ (y | ~z)
+
+def _rmd_rol(x, n):
+    return ((x << n) | (x >> (32 - n))) & 0xffffffff
+
+def ripemd160(data):
+    h = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476, 0xC3D2E1F0]
+
+    msg = data + b'\x80' + bytes((55 - len(data)) % 64) + struct.pack('<Q', 8 * len(data))
+    for blk in range(0, len(msg), 64):
+        x = struct.unpack('<16L', msg[blk:blk+64])
+        al, bl, cl, dl, el = h
+        ar, br, cr, dr, er = h
+        for j in range(80):
+            rnd = j >> 4
+            al = (_rmd_rol((al + _rmd_fi(bl, cl, dl, rnd) + x[RMD_ML[j]] + RMD_KL[rnd])
+                                & 0xffffffff, RMD_RL[j]) + el) & 0xffffffff
+            al, bl, cl, dl, el = el, al, bl, _rmd_rol(cl, 10), dl
+            ar = (_rmd_rol((ar + _rmd_fi(br, cr, dr, 4 - rnd) + x[RMD_MR[j]] + RMD_KR[rnd])
+                                & 0xffffffff, RMD_RR[j]) + er) & 0xffffffff
+            ar, br, cr, dr, er = er, ar, br, _rmd_rol(cr, 10), dr
+        h = [(h[1] + cl + dr) & 0xffffffff, (h[2] + dl + er) & 0xffffffff,
+             (h[3] + el + ar) & 0xffffffff, (h[4] + al + br) & 0xffffffff,
+             (h[0] + bl + cr) & 0xffffffff]
+
+    return struct.pack('<5L', *h)
+
+def hash160(b):
+    try:
+        r = hashlib.new('ripemd160')
+    except ValueError:
+        # some OpenSSL builds don't have it
+        return ripemd160(sha256(b).digest())
+    r.update(sha256(b).digest())
+    return r.digest()
+
+#
+# Addresses
+#
+B58_CHARS = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+def b58check(payload):
+    raw = payload + dsha256(payload)[0:4]
+    n = int.from_bytes(raw, 'big')
+    rv = ''
+    while n:
+        n, r = divmod(n, 58)
+        rv = B58_CHARS[r] + rv
+    pad = len(raw) - len(raw.lstrip(b'\0'))
+    return ('1' * pad) + rv
+
+BECH32_CHARS = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+
+def bech32_polymod(values):
+    gen = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for v in values:
+        b = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ v
+        for i in range(5):
+            chk ^= gen[i] if ((b >> i) & 1) else 0
+    return chk
+
+def segwit_addr(hrp, version, program):
+    # BIP-173, and BIP-350 (bech32m) for version 1+
+    data = [version]
+    acc = bits = 0
+    for b in program:
+        acc = (acc << 8) | b
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append((acc >> bits) & 31)
+    if bits:
+        data.append((acc << (5 - bits)) & 31)
+
+    const = 1 if version == 0 else 0x2bc830a3
+    exp = [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+    poly = bech32_polymod(exp + data + [0]*6) ^ const
+    data += [(poly >> 5 * (5 - i)) & 31 for i in range(6)]
+
+    return hrp + '1' + ''.join(BECH32_CHARS[d] for d in data)
+
+def script_type(script):
+    # classify an output script: returns (type, hash/program) or (None, None)
+    if len(script) == 25 and script[0:3] == b'\x76\xa9\x14' and script[23:] == b'\x88\xac':
+        return 'p2pkh', script[3:23]
+    if len(script) == 23 and script[0:2] == b'\xa9\x14' and script[22] == 0x87:
+        return 'p2sh', script[2:22]
+    if len(script) == 22 and script[0:2] == b'\x00\x14':
+        return 'p2wpkh', script[2:]
+    if len(script) == 34 and script[0:2] == b'\x00\x20':
+        return 'p2wsh', script[2:]
+    if len(script) == 34 and script[0:2] == b'\x51\x20':
+        return 'p2tr', script[2:]
+    return None, None
+
+def script_to_address(script, testnet=False):
+    # address for output script, or None if it doesn't have one (OP_RETURN, etc)
+    st, h = script_type(script)
+    if st == 'p2pkh':
+        return b58check(bytes([0x6f if testnet else 0x00]) + h)
+    if st == 'p2sh':
+        return b58check(bytes([0xc4 if testnet else 0x05]) + h)
+    if st in ('p2wpkh', 'p2wsh'):
+        return segwit_addr('tb' if testnet else 'bc', 0, h)
+    if st == 'p2tr':
+        return segwit_addr('tb' if testnet else 'bc', 1, h)
+    return None
+
+#
+# Decoding
+#
+def read_map(fd):
+    # yield (key type, key data, value) from one section, until the separator
+    while 1:
+        klen = read_varint(fd)
+        if not klen:
+            return
+        key = read_exact(fd, klen)
+        val = read_exact(fd, read_varint(fd))
+        yield key[0], key[1:], val
+
+def parse_derivation(val):
+    # fingerprint and path for a key
+    xfp, = struct.unpack('<I', val[0:4])
+    path = struct.unpack('<%dI' % ((len(val)-4) // 4), val[4:])
+    return xfp2str(xfp), path
+
+def check_ours(script, redeem, witness, derivs, our_xfp):
+    # is output/input script really made from keys with our fingerprint?
+    ours = [pk for pk, (xfp, path) in derivs.items() if xfp == our_xfp]
+    if not our_xfp or not ours:
+        return False
+
+    st, h = script_type(script)
+    if st == 'p2sh' and redeem and hash160(redeem) == h:
+        st, h = script_type(redeem)
+        if st is None:
+            # classic p2sh multisig
+            return any(pk in redeem for pk in ours)
+
+    if st in ('p2pkh', 'p2wpkh'):
+        return any(hash160(pk) == h for pk in ours)
+    if st == 'p2wsh' and witness and sha256(witness).digest() == h:
+        return any(pk in witness for pk in ours)
+
+    # taproot, or unknown; can't tell without EC math
+    return False
+
+def is_multisig(script, redeem, witness):
+    # spending from a p2sh/p2wsh multisig script?
+    ms = witness or redeem
+    st, _ = script_type(ms) if ms else (None, None)
+    return bool(ms) and st is None and ms[-1] == 0xae       # OP_CHECKMULTISIG
+
+def input_vsize(script, redeem, witness):
+    # estimate of input size once signed (vbytes): outpoint/sequence (40) plus signatures
+    st, _ = script_type(script)
+    if st == 'p2sh' and redeem:
+        inner, _ = script_type(redeem)
+        if inner == 'p2wpkh':
+            return 91
+        if inner == 'p2wsh':
+            st = 'p2sh-p2wsh'
+    if st == 'p2pkh':
+        return 148
+    if st == 'p2wpkh':
+        return 68
+    if st == 'p2tr':
+        return 58
+
+    if witness or redeem:
+        # multisig: m signatures, and the script
+        ms = witness or redeem
+        m = (ms[0] - 0x50) if 0x51 <= ms[0] <= 0x60 else 1
+        if st in ('p2wsh', 'p2sh-p2wsh'):
+            wit = 1 + 1 + (m * 73) + 3 + len(ms)
+            return 41 + (35 if st == 'p2sh-p2wsh' else 0) + (wit + 3) // 4
+        return 41 + 1 + (m * 73) + 3 + len(ms)
+
+    return 68       # guess
+
+def decode_psbt(raw, our_xfp=None, testnet=False):
+    # Decode binary PSBT into a summary of what it does.
+    fd = io.BytesIO(raw)
+    if fd.read(5) != b'psbt\xff':
+        raise ValueError("not a PSBT")
+
+    unsigned = None
+    for kt, kd, val in read_map(fd):
+        if kt == PSBT_GLOBAL_UNSIGNED_TX:
+            unsigned = parse_txn(val)
+        elif kt == PSBT_GLOBAL_VERSION and struct.unpack('<I', val)[0] >= 2:
+            raise ValueError("PSBT v2 not supported")
+
+    if not unsigned:
+        raise ValueError("no unsigned txn")
+
+    inputs = []
+    multisig = False
+    vsize = 10 + len(unsigned.outputs)*9 + sum(len(o.script) for o in unsigned.outputs)
+    for inp in unsigned.inputs:
+        utxo = None
+        redeem = witness = None
+        derivs = {}
+        for kt, kd, val in read_map(fd):
+            if kt == PSBT_IN_WITNESS_UTXO:
+                v = io.BytesIO(val)
+                value, = struct.unpack('<q', read_exact(v, 8))
+                utxo = ObjectStruct(value=value, script=read_exact(v, read_varint(v)))
+            elif kt == PSBT_IN_NON_WITNESS_UTXO and not utxo:
+                prev = parse_txn(val)
+                if prev.txid != inp.prev_txid:
+                    raise ValueError("input %d: wrong previous txn" % len(inputs))
+                utxo = prev.outputs[inp.prev_index]
+            elif kt == PSBT_IN_REDEEM_SCRIPT:
+                redeem = val
+            elif kt == PSBT_IN_WITNESS_SCRIPT:
+                witness = val
+            elif kt == PSBT_IN_BIP32_DERIVATION:
+                derivs[kd] = parse_derivation(val)
+
+        script = utxo.script if utxo else b''
+        vsize += input_vsize(script, redeem, witness)
+        multisig = multisig or is_multisig(script, redeem, witness)
+        inputs.append(dict(txid=inp.prev_txid, index=inp.prev_index,
+                            value=utxo.value if utxo else None,
+                            address=script_to_address(script, testnet) if utxo else None,
+                            ours=check_ours(script, redeem, witness, derivs, our_xfp)))
+
+    outputs = []
+    for out in unsigned.outputs:
+        redeem = witness = None
+        derivs = {}
+        for kt, kd, val in read_map(fd):
+            if kt == PSBT_OUT_REDEEM_SCRIPT:
+                redeem = val
+            elif kt == PSBT_OUT_WITNESS_SCRIPT:
+                witness = val
+            elif kt == PSBT_OUT_BIP32_DERIVATION:
+                derivs[kd] = parse_derivation(val)
+
+        outputs.append(dict(value=out.value, address=script_to_address(out.script, testnet),
+                            script=b2a_hex(out.script).decode('ascii'),
+                            change=check_ours(out.script, redeem, witness, derivs, our_xfp),
+                            claimed=any(xfp == our_xfp for xfp, _ in derivs.values())))
+
+    total_in = sum(i['value'] for i in inputs) if all(i['value'] is not None for i in inputs) \
+                    else None
+    total_out = sum(o['value'] for o in outputs)
+    fee = (total_in - total_out) if total_in is not None else None
+
+    return dict(txid=unsigned.txid, num_inputs=len(inputs), num_outputs=len(outputs),
+                inputs=inputs, outputs=outputs, total_in=total_in, total_out=total_out,
+                sending=sum(o['value'] for o in outputs if not o['change']),
+                fee=fee, vsize=vsize, feerate=round(fee / vsize, 1) if fee is not None else None,
+                multisig=multisig)
+
+def btc(sats):
+    return '%.8f' % (sats / 1E8)
+
+def preview_text(d):
+    # Make a text preview, something like what the Coldcard would show.
+    lines = []
+
+    lines.append(f"Sending {btc(d['sending'])} BTC")
+    if d['fee'] is not None:
+        lines.append(f"Network fee {btc(d['fee'])} BTC  "
+                        f"({d['feerate']} sat/vB, ~{d['vsize']} vbytes)")
+    else:
+        lines.append("Network fee: unknown (input amounts not given)")
+
+    lines.append('')
+    lines.append(f"{d['num_inputs']} input{'s' if d['num_inputs'] != 1 else ''}, "
+                 f"{d['num_outputs']} output{'s' if d['num_outputs'] != 1 else ''}")
+
+    for label, want in [('Destinations', False), ('Change back', True)]:
+        outs = [o for o in d['outputs'] if o['change'] == want]
+        if not outs:
+            continue
+        lines.append('')
+        lines.append(label + ':')
+        for o in outs:
+            lines.append(f"  {btc(o['value'])} BTC")
+            lines.append(f"  to {o['address'] or ('script ' + o['script'])}")
+
+    return '\n'.join(lines)
+
+async def decode_async(raw, our_xfp=None, testnet=False):
+    # Decode in a worker process if big, else right here.
+    from persist import settings
+
+    if len(raw) <= settings.PSBT_INLINE_DECODE:
+        return decode_psbt(raw, our_xfp, testnet)
+
+    return await asyncio.get_running_loop().run_in_executor(worker_processes(),
+                                    decode_psbt, raw, our_xfp, testnet)
+
+if __name__ == '__main__':
+    # Decode a PSBT file, and time it
+    #   python psbt.py file.psbt [xfp]
+    # or check our RIPEMD-160 (used when OpenSSL doesn't have it)
+    #   python psbt.py ripemd
+    import sys, time, os
+    from utils import cleanup_psbt
+
+    if sys.argv[1] == 'ripemd':
+        vectors = {b'': '9c1185a5c5e9fc54612808977ee8f548b2258d31',
+                   b'abc': '8eb208f7e05d987a9b044a8e98c6b087f15a0bfc',
+                   b'message digest': '5d0689ef49d2fae572b881b123a85ffa21595f36',
+                   b'a' * 1000000: '52783243c1697bdbe16d37f97f68f08325dc1528'}
+        for msg, expect in vectors.items():
+            assert ripemd160(msg).hex() == expect, msg[0:20]
+
+        try:
+            hashlib.new('ripemd160')
+            for n in range(300):
+                msg = os.urandom(n)
+                assert ripemd160(msg) == hashlib.new('ripemd160', msg).digest()
+            print("RIPEMD-160 ok, same as OpenSSL")
+        except ValueError:
+            print("RIPEMD-160 ok (OpenSSL doesn't have it)")
+
+        # the fallback, as if OpenSSL didn't have it
+        expect = hash160(b'test')
+        real_new = hashlib.new
+        def no_ripemd(name, *a):
+            if name == 'ripemd160':
+                raise ValueError(name)
+            return real_new(name, *a)
+        hashlib.new = no_ripemd
+        assert hash160(b'test') == expect
+        print("hash160 fallback ok")
+        sys.exit(0)
+
+    raw = cleanup_psbt(open(sys.argv[1], 'rb').read())
+    xfp = sys.argv[2].upper() if len(sys.argv) > 2 else None
+
+    t = time.perf_counter()
+    d = decode_psbt(raw, xfp)
+    dt = time.perf_counter() - t
+
+    print(preview_text(d))
+    print(f"\n({len(raw)} bytes decoded in {1000*dt:.2f}ms)")
+
+# EOF
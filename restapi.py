@@ -0,0 +1,421 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# restapi.py -- signing API for programs (payout systems, etc), no browser needed.
+#
+# - every request is signed using HMAC-SHA256 with an API key's secret (see docs/api.md)
+# - keys are made on the Tools page, and kept in BP (so encrypted)
+# - PSBT goes into the same signing queue as the web UI uses, and you get a job id
+# - long-poll the job to see when it's done, then fetch signed PSBT or txn
+# - or watch events (see events.py) as they happen: SSE stream, or long-poll
+#
+import os, asyncio, logging, hmac, time
+from hashlib import sha256
+from binascii import b2a_hex
+from base64 import b64encode, b64decode
+from collections import OrderedDict
+from aiohttp import web
+from objstruct import ObjectStruct
+from utils import Singleton, json_dumps, json_loads
+from status import STATUS
+from persist import settings, BP
+from events import EVENTS
+from fanout import FANOUT
+import events
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+PREFIX = '/api/v1'
+
+routes = web.RouteTableDef()
+
+# job states
+PENDING = 'pending'
+DONE = 'done'
+REFUSED = 'refused'
+FAILED = 'failed'
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=json_dumps)
+
+def error(status, msg):
+    return json_response(dict(error=msg), status=status)
+
+def wait_time(value):
+    # seconds to long-poll for, from query string; limited. None if not a number
+    try:
+        wait = float(value or 0)
+    except ValueError:
+        return None
+    if wait != wait:
+        return None         # NaN
+    return min(wait, settings.API_MAX_WAIT)
+
+#
+# API keys
+#
+def api_keys():
+    # key id => dict(secret, label, created)
+    return BP.setdefault('api_keys', {})
+
+def create_key(label):
+    # new key; returns (key id, secret); secret is only shown this once
+    key_id = 'bk' + b2a_hex(os.urandom(6)).decode('ascii')
+    secret = b2a_hex(os.urandom(32)).decode('ascii')
+    api_keys()[key_id] = dict(secret=secret, label=label, created=int(time.time()), last_used=None)
+    BP.save('api_keys')
+    return key_id, secret
+
+def delete_key(key_id):
+    api_keys().pop(key_id, None)
+    BP.save('api_keys')
+
+def list_keys():
+    return [dict(id=k, label=v['label'], created=v['created'], last_used=v.get('last_used'))
+                for k, v in api_keys().items()]
+
+def request_signature(secret, method, path_qs, ts, body_hash):
+    # what the client must send as X-Bunker-Signature (hex)
+    msg = '\n'.join([method.upper(), path_qs, str(ts), body_hash]).encode('utf8')
+    return hmac.new(secret.encode('ascii'), msg, sha256).hexdigest()
+
+class RequestAuth(metaclass=Singleton):
+    # Check signed requests, and stop replays of them
+
+    def __init__(self):
+        self.seen = OrderedDict()       # signature => expires
+
+    def check_headers(self, request):
+        # First part: before reading body. Returns key record, or raises
+        key_id = request.headers.get('X-Bunker-Key', '')
+        key = api_keys().get(key_id)
+        if not key:
+            raise web.HTTPUnauthorized(text='unknown key')
+
+        try:
+            ts = int(request.headers['X-Bunker-Time'])
+        except (KeyError, ValueError):
+            raise web.HTTPUnauthorized(text='need time')
+        if abs(time.time() - ts) > settings.API_MAX_SKEW:
+            raise web.HTTPUnauthorized(text='time is wrong')
+
+        return key_id, key, ts
+
+    def check_signature(self, request, key_id, key, ts, body_hash):
+        # Second part: after body is read (and hashed)
+        sig = request.headers.get('X-Bunker-Signature', '')
+        expect = request_signature(key['secret'], request.method, request.path_qs, ts, body_hash)
+        if not hmac.compare_digest(sig, expect):
+            raise web.HTTPUnauthorized(text='bad signature')
+
+        now = time.time()
+        while self.seen and next(iter(self.seen.values())) < now:
+            self.seen.popitem(last=False)
+        if sig in self.seen:
+            raise web.HTTPUnauthorized(text='replayed')
+        self.seen[sig] = now + (2 * settings.API_MAX_SKEW)
+
+        # saved at most once a minute per key; it's only a hint
+        if now - (key.get('last_used') or 0) >= 60:
+            key['last_used'] = int(now)
+            BP.save('api_keys')
+
+async def authed_body(request, max_size):
+    # Verify request signature while reading body (streamed), and return it.
+    auth = RequestAuth()
+    key_id, key, ts = auth.check_headers(request)
+
+    body = bytearray()
+    h = sha256()
+    async for chunk in request.content.iter_chunked(64*1024):
+        if len(body) + len(chunk) > max_size:
+            raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=len(body)+len(chunk))
+        body.extend(chunk)
+        h.update(chunk)
+
+    auth.check_signature(request, key_id, key, ts, h.hexdigest())
+    return body
+
+def authed(fn):
+    # Decorator: request must be signed (no body expected)
+    async def wrapper(request):
+        await authed_body(request, 0)
+        return await fn(request)
+    return wrapper
+
+#
+# Signing jobs
+#
+class SigningJobs(metaclass=Singleton):
+
+    def __init__(self):
+        self.jobs = OrderedDict()           # id => ObjectStruct, oldest first
+
+    def expire(self):
+        old = time.time() - settings.API_JOB_KEEP_TIME
+        for jid, job in list(self.jobs.items()):
+            if job.state != PENDING and job.updated < old:
+                del self.jobs[jid]
+                self.forget_psbt(job)
+
+    def forget_psbt(self, job):
+        # drop job's PSBT from signing queue, unless web UI is showing it, or it's
+        # been submitted again
+        from sigqueue import SIGQ
+
+        item = SIGQ.get(job.psbt_hash)
+        if item and not item._ui and not (item._job and not item._job.done()):
+            SIGQ.remove(job.psbt_hash)
+
+    def get(self, jid):
+        return self.jobs.get(jid)
+
+    def start(self, psbt, finalize, broadcast, auth, key_id):
+        # Add PSBT to signing queue, and start a job for it. Might raise WouldRefuse.
+        from sigqueue import SIGQ
+
+        self.expire()
+
+        fresh = SIGQ.get(sha256(psbt).hexdigest()) is None
+        item = SIGQ.add(psbt, select=False)
+
+        if auth:
+            # users' passwords / TOTP codes: same as entered on txn page
+            item.pending_auth = [ObjectStruct(name=user, has_name=True,
+                                    has_guess='x'*len(token), totp=totp)
+                                        for user, token, totp in auth]
+            item._auth_guess = [token for user, token, totp in auth]
+
+        try:
+            fut = SIGQ.submit(item.hash, finalize=finalize)
+        except Exception:
+            if fresh:
+                SIGQ.remove(item.hash)
+            raise
+
+        job = ObjectStruct(id=b2a_hex(os.urandom(8)).decode('ascii'), psbt_hash=item.hash,
+                            state=PENDING, finalize=finalize, broadcast=broadcast,
+                            created=time.time(), updated=time.time(), key=key_id,
+                            error=None, txid=None, broadcast_result=None)
+        job._result = None
+        job._done = asyncio.Event()
+        self.jobs[job.id] = job
+
+        asyncio.create_task(self.finish(job, fut))
+
+        STATUS.notify_watchers()
+        return job
+
+    async def finish(self, job, fut):
+        # wait for Coldcard, then broadcast if they want that
+        from ckcc.protocol import CCUserRefused
+        from sigqueue import SIGQ
+        from outbox import OUTBOX
+        from txn import parse_txn
+
+        try:
+            job._result = await fut
+            job.state = DONE
+            if job.finalize:
+                job.txid = parse_txn(job._result).txid
+                if job.broadcast:
+                    job.broadcast_result = await OUTBOX.send(job._result)
+        except CCUserRefused:
+            item = SIGQ.get(job.psbt_hash)
+            job.state = REFUSED
+            job.error = (item and item.refusal) or 'Refused by local user.'
+        except Exception as exc:
+            job.state = FAILED
+            job.error = str(exc) or type(exc).__name__
+
+        # we have the result (or error) now
+        self.forget_psbt(job)
+
+        job.updated = time.time()
+        job._done.set()
+
+        events.emit(events.JOB_DONE, job=job.id, psbt_hash=job.psbt_hash, state=job.state,
+                        error=job.error, txid=job.txid)
+
+    def summary(self, job):
+        return dict((k, v) for k, v in job.items() if k[0] != '_' and k != 'key')
+
+# singletons
+JOBS = SigningJobs()
+
+def parse_auth(auth):
+    # [{user, token, totp}] from request, as (user, token, totp); ValueError if not that
+    if not isinstance(auth, list):
+        raise ValueError('auth must be a list')
+
+    rv = []
+    for a in auth:
+        if not isinstance(a, dict) or not isinstance(a.get('user'), str) \
+                or not isinstance(a.get('token'), str):
+            raise ValueError('auth needs user and token')
+        rv.append((a['user'], a['token'], int(a.get('totp') or 0)))
+
+    return rv
+
+#
+# Endpoints
+#
+@routes.post(PREFIX + '/psbt')
+async def submit_psbt(request):
+    # PSBT in body: binary, base64 or hex; or JSON object w/ "psbt" (base64) and options.
+    # Options (query or JSON): finalize, broadcast, and auth: [{user, token, totp}]
+    from sigqueue import WouldRefuse
+    from utils import cleanup_psbt
+
+    body = await authed_body(request, settings.MAX_UPLOAD_SIZE)
+
+    q = request.query
+    opts = dict(finalize=q.get('finalize') in ('1', 'true'),
+                broadcast=q.get('broadcast') in ('1', 'true'), auth=[])
+
+    try:
+        if request.content_type == 'application/json':
+            j = json_loads(bytes(body))
+            if not isinstance(j, dict) or not isinstance(j.get('psbt'), str):
+                return error(400, 'need object with psbt (base64)')
+            body = b64decode(j['psbt'])
+            opts.update((k, j[k]) for k in opts if k in j)
+
+        auth = parse_auth(opts['auth'])
+    except (ValueError, TypeError) as exc:
+        # includes bad JSON, and bad base64 (binascii.Error)
+        return error(400, 'bad request: ' + str(exc))
+
+    if opts['broadcast'] and not opts['finalize']:
+        return error(400, 'must finalize to broadcast')
+
+    try:
+        psbt = cleanup_psbt(body)
+    except ValueError as exc:
+        return error(400, str(exc))
+
+    try:
+        job = JOBS.start(psbt, bool(opts['finalize']), bool(opts['broadcast']),
+                            auth, request.headers['X-Bunker-Key'])
+    except WouldRefuse as exc:
+        return error(403, 'HSM policy would refuse: ' + str(exc))
+    except AssertionError as exc:
+        return error(409, str(exc))
+
+    return json_response(JOBS.summary(job), status=202)
+
+@routes.get(PREFIX + '/jobs/{job}')
+@authed
+async def job_status(request):
+    # Status of a job. Add ?wait=N to wait up to N seconds for it to finish (long-poll).
+    job = JOBS.get(request.match_info['job'])
+    if not job:
+        return error(404, 'no such job')
+
+    wait = wait_time(request.query.get('wait'))
+    if wait is None:
+        return error(400, 'bad wait time')
+    if wait > 0 and job.state == PENDING:
+        try:
+            await asyncio.wait_for(job._done.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+    return json_response(JOBS.summary(job))
+
+@routes.get(PREFIX + '/jobs/{job}/result')
+@authed
+async def job_result(request):
+    # Signed PSBT, or txn if finalized: binary, or ?encoding=base64 or hex
+    job = JOBS.get(request.match_info['job'])
+    if not job:
+        return error(404, 'no such job')
+    if job.state != DONE:
+        return error(409, 'job is ' + job.state)
+
+    enc = request.query.get('encoding', 'binary')
+    if enc == 'base64':
+        return web.Response(text=b64encode(job._result).decode('ascii'))
+    if enc == 'hex':
+        return web.Response(text=b2a_hex(job._result).decode('ascii'))
+
+    return web.Response(body=job._result, content_type='application/octet-stream')
+
+def status_summary():
+    # Is the Coldcard there, and in HSM mode; how busy; how much can be spent
+    return dict(connected=STATUS.connected, xfp=STATUS.get('xfp'),
+                    hsm_active=bool(STATUS.hsm.get('active')),
+                    last_refusal=STATUS.hsm.get('last_refusal'),
+                    devices=STATUS.devices, queue=STATUS.queue_stats, velocity=STATUS.velocity,
+                    websockets=FANOUT.summary(details=True))
+
+@routes.get(PREFIX + '/status')
+@authed
+async def bunker_status(request):
+    return json_response(status_summary())
+
+def sse_format(ev):
+    return f"id: {ev.id}\nevent: {ev.type}\ndata: {json_dumps(ev)}\n\n"
+
+@routes.get(PREFIX + '/events')
+@authed
+async def event_stream(request):
+    # Events after Last-Event-ID header (or ?since=id), or from now on. Given as a stream
+    # of Server-Sent Events, or with ?poll=N, as JSON, waiting up to N seconds for some.
+    # Add ?types=a,b for just those. If some were missed, you get a resync event (or
+    # "missed" in JSON) with the current status.
+    q = request.query
+    last = request.headers.get('Last-Event-ID') or q.get('since')
+    try:
+        last = int(last) if last else EVENTS.last_id
+    except ValueError:
+        return error(400, 'bad event id')
+    types = set(q['types'].split(',')) if q.get('types') else None
+
+    if 'poll' in q:
+        wait = wait_time(q['poll'])
+        if wait is None:
+            return error(400, 'bad poll time')
+        deadline = time.time() + wait
+
+        seen = EVENTS.last_id
+        evs, missed = EVENTS.since(last, types)
+        while not evs and not missed and time.time() < deadline:
+            try:
+                await EVENTS.wait(seen, deadline - time.time())
+            except asyncio.TimeoutError:
+                break
+            seen = EVENTS.last_id
+            evs, missed = EVENTS.since(last, types)
+
+        return json_response(dict(events=evs, last_id=seen,
+                                    missed=(status_summary() if missed else None)))
+
+    resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                        'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    await resp.prepare(request)
+
+    try:
+        while 1:
+            seen = EVENTS.last_id
+            evs, missed = EVENTS.since(last, types)
+            if missed:
+                evs.insert(0, ObjectStruct(id=seen, type=events.RESYNC, ts=time.time(),
+                                            status=status_summary()))
+            if evs:
+                await resp.write(''.join(sse_format(ev) for ev in evs).encode('utf8'))
+            last = seen
+
+            try:
+                await EVENTS.wait(last, settings.EVENT_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await resp.write(b': keepalive\n\n')
+    except ConnectionResetError:
+        pass
+
+    return resp
+
+def is_api(request):
+    # requests to this API have their own auth; not cookies and logins
+    return request.path.startswith(PREFIX + '/')
+
+# EOF
@@ -0,0 +1,468 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# sigqueue.py -- PSBT files waiting to be signed, and a worker to feed them to the Coldcard.
+#
+# - each PSBT is keyed by it's sha256, and has it's own preview, auth slots and state
+# - STATUS.psbt_hash (etc) reflect the one currently selected in the web UI
+#
+import asyncio, logging, time
+from collections import OrderedDict
+from hashlib import sha256
+from binascii import a2b_hex
+from objstruct import ObjectStruct
+from utils import Singleton, cleanup_psbt
+from status import STATUS
+import events
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# lifecycle of each PSBT in queue
+QUEUED = 'queued'
+PREVIEWED = 'previewed'
+SIGNING = 'signing'
+DONE = 'done'
+REFUSED = 'refused'
+
+# where preview text came from
+LOCAL = 'local'                 # decoded here (see psbt.py)
+COLDCARD = 'coldcard'           # shown by the Coldcard itself
+
+class WouldRefuse(RuntimeError):
+    # HSM policy will surely refuse it, so don't bother the Coldcard
+    pass
+
+class PendingPSBT(ObjectStruct):
+    # one PSBT file, and what we know about it; underscore values aren't shared w/ browser
+
+    def __init__(self, raw):
+        super(PendingPSBT, self).__init__()
+
+        self._raw = raw
+        self.hash = sha256(raw).hexdigest()
+        self.size = len(raw)
+        self.state = QUEUED
+        self.preview = None
+        self.preview_by = None
+        self.details = None             # amounts, fee, etc. from local decode
+        self.refusal = None
+        self.added = time.time()
+
+        # timings (seconds), filled as we go
+        self.wait_time = None
+        self.sign_time = None
+        self.signer = None              # xfp of Coldcard that signed it
+        self.finalized = None           # was result a txn, rather than PSBT
+        self.prediction = None          # what we expect HSM policy to do (see policy.py)
+        self._job = None                # future for result, once submitted
+        self._ui = False                # shown in web UI; else only REST API knows of it
+
+        # auth slots; None until this PSBT is first selected
+        self.pending_auth = None
+        self._auth_guess = None
+
+        # full decode, with inputs and outputs
+        self._decoded = None
+        self._local_preview = None
+
+    def summary(self):
+        return dict((k, v) for k, v in self.items()
+                        if k[0] != '_' and k not in ('pending_auth', 'preview', 'details'))
+
+    def set_state(self, state, **extra):
+        # move along lifecycle, and tell anyone listening (see events.py)
+        self.state = state
+        events.emit(events.PSBT_STATE, psbt_hash=self.hash, state=state, **extra)
+
+class SigningQueue(metaclass=Singleton):
+
+    def __init__(self):
+        self.items = OrderedDict()          # hash => PendingPSBT
+        self.current = None                 # hash of PSBT shown in UI
+        self.jobs = asyncio.Queue()
+
+        # stats
+        self.active = 0
+        self.count = 0
+        self.total_sign_time = 0
+
+        # policy predictions vs. what the Coldcard did
+        self.policy_check = dict(agreed=0, disagreed=0, unknown=0, bounced=0)
+
+    def get(self, hh):
+        return self.items.get(hh, None)
+
+    def add(self, psbt, select=True):
+        # new PSBT file has been uploaded; doesn't replace any others
+        # - from the REST API, it isn't shown in the web UI (select=False)
+        raw = cleanup_psbt(psbt)
+        hh = sha256(raw).hexdigest()
+
+        if hh not in self.items:
+            self.items[hh] = PendingPSBT(raw)
+            logging.info("Queued PSBT with hash: " + hh)
+            events.emit(events.PSBT_STATE, psbt_hash=hh, state=QUEUED, size=len(raw))
+            self.decode(self.items[hh])
+
+        if select:
+            self.select(hh)
+
+        return self.items[hh]
+
+    def remove(self, hh):
+        # forget about a PSBT; can't stop it if device is already working on it
+        item = self.items.get(hh, None)
+        if not item or item.state == SIGNING:
+            return
+
+        del self.items[hh]
+
+        if item._job and not item._job.done():
+            # whoever is waiting for it to be signed must be told
+            item._job.set_exception(RuntimeError("PSBT was removed before signing"))
+
+        if self.current == hh:
+            self.current = None
+            # show next one, if any
+            nxt = next(reversed(self.items), None)
+            if nxt:
+                self.select(nxt)
+            else:
+                STATUS.clear_psbt()
+
+        self.publish()
+
+    def select(self, hh):
+        # make indicated PSBT the one shown in UI: swap auth slots and copy details into STATUS
+        from ckcc.utils import calc_local_pincode
+
+        item = self.items[hh]
+        item._ui = True
+
+        old = self.get(self.current)
+        if old and old is not item and not (old._job and not old._job.done()):
+            # (if it's waiting to be signed, it has the auth values it will use)
+            old.pending_auth, old._auth_guess = STATUS.pending_auth, STATUS._auth_guess
+
+        if item.pending_auth is None:
+            STATUS.reset_pending_auth()
+        else:
+            STATUS.pending_auth, STATUS._auth_guess = item.pending_auth, item._auth_guess
+
+        self.current = hh
+
+        STATUS._pending_psbt = item._raw
+        STATUS.psbt_hash = item.hash
+        STATUS.psbt_size = item.size
+        STATUS.psbt_preview = item.preview
+        STATUS.psbt_preview_by = item.preview_by
+        STATUS.psbt_details = item.details
+
+        # local PIN code will be wrong/stale now.
+        if STATUS.hsm and STATUS.hsm.get('next_local_code'):
+            STATUS.local_code = calc_local_pincode(a2b_hex(hh), STATUS.hsm['next_local_code'])
+        else:
+            STATUS.local_code = None
+
+        self.publish()
+
+    def decode(self, item):
+        # start decoding PSBT here, so there is a preview without asking the Coldcard
+        try:
+            asyncio.get_running_loop().create_task(self.local_preview(item))
+        except RuntimeError:
+            # no event loop; they can still ask the Coldcard
+            pass
+
+    async def local_preview(self, item):
+        from persist import BP
+        import psbt
+
+        our_xfp = STATUS.get('xfp') or BP.get('xfp')
+        try:
+            d = await psbt.decode_async(item._raw, our_xfp, STATUS.is_testnet)
+        except Exception as exc:
+            logging.warning(f"Unable to decode PSBT {item.hash}: {exc}")
+            return
+
+        item._decoded = d
+        item._local_preview = psbt.preview_text(d)
+        item.details = dict((k, v) for k, v in d.items() if k not in ('inputs', 'outputs'))
+
+        if item.preview is None:
+            item.preview = item._local_preview
+            item.preview_by = LOCAL
+
+        if self.current == item.hash:
+            STATUS.psbt_preview = item.preview
+            STATUS.psbt_preview_by = item.preview_by
+            STATUS.psbt_details = item.details
+
+        self.publish()
+        STATUS.notify_watchers()
+
+    def set_preview(self, hh, txt):
+        # preview from Coldcard; None if it failed, and we go back to local one (if any)
+        item = self.items.get(hh, None)
+        if not item: return
+
+        if txt:
+            item.preview = txt
+            item.preview_by = COLDCARD
+        else:
+            item.preview = item._local_preview
+            item.preview_by = LOCAL if item.preview else None
+
+        if txt and item.state == QUEUED:
+            item.set_state(PREVIEWED)
+
+        if self.current == hh:
+            STATUS.psbt_preview = item.preview
+            STATUS.psbt_preview_by = item.preview_by
+
+        self.publish()
+
+    def publish(self):
+        # copy summary of queue into STATUS, for web clients; not those from REST API
+        STATUS.psbt_queue = [i.summary() for i in self.items.values() if i._ui]
+        STATUS.queue_stats = dict(depth=self.jobs.qsize(), signed=self.count,
+                        avg_sign_time=(self.total_sign_time / self.count) if self.count else None)
+        STATUS.policy_check = dict(self.policy_check)
+
+    def predict(self, hh, dev, from_ui=False):
+        # What will HSM policy on that Coldcard do with this PSBT, given auth values so far?
+        # Returns (verdict, rule index, reason), or None if we can't say: not in HSM mode,
+        # policy not known to us, or PSBT not decoded. We only know the primary's policy
+        # (and decode for its xfp); others may have different keys or policy.
+        import policy
+        from velocity import VELOCITY
+
+        item = self.items[hh]
+        cp = policy.compiled()
+        if not (cp and item._decoded and dev.primary and dev.hsm.get('active')):
+            return None
+
+        if from_ui and self.current == hh:
+            pending, guesses = STATUS.pending_auth, STATUS._auth_guess
+        else:
+            pending, guesses = item.pending_auth, item._auth_guess
+        authed = [pa.name for pa, g in zip(pending or [], guesses or []) if pa.name and g]
+
+        return cp.predict(item._decoded, authed, VELOCITY.spent())
+
+    def check_prediction(self, item, approved):
+        # compare to what Coldcard did; they should agree!
+        import policy
+
+        pred = item.prediction
+        if not pred or pred['verdict'] == policy.UNKNOWN:
+            self.policy_check['unknown'] += 1
+        elif (pred['verdict'] == policy.APPROVE) == approved:
+            self.policy_check['agreed'] += 1
+        else:
+            self.policy_check['disagreed'] += 1
+            logging.warning(f"Policy prediction wrong for {item.hash}: expected "
+                    f"{pred['verdict']} but Coldcard {'approved' if approved else 'refused'}")
+
+    def submit(self, hh, finalize=False, from_ui=False):
+        # Queue up PSBT for signing, using auth values given so far: those in the web UI
+        # if from there, else those already in item (REST API). Returns a future which
+        # will have the signed result.
+        from persist import settings
+        from conn import POOL
+        import policy
+
+        item = self.items[hh]
+
+        assert item.state not in (SIGNING, DONE), "already " + item.state
+        assert not (item._job and not item._job.done()), "already submitted"
+
+        dev = POOL.pick(item._raw)
+        pred = self.predict(hh, dev, from_ui)
+        item.prediction = dict(zip(('verdict', 'rule', 'reason'), pred)) if pred else None
+        if pred and pred[0] == policy.REFUSE and settings.POLICY_PRECHECK:
+            # leave auth values as they are; they may want to add more
+            self.policy_check['bounced'] += 1
+            self.publish()
+            logging.info(f"Bounced PSBT {hh}: {pred[2]}")
+            raise WouldRefuse(pred[2])
+
+        if from_ui and self.current == hh:
+            # capture auth values entered; the UI will start again w/ fresh slots
+            item.pending_auth, item._auth_guess = STATUS.pending_auth, STATUS._auth_guess
+            STATUS.reset_pending_auth()
+
+        # if we predicted, it must be signed where we predicted for; else pick when it's time
+        fut = item._job = asyncio.get_running_loop().create_future()
+        self.jobs.put_nowait((item, finalize, fut, time.time(), dev if pred else None))
+        self.publish()
+
+        return fut
+
+    async def run(self):
+        # One worker per Coldcard, so they are all kept busy
+        from conn import POOL
+
+        await asyncio.gather(*[self.worker() for i in range(max(1, len(POOL.devices)))])
+
+    async def worker(self):
+        # Drain the queue, one after another, so the Coldcard is never idle.
+        while 1:
+            item, finalize, fut, queued_at, dev = await self.jobs.get()
+
+            if fut.done() or item.hash not in self.items or item.state not in (QUEUED, PREVIEWED):
+                # cancelled, removed, or somehow already done
+                if not fut.done():
+                    fut.set_exception(RuntimeError("PSBT is " + item.state))
+                continue
+
+            item.wait_time = time.time() - queued_at
+            item.set_state(SIGNING)
+            self.active += 1
+            STATUS.busy_signing = True
+            self.publish()
+            STATUS.notify_watchers()
+
+            try:
+                result = await self.sign_one(item, finalize, dev)
+                if not fut.cancelled():
+                    fut.set_result(result)
+            except Exception as exc:
+                if not fut.cancelled():
+                    fut.set_exception(exc)
+            finally:
+                self.active -= 1
+                STATUS.busy_signing = bool(self.active)
+                self.publish()
+                STATUS.notify_watchers()
+
+    async def sign_one(self, item, finalize, dev=None):
+        from conn import POOL, PHASE_TIMES
+        from ckcc.protocol import CCUserRefused
+        from artifacts import ARTIFACTS
+        from velocity import VELOCITY
+        import history, policy
+
+        # least-busy Coldcard that knows the keys, unless one was chosen already;
+        # auth and signing must be on same one
+        dev = dev or POOL.pick(item._raw)
+        started = time.time()
+
+        # for the history: who authorized it, and how long each step took
+        authed = []
+        timings = {}
+        PHASE_TIMES.set(timings)
+
+        def record(outcome, result=None, error=None):
+            return self.record_history(item, dev, finalize, started, authed, timings,
+                                            outcome, result, error)
+
+        async with dev.working():
+            try:
+                # do auth steps first (no feedback given)
+                for pa, guess in zip(item.pending_auth or [], item._auth_guess or []):
+                    if pa.name and guess:
+                        await dev.user_auth(pa.name, guess, int(pa.totp), a2b_hex(item.hash))
+                        authed.append(pa.name)
+
+                # auth values are single use
+                item.pending_auth = item._auth_guess = None
+
+                result = await dev.sign_psbt(item._raw, finalize=finalize)
+
+            except CCUserRefused:
+                h = await dev.hsm_status()
+                item.refusal = h.get('last_refusal', None)
+                item.set_state(REFUSED, error=item.refusal)
+                self.check_prediction(item, False)
+                await record(history.REFUSED, error=item.refusal)
+                raise
+            except Exception as exc:
+                # device gone, etc. They can try again.
+                item.set_state(QUEUED, error=str(exc) or type(exc).__name__)
+                await record(history.FAILED, error=str(exc) or type(exc).__name__)
+                raise
+            except:
+                item.set_state(QUEUED)
+                raise
+
+        item.sign_time = time.time() - started
+        item.signer = dev.xfp
+        item.finalized = finalize
+        item.set_state(DONE, signer=dev.xfp, finalized=finalize)
+
+        self.count += 1
+        self.total_sign_time += item.sign_time
+
+        logging.info("Done signing %s in %.1f seconds (waited %.1f)" % (
+                            item.hash, item.sign_time, item.wait_time))
+
+        # Coldcard has signed it: nothing after this may lose the result
+        h = None
+        try:
+            # new totals for velocity come with this, if Coldcard shares them
+            h = await dev.hsm_status()
+        except Exception:
+            logging.error("Unable to refresh HSM status after signing", exc_info=1)
+
+        try:
+            self.check_prediction(item, True)
+
+            pred = item.prediction
+            if dev.primary and pred and pred['verdict'] == policy.APPROVE \
+                        and pred['rule'] is not None and (h or {}).get('has_spent') is None:
+                # Coldcard didn't tell us: count only what is surely sent. Outputs
+                # which claim to be ours might be change; Coldcard knows, we can't.
+                VELOCITY.record(pred['rule'], sum(o['value'] for o in item._decoded['outputs']
+                                                        if not o['claimed']))
+        except Exception:
+            logging.error("Unable to track velocity", exc_info=1)
+
+        try:
+            await record(history.SIGNED, result=result)
+        except Exception:
+            logging.error("Unable to record signing history", exc_info=1)
+
+        try:
+            # so it can be downloaded again
+            await ARTIFACTS.put(item.hash, dev.xfp, 0, finalize, result)
+        except Exception:
+            logging.error("Unable to cache signed result", exc_info=1)
+
+        return result
+
+    async def record_history(self, item, dev, finalize, started, authed, timings,
+                                    outcome, result, error):
+        # add what happened to the signing history
+        from history import HISTORY
+        from txn import parse_txn, psbt_unsigned_txn
+
+        entry = dict(ts=int(started), outcome=outcome, psbt_hash=item.hash, size=item.size,
+                        finalize=finalize, signer=dev.xfp, users=authed, error=error,
+                        wait_time=item.wait_time, sign_time=round(time.time() - started, 3),
+                        timings=timings)
+
+        try:
+            # outputs (and txid, if we know it)
+            t = parse_txn(result) if (finalize and result) else psbt_unsigned_txn(item._raw)
+            if finalize and result:
+                entry['txid'] = t.txid
+            entry['outputs'] = [dict(value=o.value, script=o.script.hex()) for o in t.outputs]
+            entry['destinations'] = [o.script.hex() for o in t.outputs]
+            if item._decoded:
+                # so they can be found by address too
+                entry['destinations'] += [o['address'] for o in item._decoded['outputs']
+                                                if o['address']]
+
+                # what's being spent, for backtest.py
+                entry['sending'] = item._decoded['sending']
+                entry['dest_addrs'] = [o['address'] or o['script']
+                                for o in item._decoded['outputs'] if not o['change']]
+        except Exception as exc:
+            logging.warning(f"Unable to decode txn for history: {exc}")
+
+        await HISTORY.record(entry)
+
+# singleton
+SIGQ = SigningQueue()
+
+# EOF
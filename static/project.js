@@ -84,6 +84,9 @@ ready(function() {
         var WS = new WebSocket( (location.protocol == 'http:' ? 'ws://' : 'wss://') 
                                     + location.host + window.WEBSOCKET_URL);
         var keepalive = 0;
+        var last_status = null;
+        var next_req = 1;
+        var when_done = {};
         
         WS.onopen = function(e) {
 
@@ -100,6 +103,14 @@ ready(function() {
             var r = JSON.parse(e.data);
             if(r.keepalive) return;
 
+            if(r._done) {
+                // request has finished; responses (if any) came before this
+                var fn = when_done[r._done];
+                delete when_done[r._done];
+                if(fn) fn(r.ok);
+                return;
+            }
+
             if(r.show_modal) {
                 // show a modal
                 var el = $(r.selector);
@@ -135,6 +146,19 @@ ready(function() {
                 download(r.local_download.filename, data)
             }
 
+            // status updates: first is complete, later ones are just the changes
+            if(r.vue_app_cb && r.vue_app_cb.update_status) {
+                last_status = r.vue_app_cb.update_status;
+            }
+            if(r.status_patch && last_status) {
+                var st = Object.assign({}, last_status, r.status_patch);
+                delete st._deleted;
+                r.status_patch._deleted.forEach(function(k) { delete st[k]; });
+                last_status = st;
+
+                window.vue_app_cb({update_status: st});
+            }
+
             // send data back to VUE code
             if(r.vue_app_cb) {
                 window.vue_app_cb(r.vue_app_cb)
@@ -156,9 +180,25 @@ ready(function() {
         WS.onerror = done;
         WS.onclose = done;
 
-        window.WEBSOCKET = function(action) {       // accepts varargs
+        window.WEBSOCKET = function(action) {       // accepts varargs; returns request id
             let args = Array.prototype.slice.call(arguments, 1);
-            WS.send(JSON.stringify({action: action, args: args}));
+            let rid = next_req++;
+            WS.send(JSON.stringify({action: action, args: args, _req: rid}));
+            return rid;
+        }
+        window.WEBSOCKET_DONE = function(rid, fn) {
+            // call fn(ok) when request is finished (requests run at same time, so
+            // can finish in any order)
+            when_done[rid] = fn;
+        }
+        window.WEBSOCKET_BINARY = function(buf) {
+            // send binary frame; returns bytes still waiting to go out
+            if(WS.readyState != WebSocket.OPEN) return -1;
+            WS.send(buf);
+            return WS.bufferedAmount;
+        }
+        window.WEBSOCKET_BUFFERED = function() {
+            return WS.bufferedAmount;
         }
     }
 
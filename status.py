@@ -1,12 +1,11 @@
 #
 # Store and watch all **status** values in system. 
 #
-import sys, logging, asyncio
+import sys, logging, asyncio, time, json
 from pprint import pprint, pformat
 from decimal import Decimal
 from chrono import NOW
 from objstruct import ObjectStruct
-from hashlib import sha256
 from copy import deepcopy
 from utils import WatchableMixin
 
@@ -22,6 +21,9 @@ class SystemStatus(WatchableMixin, ObjectStruct):
         self.connected = False
         self.serial_number = None
 
+        # health of each Coldcard in pool (see conn.DevicePool)
+        self.devices = []
+
         #self.xfp = None
 
         self.hsm = dict(users=[], wallets=[])            # short for "hsm_status"
@@ -42,8 +44,32 @@ class SystemStatus(WatchableMixin, ObjectStruct):
         self.psbt_size = None                # size of binary
         self.local_code = None               # string of 6 digits 
         self.psbt_preview = None             # text
+        self.psbt_preview_by = None          # 'local' or 'coldcard'
+        self.psbt_details = None             # amounts, fee (see psbt.decode_psbt)
         self.busy_signing = False
 
+        # signing latency histograms (see conn.record_latency)
+        self.latency = {}
+
+        # all PSBT waiting to be signed (see sigqueue.py)
+        self.psbt_queue = []
+        self.queue_stats = {}
+
+        # spent and remaining per HSM rule, this period (see velocity.py)
+        self.velocity = None
+
+        # our guesses at HSM policy outcome vs. the Coldcard's (see sigqueue.py)
+        self.policy_check = {}
+
+        # hits/misses etc. of cached Coldcard results (see artifacts.py)
+        self.artifact_cache = {}
+
+        # each server we broadcast txn to (see chain.Broadcaster)
+        self.broadcast = []
+
+        # txn we have broadcast, and their progress (see outbox.py)
+        self.outbox = []
+
         # tor related
         self.tord_good = False          # local tord control connection good
         self.onion_addr = None          # our present onion addr, if any
@@ -85,26 +111,14 @@ class SystemStatus(WatchableMixin, ObjectStruct):
         self.psbt_size = None
         self.local_code = None
         self.psbt_preview = None
+        self.psbt_preview_by = None
+        self.psbt_details = None
 
     def import_psbt(self, psbt):
-        from ckcc.utils import calc_local_pincode
-        from utils import cleanup_psbt
-        from binascii import b2a_hex
-
-        self.clear_psbt()
+        # add to signing queue, and select it for display
+        from sigqueue import SIGQ
 
-        self._pending_psbt = cleanup_psbt(psbt)
-
-        self.psbt_size = len(self._pending_psbt)
-
-        hh = sha256(self._pending_psbt).digest()
-        self.psbt_hash = b2a_hex(hh).decode('ascii')
-
-        # local PIN code will be wrong/stale now.
-        if self.hsm and self.hsm.get('next_local_code'):
-            self.local_code = calc_local_pincode(hh, self.hsm.next_local_code)
-
-        logging.info("Imported PSBT with hash: " + self.psbt_hash)
+        SIGQ.add(psbt)
 
     def as_dict(self):
         # we stream changes to web clients, so provide JSON
@@ -112,7 +126,121 @@ class SystemStatus(WatchableMixin, ObjectStruct):
                         for k in self.keys() if k[0] != '_' and not callable(self[k]))
 
 
+class StatusPublisher:
+    # Snapshot and JSON-encode the STATUS once per change, no matter how many
+    # web clients are watching. Each client gets only the values (top-level keys)
+    # which changed since the version it has, or everything if it's new.
+
+    HISTORY = 20            # versions of changes we remember, before full resync needed
+
+    def __init__(self):
+        from utils import ChangeCounter
+
+        self._counter = ChangeCounter()      # version == snapshot number
+        self.encoded = {}           # key => JSON text of value
+        self.changes = {}           # version => set of keys changed in that version
+        self._full_len = 0
+        self._msgs = {}             # version they have => message to send (for this version)
+        self.task = None
+
+        # measurements
+        self.snapshots = 0
+        self.encode_time = 0.0      # seconds, total
+        self.sends = 0
+        self.bytes_sent = 0
+        self.bytes_full = 0         # what we would have sent w/o deltas
+
+    def ensure_running(self):
+        if not self.task:
+            self.snapshot()
+            self.task = asyncio.create_task(self.run(STATUS.change_version()))
+
+    @property
+    def version(self):
+        return self._counter.version
+
+    async def run(self, seen):
+        # seen = version of STATUS captured in last snapshot
+        while 1:
+            try:
+                seen = await STATUS.wait(since=seen, timeout=120)
+            except asyncio.TimeoutError:
+                logging.info("Status push: %s" % self.stats())
+
+            self.snapshot()
+
+    def snapshot(self):
+        # encode each value; returns True if anything changed
+        from utils import json_dumps
+
+        t = time.perf_counter()
+        now = dict((k, json_dumps(v)) for k,v in STATUS.items()
+                            if k[0] != '_' and not callable(v))
+
+        changed = set(k for k in now if self.encoded.get(k) != now[k])
+        changed.update(k for k in self.encoded if k not in now)
+
+        self.encode_time += time.perf_counter() - t
+        self.snapshots += 1
+
+        if not changed:
+            return False
+
+        # keep the old strings when unchanged; compare is cheaper next time
+        for k in now:
+            if k not in changed:
+                now[k] = self.encoded[k]
+
+        self.encoded = now
+        self._full_len = sum(len(k) + len(v) + 4 for k,v in now.items()) + 32
+        self._msgs.clear()
+
+        ver = self.version + 1
+        self.changes[ver] = changed
+        self.changes.pop(ver - self.HISTORY, None)
+        self._counter.bump()
+
+        return True
+
+    async def wait_newer(self, version, timeout=None):
+        # block until there is something newer than version
+        return await self._counter.wait_newer(version, timeout)
+
+    def message_since(self, version):
+        # Returns (new version, text to send) to bring client at version up to date.
+        # - version=None for clients who have nothing yet
+        if version not in self._msgs:
+            if version is None or (version + 1) not in self.changes:
+                msg = '{"vue_app_cb":{"update_status":{%s}}}' % ','.join(
+                            '%s:%s' % (json.dumps(k), v) for k,v in self.encoded.items())
+            else:
+                keys = set()
+                for v in range(version+1, self.version+1):
+                    keys.update(self.changes[v])
+                gone = [k for k in keys if k not in self.encoded]
+                msg = '{"status_patch":{%s}}' % ','.join(
+                            ['%s:%s' % (json.dumps(k), self.encoded[k])
+                                                    for k in keys if k in self.encoded]
+                            + ['"_deleted":%s' % json.dumps(gone)])
+
+            self._msgs[version] = msg
+
+        msg = self._msgs[version]
+
+        self.sends += 1
+        self.bytes_sent += len(msg)
+        self.bytes_full += self._full_len
+
+        return self.version, msg
+
+    def stats(self):
+        return dict(version=self.version, snapshots=self.snapshots,
+                    encode_ms=round(self.encode_time * 1000, 1), sends=self.sends,
+                    kbytes_sent=round(self.bytes_sent / 1024, 1),
+                    kbytes_saved=round((self.bytes_full - self.bytes_sent) / 1024, 1))
+
 # singleton
 STATUS = SystemStatus()
+PUBLISHER = StatusPublisher()
 
 # EOF
@@ -0,0 +1,94 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# txn.py -- just enough Bitcoin transaction parsing for our needs: txid, outputs, size.
+#
+import io, struct, logging
+from hashlib import sha256
+from binascii import b2a_hex
+from objstruct import ObjectStruct
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+def dsha256(b):
+    return sha256(sha256(b).digest()).digest()
+
+def read_varint(fd):
+    n = fd.read(1)[0]
+    if n < 0xfd:
+        return n
+    sz = {0xfd: 2, 0xfe: 4, 0xff: 8}[n]
+    return int.from_bytes(fd.read(sz), 'little')
+
+def read_exact(fd, n):
+    rv = fd.read(n)
+    if len(rv) != n:
+        raise ValueError("truncated")
+    return rv
+
+def parse_txn(raw):
+    # Decode a serialized transaction (with or without witness data).
+    # Returns ObjectStruct w/ txid, inputs, outputs, and size details.
+    fd = io.BytesIO(raw)
+
+    version = read_exact(fd, 4)
+
+    segwit = (raw[4:6] == b'\x00\x01')
+    if segwit:
+        fd.read(2)
+
+    body_start = fd.tell()
+
+    inputs = []
+    for i in range(read_varint(fd)):
+        prev_txid = read_exact(fd, 32)[::-1]
+        prev_index, = struct.unpack('<I', read_exact(fd, 4))
+        script = read_exact(fd, read_varint(fd))
+        sequence, = struct.unpack('<I', read_exact(fd, 4))
+        inputs.append(ObjectStruct(prev_txid=b2a_hex(prev_txid).decode('ascii'),
+                            prev_index=prev_index, script=script, sequence=sequence))
+
+    outputs = []
+    for i in range(read_varint(fd)):
+        value, = struct.unpack('<q', read_exact(fd, 8))
+        script = read_exact(fd, read_varint(fd))
+        outputs.append(ObjectStruct(value=value, script=script))
+
+    body_end = fd.tell()
+
+    if segwit:
+        # witness stack for each input; we just skip over it
+        for inp in inputs:
+            for j in range(read_varint(fd)):
+                read_exact(fd, read_varint(fd))
+
+    locktime, = struct.unpack('<I', read_exact(fd, 4))
+
+    if fd.read(1):
+        raise ValueError("junk after txn")
+
+    # txid hashes the txn without witness data
+    stripped = version + raw[body_start:body_end] + raw[-4:]
+    txid = dsha256(stripped)[::-1]
+
+    weight = (len(stripped) * 3) + len(raw)
+
+    return ObjectStruct(txid=b2a_hex(txid).decode('ascii'), version=int.from_bytes(version, 'little'),
+                        inputs=inputs, outputs=outputs, locktime=locktime, segwit=segwit,
+                        size=len(raw), weight=weight, vsize=(weight + 3) // 4)
+
+def psbt_unsigned_txn(psbt):
+    # The unsigned txn inside a (binary) PSBT: first thing in global section.
+    fd = io.BytesIO(psbt)
+    if fd.read(5) != b'psbt\xff':
+        raise ValueError("not a PSBT")
+
+    while 1:
+        klen = read_varint(fd)
+        if not klen:
+            raise ValueError("no unsigned txn")
+        key = read_exact(fd, klen)
+        val = read_exact(fd, read_varint(fd))
+        if key == b'\x00':
+            return parse_txn(val)
+
+# EOF
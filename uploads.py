@@ -0,0 +1,171 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# uploads.py -- big files (PSBT) coming from the browser, in chunks, over the websocket.
+#
+# - browser sends "upload_begin" action with size and sha256, and we reply with how
+#   much we already have (zero, unless resuming)
+# - then binary frames: sha256 (32 bytes), offset (8 bytes, big-endian), and data
+# - data goes straight into a buffer of the right size, and is hashed as it arrives
+# - partial uploads are kept a while, by hash, so if Tor drops the connection, the
+#   browser can connect again and continue from where it got to
+#
+import logging, struct, time
+from hashlib import sha256
+from binascii import b2a_hex
+from collections import OrderedDict
+from utils import Singleton
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+HEADER_LEN = 32 + 8
+
+class Upload:
+    # One file, being received
+
+    def __init__(self, size, digest):
+        self.size = size
+        self.digest = digest
+        self.buf = bytearray(size)
+        self.received = 0
+        self.hasher = sha256()
+        self.touched = time.time()
+
+    def write(self, offset, chunk):
+        # Add some data; must be in order. Returns True when we have it all.
+        self.touched = time.time()
+        end = offset + len(chunk)
+
+        if end <= self.received:
+            # already have it: resent after a resume
+            return False
+        if offset < self.received:
+            # partly new: keep just the part we don't have
+            chunk = chunk[self.received - offset:]
+            offset = self.received
+        if offset != self.received:
+            raise ValueError(f"Upload out of order: got {offset}, expected {self.received}")
+        if end > self.size:
+            raise ValueError("Upload is bigger than expected")
+
+        self.buf[offset:end] = chunk
+        self.hasher.update(chunk)
+        self.received = end
+
+        return end == self.size
+
+    def result(self):
+        # The file, once checked; caller gets our buffer (not a copy)
+        if self.hasher.hexdigest() != self.digest:
+            raise ValueError("Upload corrupted in transit")
+        return self.buf
+
+class UploadManager(metaclass=Singleton):
+
+    def __init__(self):
+        self.uploads = OrderedDict()        # digest (hex) => Upload, oldest first
+
+    def expire(self, incoming=0):
+        # forget those not touched in a while, or oldest ones if too much data pending
+        from persist import settings
+
+        old = time.time() - settings.UPLOAD_KEEP_TIME
+        for d, u in list(self.uploads.items()):
+            if u.touched < old:
+                del self.uploads[d]
+
+        while self.uploads and \
+                (sum(u.size for u in self.uploads.values()) + incoming) > settings.UPLOAD_MAX_PENDING:
+            d, u = self.uploads.popitem(last=False)
+            logging.warning(f"Dropped partial upload {d} ({u.received} of {u.size} bytes)")
+
+    def begin(self, size, digest):
+        # Start (or resume) an upload; returns how many bytes we already have
+        from persist import settings
+
+        digest = digest.lower()
+        assert len(digest) == 64, "bad hash"
+        assert 0 < size <= settings.MAX_UPLOAD_SIZE, f"File too big (max {settings.MAX_UPLOAD_SIZE})"
+
+        u = self.uploads.get(digest)
+        if u and u.size == size:
+            self.uploads.move_to_end(digest)
+            u.touched = time.time()
+            logging.info(f"Resuming upload {digest} at {u.received} of {size} bytes")
+            return u.received
+
+        self.uploads.pop(digest, None)
+        self.expire(incoming=size)
+        self.uploads[digest] = Upload(size, digest)
+
+        return 0
+
+    def write(self, frame):
+        # Handle binary frame. Returns (Upload, done) or raises.
+        assert len(frame) > HEADER_LEN, "short frame"
+
+        digest = b2a_hex(frame[0:32]).decode('ascii')
+        offset, = struct.unpack('>Q', frame[32:HEADER_LEN])
+
+        u = self.uploads.get(digest)
+        if not u:
+            raise ValueError("Upload not started (or expired)")
+
+        try:
+            done = u.write(offset, memoryview(frame)[HEADER_LEN:])
+        except ValueError:
+            self.uploads.pop(digest, None)
+            raise
+
+        if done:
+            del self.uploads[digest]
+
+        return u, done
+
+# singleton
+UPLOADS = UploadManager()
+
+if __name__ == '__main__':
+    # Benchmark: 10MB file in 32k chunks, dropped half way and resumed
+    #   python uploads.py [size]
+    import sys, os
+    from persist import Settings
+    Settings.startup()
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10*1024*1024
+    data = os.urandom(size)
+    digest = sha256(data).digest()
+    chunk = 32*1024
+
+    def frames(start):
+        for pos in range(start, size, chunk):
+            yield digest + struct.pack('>Q', pos) + data[pos:pos+chunk]
+
+    t = time.perf_counter()
+    assert UPLOADS.begin(size, digest.hex()) == 0
+    for i, f in enumerate(frames(0)):
+        UPLOADS.write(f)
+        if i == (size // chunk) // 2:
+            break               # connection lost
+
+    start = UPLOADS.begin(size, digest.hex())
+    print(f"resume at {start} of {size}")
+    for f in frames(max(0, start - chunk)):     # some overlap
+        u, done = UPLOADS.write(f)
+
+    assert done and u.result() == data
+    dt = time.perf_counter() - t
+    print(f"{size} bytes in {dt:.3f}s: {size/dt/1E6:.0f} MB/s")
+
+    # resent chunks that only partly overlap what we have
+    UPLOADS.uploads.clear()
+    UPLOADS.begin(size, digest.hex())
+    for pos in range(0, size, chunk):
+        # part of it (not the very end), then all of it again
+        part = min(chunk//3, size - pos - 1)
+        if part:
+            UPLOADS.write(digest + struct.pack('>Q', pos) + data[pos:pos+part])
+        u, done = UPLOADS.write(digest + struct.pack('>Q', pos) + data[pos:pos+chunk])
+    assert done and u.result() == data
+    print("partial overlaps: ok")
+
+# EOF
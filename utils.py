@@ -97,22 +97,150 @@ def cleanup_psbt(psbt):
 
     return psbt
 
+_WORKERS = None
+
+def worker_processes():
+    # Shared pool of other processes, for CPU-heavy work (captchas, big PSBT files).
+    # - "spawn" so they don't inherit our threads, sockets and event loop
+    # - started again if a worker died (pool is useless after that)
+    global _WORKERS
+
+    if not _WORKERS or _WORKERS._broken:
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        from persist import settings
+
+        _WORKERS = ProcessPoolExecutor(max_workers=settings.WORKER_PROCESSES,
+                                        mp_context=multiprocessing.get_context('spawn'))
+    return _WORKERS
+
+class Histogram:
+    # Count of durations (seconds) in fixed buckets; for latency stats that
+    # can be shown as-is in the web UI.
+    BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)     # last one is overflow
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, dt):
+        idx = 0
+        while idx < len(self.BUCKETS) and dt > self.BUCKETS[idx]:
+            idx += 1
+
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += dt
+        self.max = max(self.max, dt)
+
+    def as_dict(self):
+        return dict(count=self.count, max=round(self.max, 3),
+                    avg=round(self.total / self.count, 3) if self.count else None,
+                    buckets=self.BUCKETS, counts=self.counts)
+
+class ChangeCounter:
+    # Generation counter for change notification. Each change bumps the version,
+    # and watchers ask for "anything newer than version N?" so they never miss
+    # a change, even if they weren't waiting at that moment. A burst of changes
+    # (without yielding to event loop) wakes each watcher just once.
+
+    def __init__(self):
+        self.version = 0
+        self._waiters = set()
+        self._wake_soon = False
+
+    def bump(self):
+        self.version += 1
+
+        if self._waiters and not self._wake_soon:
+            try:
+                asyncio.get_running_loop().call_soon(self._wake)
+                self._wake_soon = True
+            except RuntimeError:
+                # no event loop running (startup code)
+                self._wake()
+
+    def _wake(self):
+        self._wake_soon = False
+        waiters, self._waiters = self._waiters, set()
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(self.version)
+
+    async def wait_newer(self, version, timeout=None):
+        # Block until version is greater than the one given, and return
+        # the new version. Raises asyncio.TimeoutError if timeout given.
+        while self.version <= version:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.add(fut)
+            try:
+                await asyncio.wait_for(fut, timeout)
+            finally:
+                self._waiters.discard(fut)
+
+        return self.version
+
 class WatchableMixin:
     # add a consistent way to block for changes on an object
 
     def __init__(self, *a, **k):
-        self._update_event = asyncio.Event()
+        self._changes = ChangeCounter()
         super(WatchableMixin, self).__init__(*a,**k)
 
     def notify_watchers(self):
         # unblock anyone watching us
-
-        self._update_event.set()
-        self._update_event.clear()
-
-    async def wait(self):
-        await self._update_event.wait()
-        return self
-
+        self._changes.bump()
+
+    def change_version(self):
+        # use this version number as the "since" value for wait()
+        return self._changes.version
+
+    async def wait(self, since=None, timeout=None):
+        # Block until something changes after version "since" (default: now),
+        # and return the new version number.
+        if since is None:
+            since = self._changes.version
+        return await self._changes.wait_newer(since, timeout)
+
+
+if __name__ == '__main__':
+    # Stress test for ChangeCounter: many watchers, thousands of rapid changes
+    import time
+
+    async def stress(num_watchers=200, num_changes=20000, burst=50):
+        cc = ChangeCounter()
+        wakeups = [0] * num_watchers
+        seen = [0] * num_watchers
+
+        async def watcher(idx):
+            v = 0
+            while v < num_changes:
+                v = await cc.wait_newer(v)
+                wakeups[idx] += 1
+                seen[idx] = v
+                if idx % 3 == 0:
+                    # slow watcher: busy elsewhere while changes happen
+                    await asyncio.sleep(0.001)
+
+        tasks = [asyncio.create_task(watcher(i)) for i in range(num_watchers)]
+        await asyncio.sleep(0)
+
+        t = time.perf_counter()
+        for n in range(num_changes):
+            cc.bump()
+            if n % burst == 0:
+                await asyncio.sleep(0)
+
+        await asyncio.wait_for(asyncio.gather(*tasks), 60)
+        dt = time.perf_counter() - t
+
+        assert all(v == num_changes for v in seen), "missed final change"
+        print(f"{num_changes} changes, {num_watchers} watchers: {dt:.2f}s, "
+                f"wakeups per watcher: min {min(wakeups)} max {max(wakeups)} "
+                f"(bursts: {num_changes // burst})")
+
+    asyncio.run(stress())
 
 # EOF
@@ -0,0 +1,174 @@
+# Copyright 2020 by Coinkite Inc. This file is covered by license found in COPYING-CC.
+#
+# velocity.py -- how much each HSM rule has spent this period, and how much is left.
+#
+# Mirrors what the Coldcard does: there is one period for all rules, which starts when
+# a rule with a per-period limit is first used, and at the end, all totals go to zero.
+# - we record what we sign, so it works even with "privacy over UX"
+# - when the Coldcard does share its totals (has_spent, period_ends), we follow those
+# - each event is O(1): running total per rule, nothing is rescanned
+#
+import logging, time
+from collections import deque
+from utils import Singleton
+from status import STATUS
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+class RuleLedger:
+    # Spending by one rule, during the current period
+
+    def __init__(self, limit):
+        self.limit = limit          # satoshis per period, or None
+        self.events = deque()       # (time, amount)
+        self.total = 0
+
+    def add(self, ts, amount):
+        self.events.append((ts, amount))
+        self.total += amount
+
+    def expire(self, before):
+        # forget events older than that
+        while self.events and self.events[0][0] < before:
+            self.total -= self.events.popleft()[1]
+
+    @property
+    def remaining(self):
+        if self.limit is None:
+            return None
+        return max(0, self.limit - self.total)
+
+class VelocityLedger(metaclass=Singleton):
+
+    def __init__(self):
+        self.rules = []
+        self.period = None          # seconds, from policy
+        self.period_start = None    # when current period started (our clock), if it has
+        self._policy = None
+
+    def setup(self):
+        # (re)build for current policy in BP; None if we don't know it
+        from persist import BP
+
+        pol = BP.get('policy')
+        if pol is self._policy:
+            return bool(pol)
+
+        self._policy = pol
+        self.rules = [RuleLedger(r.get('per_period')) for r in (pol or {}).get('rules', [])]
+        self.period = (pol.get('period') or 0) * 60 if pol else None
+        self.period_start = None
+
+        return bool(pol)
+
+    @property
+    def period_ends(self):
+        if self.period_start is None or not self.period:
+            return None
+        return self.period_start + self.period
+
+    def roll(self, now):
+        # at end of period, everything resets
+        ends = self.period_ends
+        if ends is not None and now >= ends:
+            for r in self.rules:
+                r.expire(ends)
+            self.period_start = None
+
+    def record(self, rule_idx, amount, now=None):
+        # Coldcard approved a txn using this rule
+        now = now or time.time()
+        if not self.setup() or not (0 <= rule_idx < len(self.rules)):
+            return
+
+        self.roll(now)
+
+        r = self.rules[rule_idx]
+        if r.limit is None:
+            return
+
+        if self.period_start is None:
+            self.period_start = now
+        r.add(now, amount)
+
+        self.publish(now)
+
+    def sync(self, hsm, fetched_at):
+        # Coldcard has told us its status; it knows best.
+        if not self.setup() or hsm.get('has_spent') is None:
+            return
+
+        now = fetched_at or time.time()
+        self.roll(now)
+
+        ends = hsm.get('period_ends')
+        if ends and self.period:
+            self.period_start = now + ends - self.period
+        elif not any(hsm.has_spent):
+            self.period_start = None
+
+        for r, spent in zip(self.rules, hsm.has_spent):
+            if spent != r.total:
+                # something we didn't see, or period ended: make totals match
+                if not spent:
+                    r.events.clear()
+                    r.total = 0
+                else:
+                    r.add(now, spent - r.total)
+
+        self.publish(now)
+
+    def spent(self):
+        # totals per rule, as of now; None if policy unknown
+        if not self.setup():
+            return None
+        self.roll(time.time())
+        return [r.total for r in self.rules]
+
+    def summary(self, now=None):
+        if not self.setup():
+            return None
+
+        self.roll(now or time.time())
+        return dict(period=self.period, period_ends=self.period_ends,
+                        rules=[dict(limit=r.limit, spent=r.total, remaining=r.remaining,
+                                count=len(r.events)) for r in self.rules])
+
+    def publish(self, now=None):
+        STATUS.velocity = self.summary(now)
+
+# singleton
+VELOCITY = VelocityLedger()
+
+if __name__ == '__main__':
+    # Benchmark: lots of spending events, over many periods
+    #   python velocity.py [count]
+    import sys
+    from objstruct import ObjectStruct
+    from persist import Settings
+    Settings.startup()
+    from persist import BP
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    BP['policy'] = dict(period=60, rules=[dict(per_period=10**8), dict(per_period=None),
+                                          dict(per_period=5*10**7)])
+
+    t0 = 1E9
+    t = time.perf_counter()
+    for i in range(count):
+        VELOCITY.record(i % 3, 1000, now=t0 + i)
+    dt = time.perf_counter() - t
+    print(f"{count} events in {dt:.2f}s: {1E6*dt/count:.2f}us each")
+
+    # one period is 3600 events; we're part way thru the last one
+    s = VELOCITY.summary(t0 + count)
+    n = count % 3600 or 3600
+    assert s['rules'][0]['spent'] == 1000 * len(range(0, n, 3)), s
+    print(s)
+
+    # Coldcard says something else
+    VELOCITY.sync(ObjectStruct(has_spent=[5, 0, 7], period_ends=100), t0 + count)
+    assert [r['spent'] for r in VELOCITY.summary(t0 + count)['rules']] == [5, 0, 7]
+
+# EOF
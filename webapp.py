@@ -2,10 +2,11 @@
 #
 # A web server.
 #
-import sys, os, asyncio, logging, aiohttp_jinja2, jinja2, time, weakref, re
+import sys, os, asyncio, logging, aiohttp_jinja2, jinja2, time, re
+from functools import partial
 from aiohttp import web
 from yarl import URL
-from conn import Connection, MissingColdcard
+from conn import POOL, MissingColdcard
 from ckcc.protocol import CCProtocolPacker
 from utils import pformat_json, json_loads, json_dumps, cleanup_psbt
 from objstruct import ObjectStruct
@@ -14,17 +15,22 @@ from decimal import Decimal
 import aiohttp_session
 from aiohttp_session import get_session, new_session
 from base64 import b32encode, b64decode, b64encode
-from binascii import b2a_hex, a2b_hex
+from binascii import b2a_hex
 from status import STATUS
+from sigqueue import SIGQ, DONE, WouldRefuse
+from artifacts import ARTIFACTS
+from uploads import UPLOADS, HEADER_LEN
+from dispatch import Dispatcher, TooBusy
+from fanout import FANOUT
 from persist import settings, BP
 from hashlib import sha256
-from chain import broadcast_txn
+from outbox import OUTBOX
 from version import VERSION
 try:
     from jinja2 import Markup, escape
 except ImportError:
     from markupsafe import Markup, escape
-import policy
+import policy, restapi
 
 from ckcc.constants import USER_AUTH_TOTP, USER_AUTH_HMAC, USER_AUTH_SHOW_QR, MAX_USERNAME_LEN
 from ckcc.constants import STXN_VISUALIZE, STXN_SIGNED, AF_P2WPKH, AF_CLASSIC
@@ -34,7 +40,6 @@ logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 routes = web.RouteTableDef()
 
-web_sockets = weakref.WeakSet()
 
 class HTMLErrorMsg(ValueError):
     def __init__(self, html):
@@ -96,9 +101,9 @@ async def homepage(request):
 async def setup_page(request):
     # HSM policy setup
 
-    # get latest status
-    dev = Connection()
-    await dev.hsm_status()
+    # get latest status (or recent enough)
+    dev = POOL.primary
+    await dev.hsm_status(max_age=settings.HSM_STATUS_MAX_AGE)
 
     return await add_shared_ctx(request)
 
@@ -108,9 +113,9 @@ async def bunker_page(request):
 
     # Bunker config and setup
 
-    # get latest status
-    dev = Connection()
-    await dev.hsm_status()
+    # get latest status (or recent enough)
+    dev = POOL.primary
+    await dev.hsm_status(max_age=settings.HSM_STATUS_MAX_AGE)
 
     from torsion import TOR
 
@@ -256,69 +261,47 @@ async def captcha_image(request):
     if ses.new:
         return HTTPNotFound()
 
-    from make_captcha import RansomCaptcha, MegaGifCaptcha, TOKEN_CHARS
-    import random
+    from make_captcha import CAPTCHAS
+
+    easy = BP.get('easy_captcha', settings.EASY_CAPTCHA)
 
     if 'captcha' in ses:
-        # dont let them retry?
+        # dont let them retry? redraw exactly the same one
         code = ses['captcha']
+        itype, data = await CAPTCHAS.render(code, easy)
     else:
-        code = ''.join(random.sample(TOKEN_CHARS, 8))
+        code, itype, data = await CAPTCHAS.take(easy)
         ses['captcha'] = code
 
-    easy = BP.get('easy_captcha', settings.EASY_CAPTCHA)
-    if easy:
-        itype, data = RansomCaptcha(seed=code).draw(code, foreground='#444')
-    else:
-        itype, data = MegaGifCaptcha(seed=code).draw(code, foreground='#444')
-
     return web.Response(body=data, content_type='image/'+itype, 
         headers = {'Cache-Control': 'no-cache'})
     
 
-async def rx_handler(ses, ws, orig_request):
-    # Block on receive, handle each message as it comes in.
+async def rx_handler(ses, ws, client, orig_request):
+    # Block on receive, start work on each message as it comes in (see dispatch.py).
+    # Replies go out via client's queue (see fanout.py), so we never wait on a slow browser.
     # see pp/aiohttp/client_ws.py
 
-    async def tx_resp(_ws=ws, **resp):
+    async def tx_resp(**resp):
         logging.debug(f"Send resp: {resp}")
-        await _ws.send_str(json_dumps(resp))
-
-
-    async for msg in ws:
-        if msg.type != web.WSMsgType.TEXT:
-            raise TypeError('expected text')
-
-        try:
-            assert len(msg.data) < 20000
-            req = json_loads(msg.data)
-
-            if '_ping' in req:
-                # connection keep alive, simple
-                await tx_resp(_pong=1)
-                continue
-
-            # Caution: lots of sensitive values here XXX
-            #logging.info("WS api data: %r" % req)
+        client.send(json_dumps(resp))
 
-        except Exception as e:
-            logging.critical("Junk data on WS", exc_info=1)
-            break # the connection
+    async def handle(req):
+        # one request, in its own task; responses have the request's id, if it had one
+        rid = req.get('_req')
+        send = tx_resp if rid is None else partial(tx_resp, _req=rid)
 
-        # do something with the request
         failed = True
         try:
-            await ws_api_handler(ses, tx_resp, req, orig_request)
+            await ws_api_handler(ses, send, req, orig_request)
             failed = False
-        except SystemExit:
+        except (SystemExit, KeyboardInterrupt, asyncio.CancelledError):
             raise
-        except KeyboardInterrupt:
-            break
         except HTMLErrorMsg as exc:
             # pre-formated text for display
             msg = exc.args[0]
         except RuntimeError as exc:
-            # covers CCProtoError and similar
+            # covers CCProtoError, TransferCancelled and similar
             msg = str(exc) or str(type(exc).__name__)
         except BaseException as exc:
             logging.exception("API fail: req=%r" % req)
@@ -326,31 +309,74 @@ async def rx_handler(ses, ws, orig_request):
 
         if failed:
             # standard error response
-            await tx_resp(show_modal=True, html=escape(msg), selector='.js-api-fail')
+            await send(show_modal=True, html=escape(msg), selector='.js-api-fail')
 
-async def push_status_updates_handler(ws):
-    # block for a bit, and then send display updates (and all other system status changes)
+        if rid is not None:
+            await tx_resp(_done=rid, ok=not failed)
 
-    # - there is no need for immediate update because when we rendered the HTML on page
-    #   load, we put in current values.
-    await asyncio.sleep(0.250)
+    dispatch = Dispatcher(handle, max_pending=settings.WS_MAX_PENDING)
+    try:
+        async for msg in ws:
+            if msg.type == web.WSMsgType.BINARY:
+                # part of a file upload; must be in order, and is quick
+                await rx_upload(tx_resp, msg.data)
+                continue
 
-    last = None
-    while 1:
-        # get latest state
-        now = STATUS.as_dict()
+            if msg.type != web.WSMsgType.TEXT:
+                raise TypeError('expected text')
 
-        if last != now:
-            # it has changed, so send it.
-            await ws.send_str(json_dumps(dict(vue_app_cb=dict(update_status=now))))
-            last = now
+            try:
+                assert len(msg.data) < 20000
+                req = json_loads(msg.data)
 
-        # wait until next update, or X seconds max (for keep alive/just in case)
-        try:
-            await asyncio.wait_for(STATUS._update_event.wait(), 120)
-        except asyncio.TimeoutError:
-            # force an update
-            last = None
+                if '_ping' in req:
+                    # connection keep alive, simple
+                    await tx_resp(_pong=1)
+                    continue
+
+                # Caution: lots of sensitive values here XXX
+                #logging.info("WS api data: %r" % req)
+
+            except Exception as e:
+                logging.critical("Junk data on WS", exc_info=1)
+                break # the connection
+
+            # do something with the request; don't wait for it
+            try:
+                dispatch.submit(req)
+            except TooBusy as exc:
+                await tx_resp(show_modal=True, html=escape(str(exc)), selector='.js-api-fail')
+    finally:
+        # connection closed; anything still running is of no use
+        await dispatch.close()
+
+async def rx_upload(tx_resp, frame):
+    # Binary frame with part of a file (see uploads.py); when complete, it's a PSBT to sign.
+    try:
+        upload, done = UPLOADS.write(frame)
+
+        # tell them how it's going, but not for every chunk
+        step = settings.UPLOAD_ACK_BYTES
+        before = upload.received - (len(frame) - HEADER_LEN)
+        if done or (upload.received // step) != (before // step):
+            await tx_resp(vue_app_cb=dict(upload_progress=dict(digest=upload.digest,
+                                            received=upload.received, size=upload.size)))
+        if not done:
+            return
+
+        STATUS.import_psbt(upload.result())
+        STATUS.notify_watchers()
+    except Exception as exc:
+        logging.error(f"Upload failed: {exc}")
+        await tx_resp(show_modal=True, html=escape(str(exc) or type(exc).__name__),
+                            selector='.js-api-fail')
+
+def signed_download(hh, finalize, result):
+    # signed txn (hex) or PSBT (base64) as a file for the browser to save
+    data = (b2a_hex(result) if finalize else b64encode(result)).decode('ascii')
+    fname = 'transaction.txt' if finalize else ('signed-%s.psbt' % hh[-6:])
+
+    return dict(data=data, filename=fname, is_b64=(not finalize))
 
 async def ws_api_handler(ses, send_json, req, orig_request):     # handle_api
     #
@@ -370,13 +396,13 @@ async def ws_api_handler(ses, send_json, req, orig_request):     # handle_api
         # can send special state update at this point, depending on the page
 
     elif action == 'start_hsm_btn':
-        await Connection().hsm_start()
+        await POOL.primary.hsm_start()
         await send_json(show_flash_msg=APPROVE_CTA)
         
     elif action == 'delete_user':
         name, = args
         assert 1 <= len(name) <= MAX_USERNAME_LEN, "bad username length"
-        await Connection().delete_user(name.encode('utf8'))
+        await POOL.primary.delete_user(name.encode('utf8'))
 
         # assume it worked, so UX updates right away
         try:
@@ -402,7 +428,7 @@ async def ws_api_handler(ses, send_json, req, orig_request):     # handle_api
         else:
             raise ValueError(authmode)
 
-        await Connection().create_user(name.encode('utf8'), mode, new_pw)
+        await POOL.primary.create_user(name.encode('utf8'), mode, new_pw)
 
         # assume it worked, so UX updates right away
         try:
@@ -419,7 +445,7 @@ async def ws_api_handler(ses, send_json, req, orig_request):     # handle_api
 
         policy.update_sl(proposed)
 
-        await Connection().hsm_start(proposed)
+        await POOL.primary.hsm_start(proposed)
 
         STATUS.notify_watchers()
 
@@ -436,6 +462,19 @@ async def ws_api_handler(ses, send_json, req, orig_request):     # handle_api
         await send_json(local_download=dict(data=json_dumps(proposed, indent=2),
                                 filename=f'hsm-policy-{STATUS.xfp}.json.txt'))
 
+    elif action == 'backtest_policy':
+        # what would this policy have done, with what we've signed before?
+        from history import HISTORY
+        import backtest
+
+        proposed = policy.web_cleanup(json_loads(args[0]))
+        txns = backtest.from_history(await HISTORY.export(), STATUS.is_testnet)
+        if not txns:
+            raise HTMLErrorMsg("No transactions in signing history to test with.")
+
+        r = backtest.backtest(proposed, txns)
+        await send_json(vue_app_cb=dict(backtest=r))
+
     elif action == 'import_policy':
         # they are uploading a JSON capture, but need values we can load in Vue
         proposed = args[0]
@@ -496,7 +535,9 @@ async def ws_api_handler(ses, send_json, req, orig_request):     # handle_api
         addr_fmt = AF_P2WPKH if addr_fmt != 'classic' else AF_CLASSIC
 
         try:
-            sig, addr = await Connection().sign_text_msg(msg_text, path, addr_fmt)
+            dev = POOL.pick()
+            async with dev.working():
+                sig, addr = await dev.sign_text_msg(msg_text, path, addr_fmt)
         except:
             # get the spinner to stop: error msg will be "refused by policy" typically
             await send_json(vue_app_cb=dict(msg_signing_result='(failed)'))
@@ -506,8 +547,53 @@ async def ws_api_handler(ses, send_json, req, orig_request):     # handle_api
 
         await send_json(vue_app_cb=dict(msg_signing_result=f'{sig}\n{addr}'))
 
+    elif action == 'velocity':
+        # how much can be spent now, per rule
+        from velocity import VELOCITY
+
+        await send_json(vue_app_cb=dict(velocity=VELOCITY.summary()))
+
+    elif action == 'history_query':
+        # page thru the signing history; filters given as an object
+        from history import HISTORY
+
+        q, = args
+        q = dict((k, v) for k, v in q.items() if v and k in
+                    ('before', 'outcome', 'dest', 'psbt_hash', 'txid', 'hash', 'since', 'until', 'limit'))
+
+        await send_json(vue_app_cb=dict(history=await HISTORY.query(**q)))
+
+    elif action == 'api_keys':
+        # keys for the REST API; never the secrets
+        await send_json(vue_app_cb=dict(api_keys=restapi.list_keys()))
+
+    elif action == 'api_key_create':
+        label, = args
+        label = (label or '').strip()[0:64]
+        assert label, "Need a label"
+
+        key_id, secret = restapi.create_key(label)
+        logging.warning(f"New API key: {key_id} ({label})")
+
+        # secret is shown just this once
+        await send_json(vue_app_cb=dict(api_keys=restapi.list_keys(),
+                                        api_new_key=dict(id=key_id, secret=secret)))
+
+    elif action == 'api_key_delete':
+        key_id, = args
+        restapi.delete_key(key_id)
+        logging.warning(f"Deleted API key: {key_id}")
+
+        await send_json(vue_app_cb=dict(api_keys=restapi.list_keys()))
+
+    elif action == 'upload_begin':
+        # about to send us a file, in binary chunks; maybe again, if connection dropped
+        size, digest = args
+        received = UPLOADS.begin(size, digest)
+        await send_json(vue_app_cb=dict(upload_resume=dict(digest=digest, received=received)))
+
     elif action == 'upload_psbt':
-        # receiving a PSBT for signing
+        # receiving a PSBT for signing (small ones only; see upload_begin)
 
         size, digest, contents = args
         psbt = b64decode(contents)
@@ -518,27 +604,55 @@ async def ws_api_handler(ses, send_json, req, orig_request):     # handle_api
         STATUS.notify_watchers()
 
     elif action == 'clear_psbt':
-        STATUS.clear_psbt()
+        # forget indicated PSBT (or current one)
+        hh = args[0] if args else STATUS.psbt_hash
+        SIGQ.remove(hh)
+        STATUS.notify_watchers()
+
+    elif action == 'select_psbt':
+        # show a different PSBT from the queue
+        hh, = args
+        assert SIGQ.get(hh), "unknown PSBT"
+        SIGQ.select(hh)
         STATUS.notify_watchers()
 
     elif action == 'preview_psbt':
-        STATUS.psbt_preview = 'Wait...'
+        hh = STATUS.psbt_hash
+        item = SIGQ.get(hh)
+        assert item, "no PSBT"
+
+        dev = POOL.pick(item._raw)
+        txt = await ARTIFACTS.get(hh, dev.xfp, STXN_VISUALIZE)
+        if txt is not None:
+            # same file, same Coldcard: it would say the same thing
+            SIGQ.set_preview(hh, txt.decode('utf8'))
+            STATUS.notify_watchers()
+            return
+
+        SIGQ.set_preview(hh, 'Wait...')
         STATUS.notify_watchers()
         try:
-            txt = await Connection().sign_psbt(STATUS._pending_psbt, flags=STXN_VISUALIZE)
+            async with dev.working():
+                txt = await dev.sign_psbt(item._raw, flags=STXN_VISUALIZE)
             txt = txt.decode('ascii')
             # force some line splits, especially for bech32, 32-byte values (p2wsh)
             probs = re.findall(r'([a-zA-Z0-9]{36,})', txt)
             for p in probs:
                 txt = txt.replace(p, p[0:30] + '\u22ef\n\u22ef' + p[30:])
-            STATUS.psbt_preview = txt
+            SIGQ.set_preview(hh, txt)
+            await ARTIFACTS.put(hh, dev.xfp, STXN_VISUALIZE, False, txt.encode('utf8'))
         except:
             # like if CC doesn't like the keys, whatever ..
-            STATUS.psbt_preview = None
+            SIGQ.set_preview(hh, None)
             raise
         finally:
             STATUS.notify_watchers()
 
+    elif action == 'cancel_transfer':
+        # stop any file upload/download in progress
+        for d in POOL.devices:
+            d.cancel_transfer()
+
     elif action == 'auth_set_name':
         idx, name = args
 
@@ -560,54 +674,51 @@ async def ws_api_handler(ses, send_json, req, orig_request):     # handle_api
         # they want to sign it now
         expect_hash, send_immediately, finalize, wants_dl = args
 
-        assert expect_hash == STATUS.psbt_hash, "hash mismatch"
+        assert SIGQ.get(expect_hash), "hash mismatch"
         if send_immediately: assert finalize, "must finalize b4 send"
 
-        logging.info("Starting to sign...")
-        STATUS.busy_signing = True
-        STATUS.notify_watchers()
+        logging.info("Queued for signing...")
 
+        # worker does auth steps, then signing; might be others ahead of us
         try:
-            dev = Connection()
-
-            # do auth steps first (no feedback given)
-            for pa, guess in zip(STATUS.pending_auth, STATUS._auth_guess):
-                if pa.name and guess:
-                    await dev.user_auth(pa.name, guess, int(pa.totp), a2b_hex(STATUS.psbt_hash))
+            fut = SIGQ.submit(expect_hash, finalize=finalize, from_ui=True)
+        except WouldRefuse as exc:
+            raise HTMLErrorMsg("HSM policy would refuse this transaction, so it was not "
+                                f"sent to the Coldcard.<br><br>{escape(str(exc))}")
+        STATUS.notify_watchers()
 
-            STATUS.reset_pending_auth()
+        try:
+            # if they go away, the Coldcard keeps going; result can be downloaded later
+            result = await asyncio.shield(fut)
+        except CCUserRefused:
+            logging.error("Coldcard refused to sign txn")
+            r = SIGQ.get(expect_hash).refusal
+            if not r:
+                raise HTMLErrorMsg('Refused by local user.')
+            else:
+                raise HTMLErrorMsg(f"Rejected by Coldcard.<br><br>{r}")
 
-            try:
-                result = await dev.sign_psbt(STATUS._pending_psbt, finalize=finalize)
-                logging.info("Done signing")
+        msg = "Transaction signed."
 
-                msg = "Transaction signed."
+        if send_immediately:
+            msg += '<br><br>' + await OUTBOX.send(result)
 
-                if send_immediately:
-                    msg += '<br><br>' + broadcast_txn(result)
+        await send_json(show_modal=True, html=Markup(msg), selector='.js-api-success')
 
-                await send_json(show_modal=True, html=Markup(msg), selector='.js-api-success')
+        if wants_dl:
+            await send_json(local_download=signed_download(expect_hash, finalize, result))
 
-                result = (b2a_hex(result) if finalize else b64encode(result)).decode('ascii')
-                fname = 'transaction.txt' if finalize else ('signed-%s.psbt'%STATUS.psbt_hash[-6:])
+    elif action == 'download_signed':
+        # they want the signed file again: can't sign twice, so must be in cache
+        hh, = args
+        item = SIGQ.get(hh)
+        assert item and item.state == DONE, "not signed yet"
 
-                if wants_dl:
-                    await send_json(local_download=dict(data=result, filename=fname,
-                                                        is_b64=(not finalize)))
+        result = await ARTIFACTS.get(hh, item.signer, 0, item.finalized)
+        if result is None:
+            raise HTMLErrorMsg("Signed file is no longer available.")
 
-                await dev.hsm_status()
-            except CCUserRefused:
-                logging.error("Coldcard refused to sign txn")
-                await dev.hsm_status()
-                r = STATUS.hsm.get('last_refusal', None)
-                if not r: 
-                    raise HTMLErroMsg('Refused by local user.')
-                else:
-                    raise HTMLErrorMsg(f"Rejected by Coldcard.<br><br>{r}")
-
-        finally:
-            STATUS.busy_signing = False
-            STATUS.notify_watchers()
+        await send_json(local_download=signed_download(hh, item.finalized, result))
 
     elif action == 'shutdown_bunker':
         await send_json(show_flash_msg="Bunker is shutdown.")
@@ -647,13 +758,8 @@ async def ws_api_handler(ses, send_json, req, orig_request):     # handle_api
         assert isinstance(storage, NaClCookieStorage)
         storage._secretbox = nacl.secret.SecretBox(os.urandom(32))
 
-        # kick everyone off (bonus step)
-        for w in web_sockets:
-            try:
-                await send_json(redirect='/logout', _ws=w)
-                await w.close()
-            except:
-                pass
+        # kick everyone off (bonus step); slow ones don't hold up the others
+        FANOUT.broadcast(json_dumps(dict(redirect='/logout')), close=True)
 
     else:
         raise NotImplementedError(action)
@@ -680,16 +786,14 @@ async def api_websocket(request):
     # begin a streaming response
     ws = web.WebSocketResponse()
     await ws.prepare(request)
-    web_sockets.add(ws)
 
-    try:
-        api_rx = asyncio.create_task(rx_handler(ses, ws, request))
-        dis_tx = asyncio.create_task(push_status_updates_handler(ws))
+    # status updates and replies go out from here (see fanout.py)
+    client = FANOUT.add(ws)
 
-        await asyncio.gather(api_rx, dis_tx)
+    try:
+        await rx_handler(ses, ws, client, request)
     finally:
-        api_rx.cancel()
-        dis_tx.cancel()
+        FANOUT.remove(client)
         await ws.close()
 
     return ws
@@ -784,6 +888,10 @@ def extra_filters(app):
 @web.middleware
 async def auth_everything(request, handler):
 
+    # REST API requests are signed; checked there
+    if restapi.is_api(request):
+        return await handler(request)
+
     # during setup, no login needed
     if STATUS.force_local_mode or STATUS.setup_mode:
         # bypass security completely
@@ -842,6 +950,7 @@ def startup(setup_mode):
     # create app: order of middlewares matters
     app = web.Application(middlewares=[sml, auth_everything])
     app.add_routes(routes)
+    app.add_routes(restapi.routes)
     app.router.add_static('/static', './static')
 
     # hack to obfuscate our identity a little
@@ -879,7 +988,7 @@ def startup(setup_mode):
 if __name__ == "__main__":
     from utils import setup_logging
     setup_logging()
-    dev = Connection(None)      # won't do anything tho, because async dev.run not called
+    dev = POOL.add(None)        # won't do anything tho, because async dev.run not called
     asyncio.run(startup())
 
 # EOF